@@ -0,0 +1,131 @@
+"""
+Precomputed pollutant values of every grid cell painted with every brush, for single-brush lookups.
+
+Usage: python -m air_quality.brush_impact --models models/<version> --data air_quality/all_data.csv --cores 16
+"""
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from air_quality import model_store
+from air_quality.brushes import BRUSH_COLORS, apply_brush
+from air_quality.train_models import FEATURES, POLLUTANTS, data_hash
+
+TABLE_NAME = 'brush_impact.npz'
+
+
+def build_impact_table(dict_models, grid, cores=None, chunk_rows=50_000):
+    """
+    Predicts every pollutant for every cell with every brush applied.
+
+    The forests predict with all cores (their trees are evaluated in parallel threads), and
+    the cells are processed in chunks so memory stays bounded for large grids.
+
+    :param dict_models: Dict pollutant -> model
+    :param grid: DataFrame with the FEATURES of the baseline grid, one row per cell
+    :param cores: Cores used by the forests (all cores if None)
+    :param chunk_rows: Number of cells processed at once
+    :return: float32 array [n_cells, n_brushes, n_pollutants]
+    """
+    cores = cores or os.cpu_count()
+    for model in dict_models.values():
+        if 'n_jobs' in model.get_params():
+            model.set_params(n_jobs=cores)
+
+    grid = grid[FEATURES].reset_index(drop=True)
+    table = np.empty((len(grid), len(BRUSH_COLORS), len(POLLUTANTS)), dtype=np.float32)
+    for start in range(0, len(grid), chunk_rows):
+        chunk = grid.iloc[start:start + chunk_rows]
+        # all brushes of the chunk in one batch per model
+        brushed = []
+        for color in BRUSH_COLORS:
+            rows = chunk.copy()
+            apply_brush(rows, rows.index, color)
+            brushed.append(rows)
+        brushed = pd.concat(brushed, ignore_index=True)
+        for j, pollutant in enumerate(POLLUTANTS):
+            values = dict_models[pollutant].predict(brushed)
+            table[start:start + len(chunk), :, j] = values.reshape(len(BRUSH_COLORS), len(chunk)).T
+        print(f"Cells {start}-{start + len(chunk)} of {len(grid)} done")
+    return table
+
+
+class BrushImpactTable:
+    """
+    Lookup of the pollutant values of a baseline cell painted with a single brush.
+    """
+
+    def __init__(self, values, grid_hash, models):
+        """
+        :param values: Array [n_cells, n_brushes, n_pollutants]
+        :param grid_hash: data_hash of the baseline grid features the table was built from
+        :param models: Dict pollutant -> model file hash the table was built with
+        """
+        self.values = values
+        self.grid_hash = grid_hash
+        self.models = models
+        self.brush_index = {color: i for i, color in enumerate(BRUSH_COLORS)}
+
+    def save(self, path):
+        np.savez(path, values=self.values, brushes=np.array(BRUSH_COLORS), pollutants=np.array(POLLUTANTS),
+                 grid_hash=self.grid_hash, models=json.dumps(self.models))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as table:
+            if table['brushes'].tolist() != BRUSH_COLORS or table['pollutants'].tolist() != POLLUTANTS:
+                raise ValueError(f"'{path}' was built for other brushes or pollutants")
+            return cls(table['values'], str(table['grid_hash']), json.loads(str(table['models'])))
+
+    @classmethod
+    def load_if_valid(cls, path, grid, model_dir):
+        """
+        Loads the table if it matches the baseline grid and the models, None otherwise.
+
+        :param grid: DataFrame with the FEATURES of the baseline grid
+        :param model_dir: Directory of the models that are served
+        """
+        if not os.path.exists(path):
+            return None
+        table = cls.load(path)
+        if table.grid_hash != data_hash(grid[FEATURES]):
+            print(f"Ignoring '{path}': it was built for another grid")
+            return None
+        if table.models != model_store.model_fingerprint(model_dir, POLLUTANTS):
+            print(f"Ignoring '{path}': it was built with other models")
+            return None
+        return table
+
+    def lookup(self, rows, brushes):
+        """
+        Pollutant values of baseline cells painted once.
+
+        :param rows: Array of cell positions in the baseline grid
+        :param brushes: Array of brush indices (positions in BRUSH_COLORS), one per row
+        :return: Array [len(rows), n_pollutants]
+        """
+        return self.values[rows, brushes]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Precompute pollutant values for every cell and brush.")
+    parser.add_argument("--models", default="models", help="Directory with the models; the table is saved here.")
+    parser.add_argument("--data", default=os.path.join('air_quality', 'all_data.csv'), help="Baseline grid table.")
+    parser.add_argument("--cores", type=int, default=os.cpu_count(), help="Cores used for the predictions.")
+    parser.add_argument("--chunk-rows", type=int, default=50_000, help="Cells processed at once.")
+    args = parser.parse_args()
+
+    dict_models = model_store.load_models(args.models, FEATURES, POLLUTANTS)
+    grid = pd.read_csv(args.data, low_memory=False)
+
+    start = time.perf_counter()
+    values = build_impact_table(dict_models, grid, args.cores, args.chunk_rows)
+    table = BrushImpactTable(values, data_hash(grid[FEATURES]), model_store.model_fingerprint(args.models, POLLUTANTS))
+    path = os.path.join(args.models, TABLE_NAME)
+    table.save(path)
+    print(f"Impact table {values.shape} ({values.nbytes / 1e6:.1f}MB) saved to '{path}' "
+          f"in {time.perf_counter() - start:.1f}s")
@@ -0,0 +1,182 @@
+"""
+Land-use brushes of the prediction page.
+
+Every brush colour painted on the map changes the features of the selected grid cells:
+red builds a city, green plants a forest, yellow turns land into crops, gray adds roads and
+purple places a factory in the cell.
+
+Each brush is a set of column edits: "set" overwrites a feature, "add" increases it. A request
+with many strokes is compiled into an EditPlan and applied to the feature matrix in one pass.
+"""
+
+import numpy as np
+
+CLASS_COLUMNS = [
+    'class_1_percent',
+    'class_2_percent',
+    'class_3_percent',
+    'class_4_percent',
+    'class_5_percent',
+    'class_6_percent',
+    'class_7_percent',
+    'class_8_percent',
+    'class_9_percent',
+    'class_10_percent',
+    'class_11_percent'
+]
+
+COLOR_TO_CLASS_COLUMN = {
+    'red': 'class_7_percent',  # CITY
+    'green': 'class_2_percent',  # FOREST
+    'yellow': 'class_5_percent',  # CROPS
+}
+
+BRUSH_COLORS = ['red', 'green', 'yellow', 'gray', 'purple']
+
+
+def _brush_edits(color):
+    """Column edits of a brush: {'set': {column: value}, 'add': {column: amount}}."""
+    edits = {'set': {}, 'add': {}}
+    if color == 'red':
+        edits['add']['population_sum'] = 1000
+    if color in COLOR_TO_CLASS_COLUMN:
+        edits['set'] = {col: 0 for col in CLASS_COLUMNS}
+        # LAND of type to 100%
+        edits['set'][COLOR_TO_CLASS_COLUMN[color]] = 100
+    elif color == 'gray':
+        edits['add']['road_length_m'] = 1000
+    elif color == 'purple':
+        edits['set']['distance_to_factory'] = 0
+    return edits
+
+
+BRUSH_EDITS = {color: _brush_edits(color) for color in BRUSH_COLORS}
+
+
+def apply_brush(df, mask, color):
+    """
+    Applies one brush to the rows of a grid DataFrame selected by mask (in place).
+
+    :param df: DataFrame with the model feature columns
+    :param mask: Boolean Series or row labels of the painted cells
+    :param color: Brush colour
+    :return: False if the colour is unknown (nothing is changed), True otherwise
+    """
+    if color not in BRUSH_EDITS:
+        return False
+    for col, amount in BRUSH_EDITS[color]['add'].items():
+        df.loc[mask, col] += amount
+    for col, value in BRUSH_EDITS[color]['set'].items():
+        df.loc[mask, col] = value
+    return True
+
+
+class EditPlan:
+    """
+    The strokes of one request, compiled into arrays and applied to a feature matrix in one pass.
+
+    Strokes are kept in request order. Where strokes overlap, a cell ends up with the value of
+    the last stroke that sets a column, plus every later addition to it, exactly as if the
+    strokes were applied one after another.
+    """
+
+    def __init__(self, n_cells):
+        """
+        :param n_cells: Number of rows of the feature matrix the plan will be applied to
+        """
+        self.n_cells = n_cells
+        self._rows = []
+        self._brushes = []
+
+    def add_stroke(self, rows, color):
+        """
+        Adds a stroke painting the given cells.
+
+        Cells of strokes with an unknown colour count as touched but are not changed.
+
+        :param rows: Integer positions of the painted cells
+        :return: False if the colour is unknown, True otherwise
+        """
+        rows = np.asarray(rows, dtype=np.intp)
+        self._rows.append(rows)
+        brush = BRUSH_COLORS.index(color) if color in BRUSH_EDITS else -1
+        self._brushes.append(brush)
+        return brush >= 0
+
+    def _pairs(self):
+        """(stroke order, cell row) for every painted cell of every stroke."""
+        if not self._rows:
+            empty = np.empty(0, dtype=np.intp)
+            return empty, empty
+        lengths = [len(rows) for rows in self._rows]
+        orders = np.repeat(np.arange(len(self._rows)), lengths)
+        return orders, np.concatenate(self._rows)
+
+    @property
+    def touched(self):
+        """Sorted positions of all cells covered by at least one stroke."""
+        _, rows = self._pairs()
+        return np.unique(rows)
+
+    def stroke_count(self):
+        """Number of strokes covering every cell, array [n_cells]."""
+        _, rows = self._pairs()
+        return np.bincount(rows, minlength=self.n_cells)
+
+    def last_brush(self):
+        """Index in BRUSH_COLORS of the last stroke of every cell (-1 if none or unknown colour)."""
+        orders, rows = self._pairs()
+        last_order = np.full(self.n_cells, -1)
+        np.maximum.at(last_order, rows, orders)
+        brushes = np.append(np.asarray(self._brushes, dtype=int), -1)
+        return brushes[last_order]
+
+    def apply(self, X, features):
+        """
+        Applies all strokes to a feature matrix in place.
+
+        Only the touched rows are visited. For every column the last stroke that sets it is
+        found per cell with one np.maximum.at over all (stroke, cell) pairs, and the additions
+        made after it are summed with one np.add.at.
+
+        :param X: Float array [n_cells, n_features]
+        :param features: Column names of X
+        :return: Sorted positions of the touched cells
+        """
+        orders, rows = self._pairs()
+        touched, cell = np.unique(rows, return_inverse=True)
+        if not len(touched):
+            return touched
+        set_table, add_table = edit_tables(features)
+        # unknown colours (-1) pick the last table row, which neither sets nor adds anything
+        stroke_set = set_table[np.asarray(self._brushes)]
+        stroke_add = add_table[np.asarray(self._brushes)]
+
+        for j in np.flatnonzero(~np.isnan(stroke_set).all(axis=0) | stroke_add.any(axis=0)):
+            sets = ~np.isnan(stroke_set[orders, j])
+            last_set = np.full(len(touched), -1)
+            np.maximum.at(last_set, cell[sets], orders[sets])
+            values = X[touched, j]
+            has_set = last_set >= 0
+            values[has_set] = stroke_set[last_set[has_set], j]
+            # additions only count after the last stroke that set the column
+            adds = (stroke_add[orders, j] != 0) & (orders > last_set[cell])
+            np.add.at(values, cell[adds], stroke_add[orders[adds], j])
+            X[touched, j] = values
+        return touched
+
+
+def edit_tables(features):
+    """
+    Brush edits as arrays over the feature columns.
+
+    :return: (set values [n_brushes + 1, n_features] with NaN where a brush does not set the column,
+              additions [n_brushes + 1, n_features]); the extra last row is a no-op
+    """
+    set_table = np.full((len(BRUSH_COLORS) + 1, len(features)), np.nan)
+    add_table = np.zeros((len(BRUSH_COLORS) + 1, len(features)))
+    for b, color in enumerate(BRUSH_COLORS):
+        for j, col in enumerate(features):
+            set_table[b, j] = BRUSH_EDITS[color]['set'].get(col, np.nan)
+            add_table[b, j] = BRUSH_EDITS[color]['add'].get(col, 0)
+    return set_table, add_table
@@ -0,0 +1,176 @@
+"""
+Shrinks the pollutant forests (fewer trees, depth or leaves) within a hold-out RMSE budget.
+
+Usage: python -m air_quality.compress_models --models models/<version> --tolerance 0.02 --out models/<version>-small
+"""
+import argparse
+import copy
+import os
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import joblib
+import numpy as np
+import pandas as pd
+import sklearn
+from sklearn.ensemble import RandomForestRegressor
+from sklearn.metrics import mean_absolute_error, mean_squared_error, r2_score
+from sklearn.model_selection import train_test_split
+
+from air_quality import model_store
+from air_quality.train_models import FEATURES, POLLUTANTS, data_hash, load_feature_table, measure_latency
+
+
+def prune_trees(model, n_trees):
+    """Copy of a fitted forest that keeps only its first n_trees trees."""
+    pruned = copy.copy(model)
+    pruned.estimators_ = model.estimators_[:n_trees]
+    pruned.n_estimators = len(pruned.estimators_)
+    return pruned
+
+
+def measure_file(model):
+    """Size in bytes of the compressed joblib file and the time to load it back."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'model.joblib')
+        joblib.dump(model, path, compress=3)
+        size = os.path.getsize(path)
+        start = time.perf_counter()
+        joblib.load(path)
+        load_seconds = time.perf_counter() - start
+    return size, load_seconds
+
+
+def evaluate(model, X_test, y_test):
+    """Hold-out error, batch latency, file size and load time of one candidate."""
+    y_pred = model.predict(X_test)
+    size, load_seconds = measure_file(model)
+    latency = measure_latency(model, X_test)
+    return {
+        'n_trees': len(model.estimators_),
+        'rmse': float(np.sqrt(mean_squared_error(y_test, y_pred))),
+        'mae': float(mean_absolute_error(y_test, y_pred)),
+        'r2': float(r2_score(y_test, y_pred)),
+        'size_bytes': size,
+        'load_seconds': load_seconds,
+        'batch_ms': latency['batch_ms'],
+        'single_row_ms': latency['single_row_ms'],
+    }
+
+
+def candidates(model, X_train, y_train, tree_counts, max_depths, max_leaf_nodes, refit_trees, n_jobs,
+               random_state):
+    """Yields (name, params, model) for every candidate of one pollutant, starting with the full forest."""
+    yield 'full', {}, model
+    for n_trees in tree_counts:
+        if n_trees < len(model.estimators_):
+            yield f'trees={n_trees}', {'n_trees': n_trees}, prune_trees(model, n_trees)
+    for depth in max_depths:
+        refit = RandomForestRegressor(n_estimators=refit_trees, max_depth=depth, random_state=random_state,
+                                      n_jobs=n_jobs).fit(X_train, y_train)
+        yield f'depth={depth}', {'n_trees': refit_trees, 'max_depth': depth}, refit
+    for leaves in max_leaf_nodes:
+        refit = RandomForestRegressor(n_estimators=refit_trees, max_leaf_nodes=leaves, random_state=random_state,
+                                      n_jobs=n_jobs).fit(X_train, y_train)
+        yield f'leaves={leaves}', {'n_trees': refit_trees, 'max_leaf_nodes': leaves}, refit
+
+
+def compress_pollutant(model, df, pollutant, tolerance, test_size=0.2, random_state=42, n_jobs=None,
+                       tree_counts=(25, 50, 100, 200, 400), max_depths=(8, 12, 16),
+                       max_leaf_nodes=(256, 1024, 4096), refit_trees=100):
+    """
+    Evaluates all candidates of one pollutant and picks the operating point.
+
+    :param tolerance: Allowed relative RMSE increase over the full forest (0.02 = 2 %)
+    :return: (report DataFrame with one row per candidate, selected model)
+    """
+    X_train, X_test, y_train, y_test = train_test_split(
+        df[FEATURES], df[pollutant], test_size=test_size, random_state=random_state)
+
+    rows = []
+    fitted = {}
+    for name, params, candidate in candidates(model, X_train, y_train, tree_counts, max_depths, max_leaf_nodes,
+                                              refit_trees, n_jobs, random_state):
+        row = {'pollutant': pollutant, 'candidate': name, **evaluate(candidate, X_test, y_test),
+               'params': params}
+        rows.append(row)
+        fitted[name] = candidate
+        print(f"{pollutant} {name}: RMSE={row['rmse']:.4g} size={row['size_bytes'] / 1e6:.1f}MB "
+              f"load={row['load_seconds']:.2f}s batch={row['batch_ms']:.1f}ms")
+
+    report = pd.DataFrame(rows)
+    full_rmse = report.loc[report['candidate'] == 'full', 'rmse'].iloc[0]
+    report['rmse_increase'] = report['rmse'] / full_rmse - 1 if full_rmse > 0 else 0.0
+    report['within_tolerance'] = report['rmse_increase'] <= tolerance
+    best = report[report['within_tolerance']].sort_values(['batch_ms', 'size_bytes']).iloc[0]
+    report['selected'] = report['candidate'] == best['candidate']
+    return report, fitted[best['candidate']]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compress the pollutant forests under an accuracy tolerance.")
+    parser.add_argument("--models", default="models", help="Directory with the trained models.")
+    parser.add_argument("--data", default=os.path.join('air_quality', 'all_data.csv'),
+                        help="Feature table CSV or grid dataset directory (the training data).")
+    parser.add_argument("--tolerance", type=float, default=0.02,
+                        help="Allowed relative RMSE increase on the hold-out data (0.02 = 2%%).")
+    parser.add_argument("--tree-counts", type=int, nargs="*", default=[25, 50, 100, 200, 400])
+    parser.add_argument("--max-depths", type=int, nargs="*", default=[8, 12, 16])
+    parser.add_argument("--max-leaf-nodes", type=int, nargs="*", default=[256, 1024, 4096])
+    parser.add_argument("--refit-trees", type=int, default=100, help="Trees of the refitted candidates.")
+    parser.add_argument("--cores", type=int, default=os.cpu_count(), help="Cores used for refitting.")
+    parser.add_argument("--report", default="compression_report.csv", help="Where to write the report.")
+    parser.add_argument("--out", default=None, help="Directory for the selected models (not written if omitted).")
+    args = parser.parse_args()
+
+    base_manifest = model_store.read_manifest(args.models)
+    params = (base_manifest or {}).get('params', {})
+    test_size = params.get('test_size', 0.2)
+    random_state = params.get('random_state', 42)
+
+    dict_models = model_store.load_models(args.models, FEATURES, POLLUTANTS)
+    df = load_feature_table(args.data).dropna()
+    if base_manifest is not None and data_hash(df[FEATURES + POLLUTANTS]) != base_manifest['data']['sha256']:
+        print("Warning: the data differs from the training data in the manifest, hold-out rows may have been seen")
+
+    reports = []
+    selected = {}
+    for pollutant in POLLUTANTS:
+        report, selected[pollutant] = compress_pollutant(
+            dict_models[pollutant], df, pollutant, args.tolerance, test_size, random_state, args.cores,
+            args.tree_counts, args.max_depths, args.max_leaf_nodes, args.refit_trees)
+        reports.append(report)
+    report = pd.concat(reports, ignore_index=True)
+    report.to_csv(args.report, index=False)
+    print(report.loc[report['selected'], ['pollutant', 'candidate', 'rmse_increase', 'size_bytes', 'batch_ms']])
+    print(f"Report saved to '{args.report}'")
+
+    if args.out:
+        os.makedirs(args.out, exist_ok=True)
+        models = {}
+        for pollutant, model in selected.items():
+            path = os.path.join(args.out, model_store.model_file_name(pollutant))
+            joblib.dump(model, path, compress=3)
+            row = report[(report['pollutant'] == pollutant) & report['selected']].iloc[0]
+            models[pollutant] = {
+                'file': os.path.basename(path),
+                'file_sha256': model_store.file_sha256(path),
+                'metrics': {'r2': row['r2'], 'mae': row['mae'], 'rmse': row['rmse']},
+                'latency': {'single_row_ms': row['single_row_ms'], 'batch_ms': row['batch_ms']},
+                'compression': {'candidate': row['candidate'], 'rmse_increase': row['rmse_increase']},
+            }
+        manifest = {
+            'version': os.path.basename(os.path.normpath(args.out)),
+            'created': datetime.now(timezone.utc).isoformat(),
+            'compressed_from': (base_manifest or {}).get('version', args.models),
+            'tolerance': args.tolerance,
+            'features': list(FEATURES),
+            'pollutants': list(POLLUTANTS),
+            'params': {'test_size': test_size, 'random_state': random_state},
+            'data': {'rows': int(len(df)), 'sha256': data_hash(df[FEATURES + POLLUTANTS])},
+            'sklearn_version': sklearn.__version__,
+            'models': models,
+        }
+        model_store.write_manifest(args.out, manifest)
+        print(f"Selected models saved to '{args.out}'")
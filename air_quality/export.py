@@ -0,0 +1,195 @@
+"""Streaming export of a scenario (baseline grid + overlay) as GeoJSON, GeoParquet or CSV, chunk by chunk."""
+import io
+import json
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+CHUNK_ROWS = 5_000
+
+# media type and file extension of every format
+FORMATS = {
+    'geojson': ('application/geo+json', 'geojson'),
+    'geoparquet': ('application/vnd.apache.parquet', 'parquet'),
+    'csv': ('text/csv', 'csv'),
+}
+
+# WKB of a polygon with one ring of 5 points: byte order, geometry type, ring count, point count, x/y
+_WKB_POLYGON = np.dtype([('order', 'u1'), ('type', '<u4'), ('rings', '<u4'), ('points', '<u4'),
+                         ('xy', '<f8', (10,))])
+
+
+def parse_bbox(text):
+    """
+    Bounding box from "min_lon,min_lat,max_lon,max_lat".
+
+    :raises ValueError: If the text does not have four numbers or the box is empty
+    """
+    parts = [float(v) for v in text.split(',')]
+    if len(parts) != 4 or parts[0] > parts[2] or parts[1] > parts[3]:
+        raise ValueError("bbox must be min_lon,min_lat,max_lon,max_lat")
+    return parts
+
+
+def _position_chunks(n_rows, overlay, changed_only, chunk_rows):
+    """Sorted positions of the rows to export, chunk by chunk."""
+    if changed_only:
+        for start in range(0, len(overlay.positions), chunk_rows):
+            yield overlay.positions[start:start + chunk_rows]
+    else:
+        for start in range(0, n_rows, chunk_rows):
+            yield np.arange(start, min(start + chunk_rows, n_rows))
+
+
+def cell_rings(store, grid, rows):
+    """
+    Closed exterior rings of cells, counter-clockwise from the south-west corner.
+
+    :param grid: RegularGrid of the store, None to use the sw/ne columns
+    :return: (lon, lat), arrays [n, 5]
+    """
+    if grid is not None:
+        lon, lat = grid.cell_corners(rows)
+    else:
+        sw_lon, sw_lat = store.column('sw_lon')[rows], store.column('sw_lat')[rows]
+        ne_lon, ne_lat = store.column('ne_lon')[rows], store.column('ne_lat')[rows]
+        lon = np.stack([sw_lon, ne_lon, ne_lon, sw_lon], axis=1)
+        lat = np.stack([sw_lat, sw_lat, ne_lat, ne_lat], axis=1)
+    return np.concatenate([lon, lon[:, :1]], axis=1), np.concatenate([lat, lat[:, :1]], axis=1)
+
+
+def iter_chunks(store, overlay, columns, grid=None, bbox=None, changed_only=False, chunk_rows=CHUNK_ROWS):
+    """
+    Rows of a scenario chunk by chunk.
+
+    :param store: GridStore of the baseline
+    :param overlay: Overlay of the scenario
+    :param columns: Columns of the store to export
+    :param grid: RegularGrid of the store, None to use the sw/ne columns for the polygons
+    :param bbox: [min_lon, min_lat, max_lon, max_lat]; only cells intersecting it are exported
+    :param changed_only: Only export the cells of the overlay
+    :return: Generator of (DataFrame with the columns and a 'changed' flag, ring lon, ring lat); an export
+             without any cell yields one empty chunk, so the encoders still write the header and schema
+    """
+    empty = True
+    for rows in _position_chunks(len(store), overlay, changed_only, chunk_rows):
+        if bbox is not None:
+            inside = ((store.column('ne_lon')[rows] >= bbox[0]) & (store.column('sw_lon')[rows] <= bbox[2]) &
+                      (store.column('ne_lat')[rows] >= bbox[1]) & (store.column('sw_lat')[rows] <= bbox[3]))
+            rows = rows[inside]
+        if not len(rows):
+            continue
+        empty = False
+        df = overlay.apply(store.frame(columns, rows), add_columns=False)
+        changed = np.zeros(len(rows), dtype=bool)
+        changed[overlay.lookup(rows)[0]] = True
+        df['changed'] = changed
+        lon, lat = cell_rings(store, grid, rows)
+        yield df, lon, lat
+    if empty:
+        rows = np.empty(0, dtype=np.int64)
+        df = store.frame(columns, rows)
+        df['changed'] = np.zeros(0, dtype=bool)
+        yield (df,) + cell_rings(store, grid, rows)
+
+
+def _ring_text(lon, lat, template):
+    xy = np.empty((len(lon), 10))
+    xy[:, 0::2], xy[:, 1::2] = lon, lat
+    return [template % tuple(row) for row in xy.tolist()]
+
+
+def geojson_chunks(chunks):
+    """Encodes chunks from iter_chunks as one GeoJSON FeatureCollection."""
+    coordinates = '[[' + ','.join(['[%.7f,%.7f]'] * 5) + ']]'
+    yield '{"type":"FeatureCollection","features":['
+    first = True
+    for df, lon, lat in chunks:
+        properties = df.to_json(orient='records', lines=True, double_precision=15).splitlines()
+        features = ','.join(
+            '{"type":"Feature","geometry":{"type":"Polygon","coordinates":%s},"properties":%s}' % pair
+            for pair in zip(_ring_text(lon, lat, coordinates), properties))
+        yield features if first else ',' + features
+        first = False
+    yield ']}\n'
+
+
+def csv_chunks(chunks):
+    """Encodes chunks from iter_chunks as CSV with the cell polygons as WKT in a geometry column."""
+    wkt = 'POLYGON ((' + ', '.join(['%.7f %.7f'] * 5) + '))'
+    header = True
+    for df, lon, lat in chunks:
+        df['geometry'] = _ring_text(lon, lat, wkt)
+        yield df.to_csv(index=False, header=header)
+        header = False
+
+
+def wkb_polygons(lon, lat):
+    """Cell rings as a pyarrow binary array of WKB polygons."""
+    wkb = np.zeros(len(lon), dtype=_WKB_POLYGON)
+    wkb['order'], wkb['type'], wkb['rings'], wkb['points'] = 1, 3, 1, 5
+    wkb['xy'][:, 0::2], wkb['xy'][:, 1::2] = lon, lat
+    offsets = np.arange(len(lon) + 1, dtype=np.int32) * _WKB_POLYGON.itemsize
+    return pa.Array.from_buffers(pa.binary(), len(lon), [None, pa.py_buffer(offsets), pa.py_buffer(wkb.tobytes())])
+
+
+class _Drain(io.RawIOBase):
+    """Write-only file that hands out what was written to it since the last drain."""
+
+    def __init__(self):
+        self._parts = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        data = b''.join(self._parts)
+        self._parts = []
+        return data
+
+
+def geoparquet_chunks(chunks):
+    """
+    Encodes chunks from iter_chunks as GeoParquet 1.0 with WKB polygons, one row group per chunk.
+
+    Row groups are sent as soon as they are written; only the footer waits for the end.
+    """
+    sink = _Drain()
+    writer = None
+    for df, lon, lat in chunks:
+        table = pa.Table.from_pandas(df, preserve_index=False).append_column('geometry', wkb_polygons(lon, lat))
+        # text columns of an empty chunk have no inferred type
+        table = table.cast(pa.schema([field.with_type(pa.string()) if pa.types.is_null(field.type) else field
+                                      for field in table.schema], metadata=table.schema.metadata))
+        if writer is None:
+            geo = {'version': '1.0.0', 'primary_column': 'geometry',
+                   'columns': {'geometry': {'encoding': 'WKB', 'geometry_types': ['Polygon']}}}
+            schema = table.schema.with_metadata({**(table.schema.metadata or {}), b'geo': json.dumps(geo).encode()})
+            writer = pq.ParquetWriter(sink, schema)
+        writer.write_table(table.cast(writer.schema))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+ENCODERS = {'geojson': geojson_chunks, 'geoparquet': geoparquet_chunks, 'csv': csv_chunks}
+
+
+def stream(fmt, store, overlay, columns, grid=None, bbox=None, changed_only=False, chunk_rows=CHUNK_ROWS):
+    """
+    Encoded export of a scenario, chunk by chunk.
+
+    :param fmt: One of FORMATS
+    :return: Generator of str (GeoJSON, CSV) or bytes (GeoParquet)
+    """
+    return ENCODERS[fmt](iter_chunks(store, overlay, columns, grid, bbox, changed_only, chunk_rows))
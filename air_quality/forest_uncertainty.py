@@ -0,0 +1,90 @@
+"""Mean, spread and quantiles of the per-tree predictions of a fitted random forest, vectorized over the trees."""
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import ExtraTreesRegressor, RandomForestRegressor
+
+
+def quantile_suffix(q):
+    """Field suffix of a quantile, its percentage without rounding: q05 for 0.05, q02_5 for 0.025."""
+    whole, _, fraction = np.format_float_positional(round(q * 100, 10), trim='-').partition('.')
+    return f"q{int(whole):02d}" + (f"_{fraction}" if fraction else "")
+
+
+def uncertainty_field_names(pollutant, quantiles=()):
+    """Names of the uncertainty fields of a pollutant, e.g. no2_ppb_std, no2_ppb_q05."""
+    return [f"{pollutant}_std"] + [f"{pollutant}_{quantile_suffix(q)}" for q in quantiles]
+
+
+class StackedForest:
+    """
+    Leaf values of all trees of a forest, stacked for vectorized per-tree predictions.
+    """
+
+    def __init__(self, forest):
+        """
+        :param forest: Fitted single-output RandomForestRegressor or ExtraTreesRegressor
+        """
+        self.forest = forest
+        trees = [estimator.tree_ for estimator in forest.estimators_]
+        node_counts = np.array([tree.node_count for tree in trees])
+        # offset of every tree's nodes in the flat array
+        self.offsets = np.concatenate([[0], np.cumsum(node_counts)[:-1]])
+        self.node_values = np.concatenate([tree.value[:, 0, 0] for tree in trees])
+
+    @property
+    def n_trees(self):
+        return len(self.offsets)
+
+    def per_tree_predictions(self, X):
+        """Array [rows, trees] with the prediction of every tree for every row."""
+        leaves = self.forest.apply(X)  # [rows, trees] node ids, computed in parallel by the forest
+        return self.node_values[leaves + self.offsets]
+
+    def predict_with_uncertainty(self, X, quantiles=(), chunk_rows=4096):
+        """
+        Mean, standard deviation and quantiles across trees for a batch of rows.
+
+        Rows are processed in chunks so the [rows, trees] matrix stays small.
+
+        :param X: Feature rows (DataFrame with the training feature names)
+        :param quantiles: Quantiles to compute, e.g. (0.05, 0.95)
+        :return: (mean [rows], dict field suffix -> array [rows]) with suffixes "std" and quantile_suffix(q)
+        """
+        mean = np.empty(len(X))
+        spread = {name: np.empty(len(X)) for name in ['std'] + [quantile_suffix(q) for q in quantiles]}
+        for start in range(0, len(X), chunk_rows):
+            rows = slice(start, start + chunk_rows)
+            per_tree = self.per_tree_predictions(X.iloc[rows] if isinstance(X, pd.DataFrame) else X[rows])
+            mean[rows] = per_tree.mean(axis=1)
+            spread['std'][rows] = per_tree.std(axis=1)
+            if quantiles:
+                values = np.quantile(per_tree, quantiles, axis=1)
+                for q, value in zip(quantiles, values):
+                    spread[quantile_suffix(q)][rows] = value
+        return mean, spread
+
+
+def stack_forests(dict_models):
+    """
+    StackedForest for every model that is a regression forest (random forest, extra trees); other models,
+    boosted trees included (their trees are summed, not averaged), are skipped.
+    """
+    return {pollutant: StackedForest(model) for pollutant, model in dict_models.items()
+            if isinstance(model, (RandomForestRegressor, ExtraTreesRegressor))}
+
+
+def predict_with_uncertainty(stacked, X, pollutants, quantiles=()):
+    """
+    Predictions and uncertainty fields of all pollutants for a batch.
+
+    :param stacked: Dict pollutant -> StackedForest
+    :return: (dict pollutant -> mean array, DataFrame with the uncertainty fields)
+    """
+    means = {}
+    fields = {}
+    for pollutant in pollutants:
+        mean, spread = stacked[pollutant].predict_with_uncertainty(X, quantiles)
+        means[pollutant] = mean
+        for suffix, values in spread.items():
+            fields[f"{pollutant}_{suffix}"] = values
+    return means, pd.DataFrame(fields, index=X.index if isinstance(X, pd.DataFrame) else None)
@@ -0,0 +1,126 @@
+"""
+Year-partitioned Parquet dataset (grid_dataset/year=YYYY/) of the grid features and pollutant values.
+
+Usage: python -m air_quality.grid_dataset air_quality/all_data.csv air_quality/all_data_2023.csv
+"""
+import argparse
+import os
+import shutil
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+DEFAULT_DATASET_DIR = os.path.join('air_quality', 'grid_dataset')
+
+GEOMETRY_COLUMNS = ['lon', 'lat', 'sw_lon', 'sw_lat', 'ne_lon', 'ne_lat']
+POLLUTANT_COLUMNS = ['no2_ppb', 'co_ppb', 'so2_ppb', 'o3_ppb', 'ch4_ppb']
+FEATURE_COLUMNS = [
+    'road_length_m', 'population_sum', 'distance_to_factory',
+    'class_1_percent', 'class_2_percent', 'class_3_percent',
+    'class_4_percent', 'class_5_percent', 'class_6_percent',
+    'class_7_percent', 'class_8_percent', 'class_9_percent',
+    'class_10_percent', 'class_11_percent'
+]
+
+# Schema of every partition file (the year lives in the directory name, not in the file)
+FILE_SCHEMA = pa.schema(
+    [pa.field('grid_id_x', pa.string())] +
+    [pa.field(col, pa.float64()) for col in GEOMETRY_COLUMNS + POLLUTANT_COLUMNS + FEATURE_COLUMNS]
+)
+PARTITIONING = ds.partitioning(pa.schema([pa.field('year', pa.int32())]), flavor='hive')
+
+
+def _normalize_chunk(chunk):
+    """Brings a chunk of a GEE export / merged CSV to the dataset column layout."""
+    if 'grid_id_x' not in chunk.columns and 'grid_id' in chunk.columns:
+        chunk = chunk.rename(columns={'grid_id': 'grid_id_x'})
+
+    out = pd.DataFrame(index=chunk.index)
+    out['grid_id_x'] = chunk['grid_id_x'].astype(str) if 'grid_id_x' in chunk.columns else None
+    for col in FILE_SCHEMA.names[1:]:
+        # Exports without LULC/feature columns are stored with NaN for the missing values
+        out[col] = pd.to_numeric(chunk[col], errors='coerce') if col in chunk.columns else float('nan')
+    out['year'] = pd.to_numeric(chunk['year']).astype(int)
+    return out
+
+
+def build_dataset(csv_paths, out_dir=DEFAULT_DATASET_DIR, chunksize=100_000):
+    """
+    Converts yearly CSV tables into the year-partitioned dataset.
+
+    The CSVs are streamed in chunks, so memory stays bounded by the chunk size no matter
+    how many years are converted. Partitions of the years found in the input are replaced.
+
+    :param csv_paths: Paths of CSV files with a "year" column
+    :param out_dir: Root directory of the dataset
+    :param chunksize: Number of CSV rows processed at once
+    :return: Sorted list of the years that were written
+    """
+    written_years = set()
+    for file_idx, csv_path in enumerate(csv_paths):
+        for chunk_idx, chunk in enumerate(pd.read_csv(csv_path, chunksize=chunksize, low_memory=False)):
+            chunk = _normalize_chunk(chunk)
+            for year, year_rows in chunk.groupby('year'):
+                year_dir = os.path.join(out_dir, f'year={int(year)}')
+                if year not in written_years:
+                    shutil.rmtree(year_dir, ignore_errors=True)
+                    os.makedirs(year_dir)
+                    written_years.add(year)
+                table = pa.Table.from_pandas(year_rows.drop(columns='year'), schema=FILE_SCHEMA, preserve_index=False)
+                pq.write_table(table, os.path.join(year_dir, f'part-{file_idx}-{chunk_idx}.parquet'))
+            print(f"Converted chunk {chunk_idx} of {csv_path}")
+    return sorted(int(y) for y in written_years)
+
+
+def open_dataset(dataset_dir=DEFAULT_DATASET_DIR):
+    """Opens the dataset lazily; no data is read until a scan is executed."""
+    return ds.dataset(dataset_dir, format='parquet', schema=FILE_SCHEMA.append(PARTITIONING.schema.field('year')),
+                      partitioning=PARTITIONING)
+
+
+def available_years(dataset_dir=DEFAULT_DATASET_DIR):
+    """Lists the years stored in the dataset by looking at the partition directories only."""
+    if not os.path.isdir(dataset_dir):
+        return []
+    years = []
+    for name in os.listdir(dataset_dir):
+        if name.startswith('year='):
+            years.append(int(name.split('=', 1)[1]))
+    return sorted(years)
+
+
+def load_years(years, columns=None, dataset_dir=DEFAULT_DATASET_DIR):
+    """
+    Loads the requested years and columns into a DataFrame.
+
+    The year filter is pushed down to the partition directories and the column list to
+    the Parquet reader, so other years and columns are never read.
+
+    :param years: Iterable of years to load
+    :param columns: Columns to load (all columns if None); "year" is always included
+    :param dataset_dir: Root directory of the dataset
+    :return: DataFrame with the requested rows and columns
+    """
+    dataset = open_dataset(dataset_dir)
+    if columns is not None:
+        columns = [col for col in columns if col != 'year'] + ['year']
+    table = dataset.to_table(columns=columns, filter=ds.field('year').isin([int(y) for y in years]))
+    return table.to_pandas()
+
+
+def load_year(year, columns=None, dataset_dir=DEFAULT_DATASET_DIR):
+    """Loads a single year of the dataset; see load_years."""
+    return load_years([year], columns=columns, dataset_dir=dataset_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert yearly grid CSVs into a year-partitioned Parquet dataset.")
+    parser.add_argument("csv_files", nargs="+", help="CSV files with the same columns as all_data.csv.")
+    parser.add_argument("--out", default=DEFAULT_DATASET_DIR, help="Output dataset directory.")
+    parser.add_argument("--chunksize", type=int, default=100_000, help="CSV rows processed at once.")
+    args = parser.parse_args()
+
+    years = build_dataset(args.csv_files, args.out, args.chunksize)
+    print(f"Dataset written to '{args.out}' with years: {years}")
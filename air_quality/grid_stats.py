@@ -0,0 +1,192 @@
+"""Aggregate pollutant statistics of the grid and of scenarios, from additive sums updated by the painted cells only."""
+import numpy as np
+
+from air_quality.brushes import CLASS_COLUMNS
+
+DEFAULT_REGION_KM = 10
+DEFAULT_BINS = 40
+CHUNK_ROWS = 100_000
+
+
+class Sums:
+    """
+    Additive statistics of a set of cells, per pollutant.
+    """
+
+    def __init__(self, n_pollutants, n_regions, n_classes, n_bins):
+        self.count = np.zeros(n_pollutants)
+        self.total = np.zeros(n_pollutants)
+        self.population = np.zeros(n_pollutants)
+        self.exposure = np.zeros(n_pollutants)
+        self.region_count = np.zeros((n_regions, n_pollutants))
+        self.region_total = np.zeros((n_regions, n_pollutants))
+        self.class_count = np.zeros((n_classes, n_pollutants))
+        self.class_total = np.zeros((n_classes, n_pollutants))
+        # bin 0 holds values below the first edge, bin n_bins + 1 values above the last one
+        self.histogram = np.zeros((n_pollutants, n_bins + 2))
+
+    def copy(self):
+        copied = Sums.__new__(Sums)
+        copied.__dict__ = {name: values.copy() for name, values in self.__dict__.items()}
+        return copied
+
+    def add(self, values, population, regions, classes, bins, sign=1):
+        """
+        Adds (sign=1) or removes (sign=-1) the contribution of cells.
+
+        :param values: Pollutant values [n, n_pollutants], NaN where unknown
+        :param population: Population of the cells [n]
+        :param regions: Region of the cells [n]
+        :param classes: Dominant land class of the cells [n]
+        :param bins: Histogram bin of every value [n, n_pollutants]
+        """
+        valid = np.isfinite(values)
+        filled = np.where(valid, values, 0.0)
+        population = np.where(np.isfinite(population), population, 0.0)
+        self.count += sign * valid.sum(axis=0)
+        self.total += sign * filled.sum(axis=0)
+        self.population += sign * (population[:, None] * valid).sum(axis=0)
+        self.exposure += sign * (population[:, None] * filled).sum(axis=0)
+        n_regions, n_classes = len(self.region_count), len(self.class_count)
+        for j in range(values.shape[1]):
+            self.region_count[:, j] += sign * np.bincount(regions, valid[:, j], n_regions)
+            self.region_total[:, j] += sign * np.bincount(regions, filled[:, j], n_regions)
+            self.class_count[:, j] += sign * np.bincount(classes, valid[:, j], n_classes)
+            self.class_total[:, j] += sign * np.bincount(classes, filled[:, j], n_classes)
+            self.histogram[j] += sign * np.bincount(bins[valid[:, j], j], minlength=self.histogram.shape[1])
+
+
+def _mean(total, count):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total / count
+    return [None if not np.isfinite(v) else float(v) for v in np.atleast_1d(mean)]
+
+
+class GridStatistics:
+    """
+    Baseline sums of the grid and the scenario sums derived from them.
+    """
+
+    def __init__(self, store, pollutants, grid=None, region_km=DEFAULT_REGION_KM, n_bins=DEFAULT_BINS):
+        """
+        :param store: GridStore of the baseline grid
+        :param pollutants: Pollutant columns
+        :param grid: RegularGrid of the store, None to make the regions from the cell centres
+        :param region_km: Side of the square regions in cells (kilometers)
+        :param n_bins: Number of histogram bins between the baseline minimum and maximum
+        """
+        self.store = store
+        self.pollutants = list(pollutants)
+        self.regions, self.region_names = self._regions(store, grid, region_km)
+        baseline = np.column_stack([store.column(p) for p in self.pollutants])
+        low, high = np.nanmin(baseline, axis=0), np.nanmax(baseline, axis=0)
+        self.edges = np.linspace(low, high, n_bins + 1, axis=1)
+        # cells by decreasing baseline value, to merge with the painted cells for the top cells
+        self.order = np.argsort(-np.where(np.isfinite(baseline), baseline, -np.inf), axis=0, kind='stable').T
+        self.baseline = Sums(len(self.pollutants), len(self.region_names), len(CLASS_COLUMNS), n_bins)
+        for start in range(0, len(store), CHUNK_ROWS):
+            rows = np.arange(start, min(start + CHUNK_ROWS, len(store)))
+            self.baseline.add(*self._contribution(rows, self._baseline_columns(rows)))
+        self._cache = {}
+
+    @staticmethod
+    def _regions(store, grid, region_km):
+        """Region of every cell and the names of the regions."""
+        if grid is not None:
+            cols, rows = grid.cols // region_km, grid.rows // region_km
+            tile_cols = grid.col0 + cols * region_km
+            tile_rows = grid.row0 + rows * region_km
+        else:
+            lat = np.asarray(store.column('lat'))
+            lon = np.asarray(store.column('lon'))
+            km_per_degree = 111.32
+            tile_cols = np.floor(lon * km_per_degree * np.cos(np.radians(np.nanmean(lat))) / region_km).astype(np.int64)
+            tile_rows = np.floor(lat * km_per_degree / region_km).astype(np.int64)
+        tiles, regions = np.unique(np.stack([tile_cols, tile_rows], axis=1), axis=0, return_inverse=True)
+        return regions.ravel(), [f"{col},{row}" for col, row in tiles.tolist()]
+
+    def _baseline_columns(self, rows):
+        columns = self.pollutants + ['population_sum'] + CLASS_COLUMNS
+        return {col: np.asarray(self.store.column(col)[rows]) for col in columns}
+
+    def _contribution(self, rows, columns):
+        """Arguments of Sums.add for cells with the given column values."""
+        values = np.column_stack([columns[p] for p in self.pollutants])
+        classes = np.argmax(np.nan_to_num(np.column_stack([columns[c] for c in CLASS_COLUMNS]), nan=-1.0), axis=1)
+        bins = np.column_stack([np.searchsorted(self.edges[j], values[:, j], side='right')
+                                for j in range(len(self.pollutants))])
+        # the maximum belongs to the last bin, not above it
+        n_bins = self.edges.shape[1] - 1
+        bins[values == self.edges[:, -1]] = n_bins
+        return values, columns['population_sum'], self.regions[rows], classes, np.where(np.isfinite(values), bins, 0)
+
+    def scenario_sums(self, overlay, version=None):
+        """
+        Sums of a scenario: the baseline sums with the cells of the overlay replaced.
+
+        :param overlay: Overlay of the scenario
+        :param version: Hashable id of the overlay (scenario key and file version); the sums of the last
+                        versions are cached
+        """
+        if version is not None and version in self._cache:
+            return self._cache[version]
+        sums = self.baseline
+        if len(overlay):
+            rows = overlay.positions
+            old = self._baseline_columns(rows)
+            new = {col: overlay.values.get(col, values) for col, values in old.items()}
+            sums = sums.copy()
+            sums.add(*self._contribution(rows, old), sign=-1)
+            sums.add(*self._contribution(rows, new))
+        if version is not None:
+            if len(self._cache) >= 64:
+                self._cache.pop(next(iter(self._cache)))
+            self._cache[version] = sums
+        return sums
+
+    def summary(self, sums):
+        """Number of cells, mean and population-weighted exposure of every pollutant."""
+        return {p: {'cells': int(sums.count[j]), 'mean': _mean(sums.total[j], sums.count[j])[0],
+                    'population_weighted': _mean(sums.exposure[j], sums.population[j])[0]}
+                for j, p in enumerate(self.pollutants)}
+
+    def histogram(self, sums, pollutant):
+        """Counts over the fixed bins of a pollutant (edges from the baseline minimum to maximum)."""
+        j = self.pollutants.index(pollutant)
+        counts = sums.histogram[j].round().astype(int)
+        return {'edges': self.edges[j].tolist(), 'counts': counts[1:-1].tolist(),
+                'below': int(counts[0]), 'above': int(counts[-1])}
+
+    def by_region(self, sums):
+        """Number of cells and mean of every pollutant per region."""
+        means = {p: _mean(sums.region_total[:, j], sums.region_count[:, j]) for j, p in enumerate(self.pollutants)}
+        return [{'region': name, 'cells': int(sums.region_count[i].max()),
+                 'mean': {p: means[p][i] for p in self.pollutants}}
+                for i, name in enumerate(self.region_names) if sums.region_count[i].max() > 0]
+
+    def by_land_class(self, sums):
+        """Number of cells and mean of every pollutant per dominant land class."""
+        means = {p: _mean(sums.class_total[:, j], sums.class_count[:, j]) for j, p in enumerate(self.pollutants)}
+        return [{'land_class': name, 'cells': int(sums.class_count[i].max()),
+                 'mean': {p: means[p][i] for p in self.pollutants}}
+                for i, name in enumerate(CLASS_COLUMNS) if sums.class_count[i].max() > 0]
+
+    def top_cells(self, overlay, pollutant, n=10):
+        """
+        Positions and values of the n cells with the highest values of a pollutant in a scenario.
+
+        The baseline order is precomputed, so only the first n unchanged cells of it are merged with the
+        cells of the overlay.
+        """
+        j = self.pollutants.index(pollutant)
+        order = self.order[j]
+        changed = overlay.positions
+        head = order[:n + len(changed)]
+        head = head[~np.isin(head, changed)][:n]
+        positions = np.concatenate([head, changed])
+        values = np.asarray(self.store.column(pollutant)[head], dtype=float)
+        if len(changed):
+            scenario_values = overlay.values.get(pollutant, np.asarray(self.store.column(pollutant)[changed]))
+            values = np.concatenate([values, scenario_values])
+        best = np.argsort(-np.where(np.isfinite(values), values, -np.inf), kind='stable')[:n]
+        return positions[best], values[best]
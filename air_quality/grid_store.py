@@ -0,0 +1,315 @@
+"""
+Baseline grid stored as memory-mapped .npy columns shared by the server workers, and the Overlay of painted cells.
+
+Usage: python -m air_quality.grid_store --data air_quality/all_data.csv [--benchmark 4]
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from air_quality.scenario_log import file_lock
+
+DEFAULT_STORE_DIR = os.path.join('air_quality', 'grid_store')
+DEFAULT_OVERLAY_DIR = os.path.join('air_quality', 'overlays')
+META_NAME = 'meta.json'
+
+
+def _source_info(csv_path):
+    """Identity of the CSV the store was published from (changes whenever the file does)."""
+    stat = os.stat(csv_path)
+    return {'path': os.path.abspath(csv_path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def _column_file(store_dir, column):
+    return os.path.join(store_dir, column + '.npy')
+
+
+def _lock_path(store_dir):
+    return os.path.abspath(store_dir) + '.lock'
+
+
+def _is_current(csv_path, store_dir):
+    """Whether the store exists and was published from the CSV as it is now."""
+    meta_path = os.path.join(store_dir, META_NAME)
+    if not os.path.exists(meta_path):
+        return False
+    with open(meta_path) as f:
+        return json.load(f).get('source') == _source_info(csv_path)
+
+
+def _write_store(csv_path, store_dir):
+    """Writes the store to a temporary directory and renames it into place; call with the store's lock held."""
+    df = pd.read_csv(csv_path, low_memory=False)
+    parent = os.path.dirname(os.path.abspath(store_dir))
+    os.makedirs(parent, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=parent, prefix='.grid_store-')
+    for col in df.columns:
+        values = df[col].to_numpy()
+        if values.dtype == object:
+            # text columns (grid ids) as fixed-width bytes, so they can be memory-mapped too
+            values = df[col].astype(str).str.encode('utf-8').to_numpy().astype(bytes)
+        else:
+            # numbers as float64 like in the grid dataset, so edits never change a column's type
+            values = values.astype(np.float64)
+        np.save(_column_file(tmp_dir, col), values)
+    with open(os.path.join(tmp_dir, META_NAME), 'w') as f:
+        json.dump({'columns': list(df.columns), 'n_rows': len(df), 'source': _source_info(csv_path)}, f, indent=2)
+
+    old_dir = None
+    if os.path.exists(store_dir):
+        # workers that still map the old files keep valid views after they are unlinked
+        old_dir = tempfile.mkdtemp(dir=parent, prefix='.grid_store-old-')
+        os.rmdir(old_dir)
+        os.replace(store_dir, old_dir)
+    try:
+        os.replace(tmp_dir, store_dir)
+    except OSError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    if old_dir is not None:
+        shutil.rmtree(old_dir, ignore_errors=True)
+    print(f"Published {len(df)} rows x {len(df.columns)} columns of '{csv_path}' to '{store_dir}'")
+
+
+class GridStore:
+    """
+    Read-only, memory-mapped columns of the baseline grid.
+    """
+
+    def __init__(self, store_dir):
+        """
+        :param store_dir: Directory written by GridStore.publish
+        """
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, META_NAME)) as f:
+            self.meta = json.load(f)
+        self.columns = self.meta['columns']
+        self._arrays = {col: np.load(_column_file(store_dir, col), mmap_mode='r') for col in self.columns}
+
+    def __len__(self):
+        return self.meta['n_rows']
+
+    @staticmethod
+    def publish(csv_path, store_dir=DEFAULT_STORE_DIR):
+        """
+        Writes the columns of a CSV table as .npy files.
+
+        The store is written to a temporary directory and renamed into place under a file lock, so
+        workers starting at the same time never see a half-written store or move each other's aside.
+
+        :param csv_path: Baseline table (all_data.csv)
+        :param store_dir: Directory of the store
+        """
+        with file_lock(_lock_path(store_dir)):
+            _write_store(csv_path, store_dir)
+
+    @classmethod
+    def open_or_publish(cls, csv_path, store_dir=DEFAULT_STORE_DIR):
+        """Opens the store, publishing it first if it is missing or older than the CSV."""
+        if not _is_current(csv_path, store_dir):
+            with file_lock(_lock_path(store_dir)):
+                # another worker may have published it while this one waited for the lock
+                if not _is_current(csv_path, store_dir):
+                    _write_store(csv_path, store_dir)
+        return cls(store_dir)
+
+    def column(self, name):
+        """Read-only memory-mapped array of a column."""
+        return self._arrays[name]
+
+    def frame(self, columns=None, rows=None):
+        """
+        Private DataFrame copy of some columns and rows of the grid.
+
+        :param columns: Columns to copy (all if None)
+        :param rows: Positions of the rows to copy (all if None); the frame is indexed by position
+        """
+        columns = self.columns if columns is None else list(columns)
+        rows = None if rows is None else np.asarray(rows, dtype=np.int64)
+        data = {}
+        for col in columns:
+            values = self._arrays[col] if rows is None else self._arrays[col][rows]
+            data[col] = np.char.decode(values, 'utf-8').astype(object) if values.dtype.kind == 'S' \
+                else np.array(values)
+        return pd.DataFrame(data, index=pd.RangeIndex(len(self)) if rows is None else rows)
+
+
+class Overlay:
+    """
+    Values of the cells a session changed, on top of the baseline grid.
+    """
+
+    def __init__(self, positions=None, values=None):
+        """
+        :param positions: Sorted, unique positions of the changed cells
+        :param values: Dict column -> array of values, one per position
+        """
+        self.positions = np.asarray([] if positions is None else positions, dtype=np.int64)
+        self.values = values or {}
+
+    def __len__(self):
+        return len(self.positions)
+
+    def update(self, positions, values):
+        """
+        Sets the values of cells; cells already in the overlay are overwritten.
+
+        :param positions: Positions of the cells
+        :param values: Dict column -> array of values, one per position
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        merged = np.union1d(self.positions, positions)
+        old = np.searchsorted(merged, self.positions)
+        new = np.searchsorted(merged, positions)
+        merged_values = {}
+        for col in list(self.values) + [col for col in values if col not in self.values]:
+            column = np.full(len(merged), np.nan)
+            if col in self.values:
+                column[old] = self.values[col]
+            if col in values:
+                column[new] = values[col]
+            merged_values[col] = column
+        self.positions = merged
+        self.values = merged_values
+
+    def drop(self, positions):
+        """Removes cells from the overlay, so they show the baseline values again."""
+        keep = ~np.isin(self.positions, positions)
+        self.positions = self.positions[keep]
+        self.values = {col: values[keep] for col, values in self.values.items()}
+
+    def copy(self):
+        return Overlay(self.positions.copy(), {col: values.copy() for col, values in self.values.items()})
+
+    def lookup(self, rows):
+        """
+        Overlay entries of a set of rows.
+
+        :return: (positions in rows that are in the overlay, their indices in the overlay)
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        idx = np.minimum(np.searchsorted(self.positions, rows), max(len(self.positions) - 1, 0))
+        hit = (self.positions[idx] == rows) if len(self.positions) else np.zeros(len(rows), dtype=bool)
+        return np.flatnonzero(hit), idx[hit]
+
+    def apply(self, df, add_columns=True):
+        """
+        Writes the overlay values onto a frame from GridStore.frame (in place).
+
+        :param add_columns: Add the overlay columns missing from the frame (NaN outside the
+                            overlay) instead of skipping them
+        """
+        at, idx = self.lookup(df.index.to_numpy())
+        for col, values in self.values.items():
+            if col not in df.columns:
+                if not add_columns:
+                    continue
+                df[col] = np.nan
+            df.iloc[at, df.columns.get_loc(col)] = values[idx]
+        return df
+
+    def save(self, path):
+        """Writes the overlay atomically, so readers in other workers never see a partial file."""
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp_path = path + f'.{os.getpid()}.tmp.npz'
+        np.savez(tmp_path, positions=self.positions, columns=np.array(list(self.values), dtype=str),
+                 **{f'value_{i}': values for i, values in enumerate(self.values.values())})
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Loads an overlay, an empty one if the file does not exist."""
+        if not os.path.exists(path):
+            return cls()
+        with np.load(path) as f:
+            columns = f['columns'].tolist()
+            return cls(f['positions'], {col: f[f'value_{i}'] for i, col in enumerate(columns)})
+
+
+def proportional_set_size(pid='self'):
+    """
+    Memory of a process in bytes with shared pages split between the processes sharing them
+    (Pss of /proc/<pid>/smaps_rollup); None where /proc is not available.
+    """
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as f:
+            for line in f:
+                if line.startswith('Pss:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+def _benchmark_worker(mode, csv_path, store_dir, results, all_loaded):
+    """Loads the grid like a server worker would and reports its memory once all workers loaded."""
+    before = proportional_set_size()
+    if mode == 'private':
+        grid = pd.read_csv(csv_path)
+        checksum = float(grid.select_dtypes('number').to_numpy().sum())
+    else:
+        store = GridStore(store_dir)
+        # touch every page, as serving the whole grid would
+        checksum = float(sum(store.column(col).sum() for col in store.columns if store.column(col).dtype.kind == 'f'))
+    results.put(('loaded', checksum))
+    all_loaded.wait()
+    # measured while all workers are alive, so shared pages are split between them
+    results.put(('memory', before, proportional_set_size()))
+    all_loaded.wait()
+
+
+def benchmark(csv_path, store_dir, workers):
+    """
+    Total memory of N worker processes holding the grid privately (pandas) vs. attached to the store.
+
+    :return: Dict mode -> (total Pss of the workers in bytes, Pss added by loading the grid)
+    """
+    context = multiprocessing.get_context('spawn')
+    report = {}
+    for mode in ('private', 'store'):
+        results = context.Queue()
+        all_loaded = context.Barrier(workers + 1)
+        processes = [context.Process(target=_benchmark_worker, args=(mode, csv_path, store_dir, results, all_loaded))
+                     for _ in range(workers)]
+        for process in processes:
+            process.start()
+        for _ in range(workers):
+            results.get()
+        all_loaded.wait()
+        memory = [results.get() for _ in range(workers)]
+        all_loaded.wait()
+        for process in processes:
+            process.join()
+        if any(after is None for _, _, after in memory):
+            return None
+        report[mode] = (sum(after for _, _, after in memory), sum(after - before for _, before, after in memory))
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Publish the baseline grid as memory-mapped columns.")
+    parser.add_argument("--data", default=os.path.join('air_quality', 'all_data.csv'), help="Baseline grid table.")
+    parser.add_argument("--store", default=DEFAULT_STORE_DIR, help="Directory of the store.")
+    parser.add_argument("--benchmark", type=int, metavar="WORKERS",
+                        help="Compare the memory of this many workers with private copies and with the store.")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    GridStore.publish(args.data, args.store)
+    print(f"Done in {time.perf_counter() - start:.1f}s")
+
+    if args.benchmark:
+        report = benchmark(args.data, args.store, args.benchmark)
+        if report is None:
+            sys.exit("The memory benchmark needs /proc (Linux)")
+        for mode, (total, grid) in report.items():
+            print(f"{mode:>8}: {args.benchmark} workers use {total / 1e6:.1f}MB in total, "
+                  f"{grid / 1e6:.1f}MB of it for the grid")
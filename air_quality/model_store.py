@@ -0,0 +1,98 @@
+"""Versioned storage of the pollutant models (model_<pollutant>.joblib and manifest.json)."""
+import hashlib
+import json
+import os
+
+import joblib
+import sklearn
+
+MANIFEST_NAME = 'manifest.json'
+
+
+class ModelCompatibilityError(ValueError):
+    """Raised when stored models do not match the features or pollutants the caller expects."""
+
+
+def model_file_name(pollutant):
+    return "model_" + pollutant + ".joblib"
+
+
+def file_sha256(path, block_size=1 << 20):
+    """SHA-256 of a file, read in blocks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def write_manifest(model_dir, manifest):
+    with open(os.path.join(model_dir, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+
+def read_manifest(model_dir):
+    """Returns the manifest of a model directory, None for directories without one."""
+    path = os.path.join(model_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def check_manifest(manifest, features, pollutants):
+    """
+    Checks that a manifest was trained on the given features and covers the pollutants.
+
+    :raises ModelCompatibilityError: If the features differ or a pollutant is missing
+    """
+    if manifest['features'] != list(features):
+        raise ModelCompatibilityError(
+            f"Models were trained on features {manifest['features']}, expected {list(features)}")
+    missing = [p for p in pollutants if p not in manifest['models']]
+    if missing:
+        raise ModelCompatibilityError(f"No models for pollutants {missing} in manifest version {manifest['version']}")
+    if manifest.get('sklearn_version') != sklearn.__version__:
+        print(f"Warning: models were trained with scikit-learn {manifest.get('sklearn_version')}, "
+              f"running {sklearn.__version__}")
+
+
+def load_models(model_dir, features, pollutants, verify_files=True):
+    """
+    Loads one model per pollutant and verifies it against the expected features.
+
+    :param model_dir: Directory with the model_<pollutant>.joblib files (and optional manifest)
+    :param features: Feature columns in the order the caller will pass them
+    :param pollutants: Pollutants to load
+    :param verify_files: Compare the model files with the hashes stored in the manifest
+    :return: Dict pollutant -> fitted model
+    :raises ModelCompatibilityError: If a model does not match the features or its file changed
+    """
+    manifest = read_manifest(model_dir)
+    if manifest is not None:
+        check_manifest(manifest, features, pollutants)
+    else:
+        print(f"No {MANIFEST_NAME} in '{model_dir}', loading models without version checks")
+
+    models = {}
+    for pollutant in pollutants:
+        model_path = os.path.join(model_dir, model_file_name(pollutant))
+        if manifest is not None and verify_files:
+            expected = manifest['models'][pollutant]['file_sha256']
+            if file_sha256(model_path) != expected:
+                raise ModelCompatibilityError(f"'{model_path}' does not match the hash in the manifest")
+        model = joblib.load(model_path)
+        fitted_features = getattr(model, 'feature_names_in_', None)
+        if fitted_features is not None and list(fitted_features) != list(features):
+            raise ModelCompatibilityError(
+                f"Model for {pollutant} was fitted on {list(fitted_features)}, expected {list(features)}")
+        models[pollutant] = model
+    return models
+
+
+def model_fingerprint(model_dir, pollutants):
+    """File hashes of the models of a directory, taken from the manifest when there is one."""
+    manifest = read_manifest(model_dir)
+    if manifest is not None:
+        return {p: manifest['models'][p]['file_sha256'] for p in pollutants}
+    return {p: file_sha256(os.path.join(model_dir, model_file_name(p))) for p in pollutants}
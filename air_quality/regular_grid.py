@@ -0,0 +1,214 @@
+"""Implicit geometry of the regular 1 km UTM (EPSG:32633) grid the data was exported on."""
+import numpy as np
+
+CRS = 'EPSG:32633'
+CELL_SIZE_M = 1000
+
+# WGS84 ellipsoid and UTM zone 33N
+SEMI_MAJOR_AXIS = 6378137.0
+FLATTENING = 1 / 298.257223563
+CENTRAL_MERIDIAN = 15.0
+SCALE_FACTOR = 0.9996
+FALSE_EASTING = 500000.0
+FALSE_NORTHING = 0.0
+
+_n = FLATTENING / (2 - FLATTENING)
+_RECTIFYING_RADIUS = SEMI_MAJOR_AXIS / (1 + _n) * (1 + _n ** 2 / 4 + _n ** 4 / 64)
+_ALPHA = [
+    _n / 2 - 2 * _n ** 2 / 3 + 5 * _n ** 3 / 16 + 41 * _n ** 4 / 180,
+    13 * _n ** 2 / 48 - 3 * _n ** 3 / 5 + 557 * _n ** 4 / 1440,
+    61 * _n ** 3 / 240 - 103 * _n ** 4 / 140,
+    49561 * _n ** 4 / 161280,
+]
+_BETA = [
+    _n / 2 - 2 * _n ** 2 / 3 + 37 * _n ** 3 / 96 - _n ** 4 / 360,
+    _n ** 2 / 48 + _n ** 3 / 15 - 437 * _n ** 4 / 1440,
+    17 * _n ** 3 / 480 - 37 * _n ** 4 / 840,
+    4397 * _n ** 4 / 161280,
+]
+_DELTA = [
+    2 * _n - 2 * _n ** 2 / 3 - 2 * _n ** 3 + 116 * _n ** 4 / 45,
+    7 * _n ** 2 / 3 - 8 * _n ** 3 / 5 - 227 * _n ** 4 / 45,
+    56 * _n ** 3 / 15 - 136 * _n ** 4 / 35,
+    4279 * _n ** 4 / 630,
+]
+
+
+def lonlat_to_utm(lon, lat):
+    """
+    Projects WGS84 coordinates to UTM zone 33N.
+
+    :param lon: Longitudes in degrees
+    :param lat: Latitudes in degrees
+    :return: (easting, northing) in meters
+    """
+    phi = np.radians(np.asarray(lat, dtype=float))
+    lam = np.radians(np.asarray(lon, dtype=float) - CENTRAL_MERIDIAN)
+    e = 2 * np.sqrt(_n) / (1 + _n)
+    t = np.sinh(np.arctanh(np.sin(phi)) - e * np.arctanh(e * np.sin(phi)))
+    xi = np.arctan2(t, np.cos(lam))
+    eta = np.arctanh(np.sin(lam) / np.sqrt(1 + t * t))
+    x, y = eta.copy(), xi.copy()
+    for j, alpha in enumerate(_ALPHA, start=1):
+        x += alpha * np.cos(2 * j * xi) * np.sinh(2 * j * eta)
+        y += alpha * np.sin(2 * j * xi) * np.cosh(2 * j * eta)
+    k = SCALE_FACTOR * _RECTIFYING_RADIUS
+    return FALSE_EASTING + k * x, FALSE_NORTHING + k * y
+
+
+def utm_to_lonlat(easting, northing):
+    """
+    Inverse of lonlat_to_utm.
+
+    :return: (lon, lat) in degrees
+    """
+    k = SCALE_FACTOR * _RECTIFYING_RADIUS
+    xi = (np.asarray(northing, dtype=float) - FALSE_NORTHING) / k
+    eta = (np.asarray(easting, dtype=float) - FALSE_EASTING) / k
+    xi_p, eta_p = xi.copy(), eta.copy()
+    for j, beta in enumerate(_BETA, start=1):
+        xi_p -= beta * np.sin(2 * j * xi) * np.cosh(2 * j * eta)
+        eta_p -= beta * np.cos(2 * j * xi) * np.sinh(2 * j * eta)
+    chi = np.arcsin(np.sin(xi_p) / np.cosh(eta_p))
+    phi = chi.copy()
+    for j, delta in enumerate(_DELTA, start=1):
+        phi += delta * np.sin(2 * j * chi)
+    lam = np.arctan2(np.sinh(eta_p), np.cos(xi_p))
+    return CENTRAL_MERIDIAN + np.degrees(lam), np.degrees(phi)
+
+
+def parse_grid_ids(grid_ids):
+    """
+    Column and row of cells from their "col,row" ids.
+
+    :return: (cols, rows) int arrays
+    :raises ValueError: If an id is not of the form "col,row"
+    """
+    parts = np.asarray(grid_ids, dtype=str)
+    split = np.char.partition(parts, ',')
+    if not (split[:, 1] == ',').all():
+        raise ValueError("Grid ids must have the form 'col,row'")
+    return split[:, 0].astype(np.int64), split[:, 2].astype(np.int64)
+
+
+class RegularGrid:
+    """
+    Cells of the regular UTM grid as integer col/row, with the geometry derived on demand.
+    """
+
+    def __init__(self, cols, rows, step=CELL_SIZE_M):
+        """
+        :param cols: Column of every cell (UTM easting // step)
+        :param rows: Row of every cell (UTM northing // step)
+        :param step: Cell size in meters
+        """
+        cols = np.asarray(cols, dtype=np.int64)
+        rows = np.asarray(rows, dtype=np.int64)
+        self.step = step
+        self.col0 = int(cols.min()) if len(cols) else 0
+        self.row0 = int(rows.min()) if len(rows) else 0
+        self.n_cols = int(cols.max()) - self.col0 + 1 if len(cols) else 0
+        self.n_rows = int(rows.max()) - self.row0 + 1 if len(rows) else 0
+        # cell indices relative to the origin fit in 32 bits
+        self.cols = (cols - self.col0).astype(np.int32)
+        self.rows = (rows - self.row0).astype(np.int32)
+        # position of the (first) table row of every grid cell, -1 where the grid has no cell
+        self.positions = np.full((self.n_rows, self.n_cols), -1, dtype=np.int64)
+        cells, first = np.unique(self.rows.astype(np.int64) * self.n_cols + self.cols, return_index=True)
+        self.positions.flat[cells] = first
+
+    @classmethod
+    def from_grid_ids(cls, grid_ids, step=CELL_SIZE_M):
+        cols, rows = parse_grid_ids(grid_ids)
+        return cls(cols, rows, step)
+
+    @classmethod
+    def from_grid(cls, df):
+        """Grid of a DataFrame with grid_id_x, None if its ids are not "col,row"."""
+        if 'grid_id_x' not in df.columns:
+            return None
+        try:
+            return cls.from_grid_ids(df['grid_id_x'].astype(str).to_numpy())
+        except ValueError:
+            return None
+
+    @property
+    def origin(self):
+        """UTM easting and northing of the south-west corner of the grid."""
+        return self.col0 * self.step, self.row0 * self.step
+
+    def descriptor(self):
+        """JSON-ready description of the grid: enough to derive the geometry of every cell."""
+        return {
+            'crs': CRS,
+            'step': self.step,
+            'origin': list(self.origin),
+            'shape': [self.n_rows, self.n_cols],
+            'projection': {
+                'central_meridian': CENTRAL_MERIDIAN,
+                'scale_factor': SCALE_FACTOR,
+                'false_easting': FALSE_EASTING,
+                'false_northing': FALSE_NORTHING,
+            },
+        }
+
+    def _cells(self, positions):
+        if positions is None:
+            return self.cols, self.rows
+        return self.cols[positions], self.rows[positions]
+
+    def cell_centres(self, positions=None):
+        """
+        Lon/lat of the centres of cells.
+
+        :param positions: Table positions of the cells (all cells if None)
+        :return: (lon, lat)
+        """
+        cols, rows = self._cells(positions)
+        x0, y0 = self.origin
+        return utm_to_lonlat(x0 + (cols + 0.5) * self.step, y0 + (rows + 0.5) * self.step)
+
+    def cell_bounds(self, positions=None):
+        """
+        Lon/lat of the south-west and north-east corners of cells.
+
+        :param positions: Table positions of the cells (all cells if None)
+        :return: (sw_lon, sw_lat, ne_lon, ne_lat)
+        """
+        cols, rows = self._cells(positions)
+        x0, y0 = self.origin
+        sw_lon, sw_lat = utm_to_lonlat(x0 + cols * self.step, y0 + rows * self.step)
+        ne_lon, ne_lat = utm_to_lonlat(x0 + (cols + 1) * self.step, y0 + (rows + 1) * self.step)
+        return sw_lon, sw_lat, ne_lon, ne_lat
+
+    def cell_corners(self, positions=None):
+        """
+        Lon/lat of the four corners of cells, counter-clockwise from the south-west corner.
+
+        The cells are squares in UTM, so in lon/lat they are slightly rotated quadrilaterals.
+
+        :param positions: Table positions of the cells (all cells if None)
+        :return: (lon, lat), arrays [n, 4]
+        """
+        cols, rows = self._cells(positions)
+        x0, y0 = self.origin
+        dx = np.array([0, 1, 1, 0])
+        dy = np.array([0, 0, 1, 1])
+        return utm_to_lonlat(x0 + (cols[:, None] + dx) * self.step, y0 + (rows[:, None] + dy) * self.step)
+
+    def locate(self, lon, lat):
+        """
+        Table positions of the cells containing coordinates.
+
+        :param lon: Longitudes in degrees
+        :param lat: Latitudes in degrees
+        :return: Int array of positions, -1 for coordinates outside the grid
+        """
+        x, y = lonlat_to_utm(lon, lat)
+        x0, y0 = self.origin
+        cols = np.floor((x - x0) / self.step).astype(np.int64)
+        rows = np.floor((y - y0) / self.step).astype(np.int64)
+        inside = (cols >= 0) & (cols < self.n_cols) & (rows >= 0) & (rows < self.n_rows)
+        out = np.full(cols.shape, -1, dtype=np.int64)
+        out[inside] = self.positions[rows[inside], cols[inside]]
+        return out
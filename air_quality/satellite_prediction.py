@@ -0,0 +1,182 @@
+"""Cached predictions of the next year's satellite image from a model exported by models/export_model.py."""
+import hashlib
+import io
+import json
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tifffile
+import torch
+from PIL import Image
+from skimage import transform
+
+from air_quality.scenario_log import canonical_json, prune_cache
+
+METADATA_FILE = 'predictor.json'
+YEAR_IMAGE = re.compile(r'^output_image_(\d{4})\.(tif|tiff|png|jpg|jpeg)$', re.IGNORECASE)
+# preferred format when a year has several files
+FORMAT_RANK = {'tif': 0, 'tiff': 0, 'png': 1, 'jpg': 2, 'jpeg': 2}
+
+
+def load_exported(path):
+    """TorchScript model and metadata of an exported predictor."""
+    extra = {METADATA_FILE: ''}
+    model = torch.jit.load(path, map_location='cpu', _extra_files=extra)
+    return model.eval(), json.loads(extra[METADATA_FILE])
+
+
+def year_images(image_dir):
+    """Image file of every year in a directory, {year: path}."""
+    found = {}
+    for name in sorted(os.listdir(image_dir)) if os.path.isdir(image_dir) else []:
+        match = YEAR_IMAGE.match(name)
+        if match:
+            year, ext = int(match.group(1)), match.group(2).lower()
+            if year not in found or FORMAT_RANK[ext] < FORMAT_RANK[found[year][1]]:
+                found[year] = (os.path.join(image_dir, name), ext)
+    return {year: path for year, (path, _) in found.items()}
+
+
+def read_region(path, bbox=None):
+    """
+    RGB pixels of an image, cut to a bounding box.
+
+    :param bbox: [min_lon, min_lat, max_lon, max_lat], None for the whole image
+    :raises ValueError: If a bounding box is given for an image without georeferencing, or misses the image
+    """
+    if not path.lower().endswith(('.tif', '.tiff')):
+        if bbox is not None:
+            raise ValueError(f"{os.path.basename(path)} is not georeferenced, only the whole image can be predicted")
+        return np.asarray(Image.open(path).convert('RGB'))
+    try:
+        # uncompressed GeoTIFFs are memory-mapped, so only the region is read
+        image = tifffile.memmap(path, mode='r')
+    except ValueError:
+        image = tifffile.imread(path)
+    if bbox is None:
+        return np.asarray(image[:, :, :3])
+    with tifffile.TiffFile(path) as tif:
+        tags = tif.pages[0].tags
+        if 33550 not in tags or 33922 not in tags:
+            raise ValueError(f"{os.path.basename(path)} is not georeferenced, only the whole image can be predicted")
+        dx, dy = tags[33550].value[:2]
+        min_lon, max_lat = tags[33922].value[3:5]
+    height, width = image.shape[:2]
+    col0 = max(0, int(np.floor((bbox[0] - min_lon) / dx)))
+    col1 = min(width, int(np.ceil((bbox[2] - min_lon) / dx)))
+    row0 = max(0, int(np.floor((max_lat - bbox[3]) / dy)))
+    row1 = min(height, int(np.ceil((max_lat - bbox[1]) / dy)))
+    if col1 <= col0 or row1 <= row0:
+        raise ValueError("The bounding box does not overlap the satellite images")
+    return np.asarray(image[row0:row1, col0:col1, :3])
+
+
+def encode_png(image):
+    """PNG of a float image [H, W, 3] in [0, 1]."""
+    buffer = io.BytesIO()
+    Image.fromarray(np.clip(np.round(image * 255), 0, 255).astype(np.uint8)).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+class ImagePredictor:
+    """
+    Exported predictor with a worker pool and a disk cache of the predicted images.
+    """
+
+    def __init__(self, model_path, image_dir, cache_dir, workers=2, cache_size=500):
+        """
+        :param model_path: TorchScript file from models/export_model.py
+        :param image_dir: Directory of the yearly images
+        :param cache_dir: Directory of the cached PNGs
+        :param workers: Predictions running at the same time
+        :param cache_size: Cached PNGs kept on disk
+        """
+        self.model, self.metadata = load_exported(model_path)
+        self.input_years = self.metadata['input_years']
+        self.size = self.metadata['size']
+        self.image_dir = image_dir
+        self.cache_dir = cache_dir
+        self.cache_size = cache_size
+        with open(model_path, 'rb') as f:
+            self.model_sha256 = hashlib.sha256(f.read()).hexdigest()
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._lock = threading.Lock()
+        self._pending = {}
+
+    def available_years(self):
+        return sorted(year_images(self.image_dir))
+
+    def check_years(self, years):
+        """
+        Years of a request, the last input_years available years if None.
+
+        :raises ValueError: If the years are not consecutive, not as many as the model takes or missing
+        """
+        available = self.available_years()
+        if years is None:
+            years = available[-self.input_years:]
+        years = list(years)
+        if len(years) != self.input_years:
+            raise ValueError(f"The model predicts from {self.input_years} consecutive years, got {len(years)} "
+                             f"(available: {available})")
+        if any(b != a + 1 for a, b in zip(years, years[1:])):
+            raise ValueError("The years must be consecutive")
+        missing = [year for year in years if year not in available]
+        if missing:
+            raise ValueError(f"No satellite images of {missing} (available: {available})")
+        return years
+
+    def cache_key(self, years, bbox):
+        paths = year_images(self.image_dir)
+        sources = [(os.path.basename(paths[year]), os.stat(paths[year]).st_size, os.stat(paths[year]).st_mtime_ns)
+                   for year in years]
+        region = None if bbox is None else [round(v, 7) for v in bbox]
+        return hashlib.sha256(canonical_json([self.model_sha256, years, region, sources]).encode('utf-8')).hexdigest()
+
+    def _predict(self, years, bbox):
+        paths = year_images(self.image_dir)
+        frames = []
+        for year in years:
+            img = transform.resize(read_region(paths[year], bbox), (self.size, self.size))
+            frames.append(torch.from_numpy(img.astype(np.float32)).permute(2, 0, 1))
+        with torch.inference_mode():
+            predicted = self.model(torch.stack(frames).unsqueeze(0))[0]
+        return encode_png(predicted.float().permute(1, 2, 0).numpy())
+
+    def _predict_and_cache(self, key, path, years, bbox):
+        try:
+            png = self._predict(years, bbox)
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_path = path + f'.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(png)
+            os.replace(tmp_path, path)
+            prune_cache(self.cache_dir, self.cache_size)
+            return png
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+
+    def predict(self, years=None, bbox=None):
+        """
+        PNG of the predicted image of the year after the input years.
+
+        :param years: Consecutive input years (the last available ones if None)
+        :param bbox: [min_lon, min_lat, max_lon, max_lat] of the region, None for the whole images
+        :return: (PNG bytes, predicted year, whether it came from the cache)
+        :raises ValueError: If the years or the region cannot be predicted
+        """
+        years = self.check_years(years)
+        key = self.cache_key(years, bbox)
+        path = os.path.join(self.cache_dir, key + '.png')
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                return f.read(), years[-1] + 1, True
+        with self._lock:
+            future = self._pending.get(key)
+            if future is None:
+                future = self._pending[key] = self._executor.submit(self._predict_and_cache, key, path, years, bbox)
+        return future.result(), years[-1] + 1, False
@@ -0,0 +1,172 @@
+"""Scenarios as append-only logs of brush edits, with a chained key for every state to cache its overlay under."""
+import hashlib
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: no flock, the development server runs one process
+    fcntl = None
+
+
+def canonical_json(value):
+    return json.dumps(value, sort_keys=True, separators=(',', ':'))
+
+
+def seed_hash(*parts):
+    """Key of the empty scenario, from anything the materialized result depends on (grid, models, ...)."""
+    return hashlib.sha256(canonical_json(parts).encode('utf-8')).hexdigest()
+
+
+def chain_hash(previous, edit):
+    """Key of a state from the key of the previous state and the edit applied to it."""
+    return hashlib.sha256((previous + canonical_json(edit)).encode('utf-8')).hexdigest()
+
+
+class ScenarioLog:
+    """
+    Edits of a scenario with an undo/redo head.
+    """
+
+    def __init__(self, seed, edits=(), head=None):
+        """
+        :param seed: Key of the empty scenario (seed_hash)
+        :param edits: List of edits, each a list of stroke dicts
+        :param head: Number of active edits (all if None)
+        """
+        self.seed = seed
+        self.edits = [list(edit) for edit in edits]
+        self.head = len(self.edits) if head is None else head
+        self._hashes = [seed]
+
+    def hashes(self):
+        """Keys of all states of the log, [seed, after edit 1, ..., after the last edit]."""
+        for edit in self.edits[len(self._hashes) - 1:]:
+            self._hashes.append(chain_hash(self._hashes[-1], edit))
+        return self._hashes
+
+    @property
+    def key(self):
+        """Key of the current state."""
+        return self.hashes()[self.head]
+
+    @property
+    def active(self):
+        """Edits up to the head."""
+        return self.edits[:self.head]
+
+    def can_undo(self):
+        return self.head > 0
+
+    def can_redo(self):
+        return self.head < len(self.edits)
+
+    def append(self, edit):
+        """Adds an edit after the head; undone edits are dropped."""
+        self.edits = self.edits[:self.head] + [list(edit)]
+        self._hashes = self._hashes[:self.head + 1]
+        self.head += 1
+
+    def undo(self):
+        if self.can_undo():
+            self.head -= 1
+
+    def redo(self):
+        if self.can_redo():
+            self.head += 1
+
+    def common_prefix(self, other):
+        """Number of leading active edits two logs of the same seed share."""
+        ours, theirs = self.hashes()[:self.head + 1], other.hashes()[:other.head + 1]
+        n = 0
+        while n < min(len(ours), len(theirs)) and ours[n] == theirs[n]:
+            n += 1
+        return max(n - 1, 0)
+
+    def copy(self):
+        return ScenarioLog(self.seed, self.edits, self.head)
+
+    def to_dict(self):
+        return {'seed': self.seed, 'head': self.head, 'edits': self.edits}
+
+    def save(self, path):
+        """Writes the log atomically."""
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp_path = path + f'.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.to_dict(), f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, seed):
+        """
+        Loads a log, an empty one if the file does not exist or was written for another seed
+        (other grid or models), since its cached states would not match.
+        """
+        if not os.path.exists(path):
+            return cls(seed)
+        with open(path) as f:
+            data = json.load(f)
+        if data['seed'] != seed:
+            return cls(seed)
+        return cls(seed, data['edits'], data['head'])
+
+
+def prune_cache(cache_dir, max_files, tmp_max_age=3600):
+    """
+    Deletes the least recently written files of a cache directory beyond max_files.
+
+    Temporary files (a '.tmp' in the name) are being written by other processes and are left alone, unless
+    they are older than tmp_max_age seconds (left behind by a process that died).
+    """
+    if not os.path.isdir(cache_dir):
+        return
+    now = time.time()
+    entries, stale = [], []
+    for entry in os.scandir(cache_dir):
+        try:
+            if not entry.is_file():
+                continue
+            mtime = entry.stat().st_mtime
+        except OSError:  # removed by another process in the meantime
+            continue
+        if '.tmp' not in entry.name:
+            entries.append((mtime, entry.path))
+        elif now - mtime > tmp_max_age:
+            stale.append(entry.path)
+    entries.sort()
+    for path in stale + [path for _, path in entries[:max(len(entries) - max_files, 0)]]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+_thread_locks = {}
+_thread_locks_guard = threading.Lock()
+
+
+@contextmanager
+def file_lock(path):
+    """
+    Exclusive lock on a lock file, shared by all threads and processes that use the same path.
+
+    Every call opens its own descriptor, so flock also serializes the threads of one process. Without
+    fcntl only the threads of this process are serialized.
+    """
+    if fcntl is None:
+        with _thread_locks_guard:
+            lock = _thread_locks.setdefault(path, threading.Lock())
+        with lock:
+            yield
+        return
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
@@ -0,0 +1,283 @@
+"""Selection of the grid cells under painted rectangles and (buffered) GeoJSON geometries."""
+import numpy as np
+
+# meters per degree of latitude; degrees of longitude are scaled by cos(latitude)
+METERS_PER_DEGREE = 111_320.0
+
+# upper bound of the (edge, cell) pairs evaluated at once
+BLOCK_SIZE = 1 << 20
+
+
+class CellIndex:
+    """
+    Bucket index over the centres of the grid cells.
+    """
+
+    def __init__(self, lat, lon, half_cell_m=0.0, cells_per_bucket=16):
+        """
+        :param lat: Latitudes of the cell centres
+        :param lon: Longitudes of the cell centres
+        :param half_cell_m: Half the width of a cell in meters (minimum buffer of lines and points)
+        :param cells_per_bucket: Average number of cells per bucket
+        """
+        lat = np.asarray(lat, dtype=float)
+        lon = np.asarray(lon, dtype=float)
+        self.lat0 = float(np.nanmean(lat)) if len(lat) else 0.0
+        self.lon0 = float(np.nanmean(lon)) if len(lon) else 0.0
+        self.half_cell_m = float(half_cell_m)
+        self.lat, self.lon = lat, lon
+        self.x, self.y = self.project(lat, lon)
+
+        if len(lat):
+            self.min_x, self.min_y = float(self.x.min()), float(self.y.min())
+            area = max((self.x.max() - self.min_x) * (self.y.max() - self.min_y), 1.0)
+        else:
+            self.min_x = self.min_y = 0.0
+            area = 1.0
+        self.bucket_m = max(np.sqrt(area * cells_per_bucket / max(len(lat), 1)), 2 * self.half_cell_m, 1.0)
+        ix, iy = self._buckets(self.x, self.y)
+        self.nx = int(ix.max()) + 1 if len(lat) else 1
+        self.ny = int(iy.max()) + 1 if len(lat) else 1
+        keys = iy * self.nx + ix
+        # cells sorted by bucket, so every row of buckets is one contiguous key range
+        self.order = np.argsort(keys, kind='stable')
+        self.sorted_keys = keys[self.order]
+
+    @classmethod
+    def from_grid(cls, df):
+        """Index of a grid DataFrame with lat/lon centres and, if present, sw/ne cell corners."""
+        half_cell_m = 0.0
+        if all(col in df.columns for col in ["sw_lon", "sw_lat", "ne_lon", "ne_lat"]) and len(df):
+            lat0 = np.radians(df['lat'].mean())
+            width = (df['ne_lon'] - df['sw_lon']).abs() * METERS_PER_DEGREE * np.cos(lat0)
+            height = (df['ne_lat'] - df['sw_lat']).abs() * METERS_PER_DEGREE
+            half_cell_m = float(np.nanmedian(np.minimum(width, height))) / 2
+        return cls(df['lat'].to_numpy(dtype=float), df['lon'].to_numpy(dtype=float), half_cell_m)
+
+    def project(self, lat, lon):
+        """Local east/north meters around the centre of the grid."""
+        lat = np.asarray(lat, dtype=float)
+        lon = np.asarray(lon, dtype=float)
+        x = (lon - self.lon0) * METERS_PER_DEGREE * np.cos(np.radians(self.lat0))
+        y = (lat - self.lat0) * METERS_PER_DEGREE
+        return x, y
+
+    def _buckets(self, x, y):
+        ix = np.floor((x - self.min_x) / self.bucket_m).astype(np.int64)
+        iy = np.floor((y - self.min_y) / self.bucket_m).astype(np.int64)
+        return ix, iy
+
+    def candidates(self, min_x, min_y, max_x, max_y):
+        """Positions of the cells in the buckets overlapping a box in projected meters (unsorted)."""
+        (ix0, ix1), (iy0, iy1) = self._buckets(np.array([min_x, max_x]), np.array([min_y, max_y]))
+        ix0, ix1 = max(ix0, 0), min(ix1, self.nx - 1)
+        iy0, iy1 = max(iy0, 0), min(iy1, self.ny - 1)
+        if ix0 > ix1 or iy0 > iy1:
+            return np.empty(0, dtype=np.intp)
+        rows = np.arange(iy0, iy1 + 1) * self.nx
+        starts = np.searchsorted(self.sorted_keys, rows + ix0, side='left')
+        ends = np.searchsorted(self.sorted_keys, rows + ix1, side='right')
+        if not (ends > starts).any():
+            return np.empty(0, dtype=np.intp)
+        return self.order[np.concatenate([np.arange(s, e) for s, e in zip(starts, ends)])]
+
+    def select_box(self, south_west, north_east):
+        """
+        Cells whose centre lies in a lat/lon rectangle (the rectangle strokes of the map).
+
+        :param south_west: [lat, lon] of the south-west corner
+        :param north_east: [lat, lon] of the north-east corner
+        :return: Sorted cell positions
+        """
+        (min_x, max_x), (min_y, max_y) = self.project([south_west[0], north_east[0]],
+                                                      [south_west[1], north_east[1]])
+        rows = self.candidates(min_x, min_y, max_x, max_y)
+        # the exact test on degrees keeps the cells on the edges the same as before the index
+        lat, lon = self.lat[rows], self.lon[rows]
+        inside = ((lat >= south_west[0]) & (lat <= north_east[0]) &
+                  (lon >= south_west[1]) & (lon <= north_east[1]))
+        return np.sort(rows[inside])
+
+    def select_geometry(self, geometry, buffer_m=0.0):
+        """
+        Cells whose centre lies in a GeoJSON geometry grown by buffer_m meters.
+
+        :param geometry: GeoJSON geometry or Feature, coordinates as [lon, lat]
+        :param buffer_m: Buffer around the shape in meters
+        :return: Sorted cell positions
+        :raises ValueError: For unsupported geometry types, bad coordinates or a negative buffer
+        """
+        buffer_m = float(buffer_m)
+        if buffer_m < 0:
+            raise ValueError("The buffer of a geometry can not be negative")
+        polygons, lines, points = parse_geometry(geometry)
+        # lines and points have no area, so they are grown by at least half a cell
+        reach = max(buffer_m, self.half_cell_m)
+
+        polygons = [[np.column_stack(self.project(ring[:, 1], ring[:, 0])) for ring in polygon]
+                    for polygon in polygons]
+        lines = [np.column_stack(self.project(line[:, 1], line[:, 0])) for line in lines]
+        points = [np.column_stack(self.project(point[:, 1], point[:, 0])) for point in points]
+
+        coords = [ring for polygon in polygons for ring in polygon] + lines + points
+        if not coords:
+            return np.empty(0, dtype=np.intp)
+        coords = np.concatenate(coords)
+        grow = reach if lines or points else buffer_m
+        (min_x, min_y), (max_x, max_y) = coords.min(axis=0) - grow, coords.max(axis=0) + grow
+        rows = self.candidates(min_x, min_y, max_x, max_y)
+        px, py = self.x[rows], self.y[rows]
+
+        selected = np.zeros(len(rows), dtype=bool)
+        for polygon in polygons:
+            selected |= points_in_polygon(px, py, polygon)
+            if buffer_m > 0:
+                selected |= within_distance(px, py, ring_segments(polygon), buffer_m)
+        if lines:
+            segments = np.concatenate([np.column_stack([line[:-1], line[1:]]) for line in lines])
+            selected |= within_distance(px, py, segments, reach)
+        if points:
+            point_segments = np.concatenate([np.column_stack([point, point]) for point in points])
+            selected |= within_distance(px, py, point_segments, reach)
+        return np.sort(rows[selected])
+
+
+def _coordinates(coords, min_points, name):
+    """GeoJSON positions as a float array [n, 2] of (lon, lat)."""
+    try:
+        coords = np.asarray(coords, dtype=float)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid coordinates of {name}")
+    if coords.ndim != 2 or coords.shape[1] < 2 or len(coords) < min_points or not np.isfinite(coords).all():
+        raise ValueError(f"{name} needs at least {min_points} [lon, lat] positions")
+    return coords[:, :2]
+
+
+def parse_geometry(geometry):
+    """
+    Splits a GeoJSON geometry into polygons, lines and points.
+
+    :param geometry: GeoJSON geometry, Feature or GeometryCollection
+    :return: (list of polygons as lists of rings, list of lines, list of point arrays),
+             each ring, line or point array being [n, 2] (lon, lat)
+    :raises ValueError: For unsupported types or invalid coordinates
+    """
+    if not isinstance(geometry, dict):
+        raise ValueError("Geometry must be a GeoJSON object")
+    kind = geometry.get('type')
+    if kind == 'Feature':
+        return parse_geometry(geometry.get('geometry'))
+    polygons, lines, points = [], [], []
+    if kind == 'GeometryCollection':
+        for part in geometry.get('geometries', []):
+            part_polygons, part_lines, part_points = parse_geometry(part)
+            polygons += part_polygons
+            lines += part_lines
+            points += part_points
+        return polygons, lines, points
+
+    coords = geometry.get('coordinates')
+    if coords is None:
+        raise ValueError(f"Geometry {kind} has no coordinates")
+    if kind == 'Polygon':
+        polygons.append([_coordinates(ring, 3, kind) for ring in coords])
+    elif kind == 'MultiPolygon':
+        polygons += [[_coordinates(ring, 3, kind) for ring in polygon] for polygon in coords]
+    elif kind == 'LineString':
+        lines.append(_coordinates(coords, 2, kind))
+    elif kind == 'MultiLineString':
+        lines += [_coordinates(line, 2, kind) for line in coords]
+    elif kind == 'Point':
+        points.append(_coordinates([coords], 1, kind))
+    elif kind == 'MultiPoint':
+        points.append(_coordinates(coords, 1, kind))
+    else:
+        raise ValueError(f"Unsupported geometry type {kind}")
+    return polygons, lines, points
+
+
+def ring_segments(rings):
+    """Edges of closed rings as an array [n, 4] of (x1, y1, x2, y2)."""
+    return np.concatenate([np.column_stack([ring, np.roll(ring, -1, axis=0)]) for ring in rings])
+
+
+def _band_pairs(sorted_y, low, high):
+    """
+    (segment, point) pairs where the point lies in the y-band of the segment.
+
+    :param sorted_y: Point y coordinates in ascending order
+    :param low: Lower end of the band of every segment (included)
+    :param high: Upper end of the band of every segment (excluded)
+    :return: Generator of (segment ids, positions in sorted_y), in blocks of at most BLOCK_SIZE pairs
+    """
+    starts = np.searchsorted(sorted_y, low, side='left')
+    counts = np.maximum(np.searchsorted(sorted_y, high, side='left') - starts, 0)
+    ends = np.cumsum(counts)
+    first = 0
+    while first < len(counts):
+        # as many segments as fit in one block, at least one
+        last = max(int(np.searchsorted(ends, ends[first] - counts[first] + BLOCK_SIZE, side='right')), first + 1)
+        segment = np.repeat(np.arange(first, last), counts[first:last])
+        offsets = np.arange(len(segment)) - np.repeat(ends[first:last] - counts[first:last] - ends[first] + counts[first],
+                                                      counts[first:last])
+        yield segment, starts[segment] + offsets
+        first = last
+
+
+def points_in_polygon(x, y, rings):
+    """
+    Even-odd point-in-polygon test of many points against a polygon with holes.
+
+    A point is inside when a ray towards +x crosses the edges of all rings an odd number of
+    times, so holes need no special handling. Only the (edge, point) pairs where the point
+    lies in the y-range of the edge are evaluated, found by binary search on the points
+    sorted by y.
+
+    :param x: Point x coordinates
+    :param y: Point y coordinates
+    :param rings: Outer ring and holes, arrays [n, 2]
+    :return: Boolean array over the points
+    """
+    x1, y1, x2, y2 = ring_segments(rings).T
+    order = np.argsort(y, kind='stable')
+    sorted_x, sorted_y = x[order], y[order]
+    crossings = np.zeros(len(x), dtype=np.int64)
+    # an edge spans py when min(y1, y2) <= py < max(y1, y2); horizontal edges span nothing
+    for edge, point in _band_pairs(sorted_y, np.minimum(y1, y2), np.maximum(y1, y2)):
+        py = sorted_y[point]
+        x_cross = x1[edge] + (py - y1[edge]) * (x2[edge] - x1[edge]) / (y2[edge] - y1[edge])
+        crossings += np.bincount(point[sorted_x[point] < x_cross], minlength=len(x))
+    inside = np.zeros(len(x), dtype=bool)
+    inside[order] = crossings % 2 == 1
+    return inside
+
+
+def within_distance(x, y, segments, reach):
+    """
+    Points closer than reach to any of a set of segments.
+
+    Only the pairs where the point lies in the y-range of the segment grown by reach are
+    evaluated.
+
+    :param segments: Array [n, 4] of (x1, y1, x2, y2); a segment with equal ends is a point
+    :param reach: Distance in the units of the coordinates
+    :return: Boolean array over the points
+    """
+    x1, y1, x2, y2 = np.asarray(segments, dtype=float).T
+    dx, dy = x2 - x1, y2 - y1
+    length2 = dx * dx + dy * dy
+    order = np.argsort(y, kind='stable')
+    sorted_x, sorted_y = x[order], y[order]
+    near = np.zeros(len(x), dtype=bool)
+    # the band includes its upper end, so the end is moved up to the next float
+    high = np.nextafter(np.maximum(y1, y2) + reach, np.inf)
+    for segment, point in _band_pairs(sorted_y, np.minimum(y1, y2) - reach, high):
+        px, py = sorted_x[point], sorted_y[point]
+        sx, sy, sdx, sdy, sl2 = x1[segment], y1[segment], dx[segment], dy[segment], length2[segment]
+        # position of the closest point along each segment, clipped to its ends
+        t = np.where(sl2 > 0, np.clip(((px - sx) * sdx + (py - sy) * sdy) / np.where(sl2 > 0, sl2, 1.0), 0.0, 1.0), 0.0)
+        hit = np.hypot(px - (sx + t * sdx), py - (sy + t * sdy)) <= reach
+        near[point[hit]] = True
+    out = np.zeros(len(x), dtype=bool)
+    out[order] = near
+    return out
@@ -0,0 +1,159 @@
+"""
+Fast gradient boosting surrogates distilled from the pollutant forests, answering /predict before the forests refine it.
+
+Usage: python -m air_quality.surrogate --models models/<version> --data air_quality/all_data.csv
+"""
+import argparse
+import json
+import os
+import time
+
+import joblib
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import HistGradientBoostingRegressor
+from sklearn.metrics import mean_absolute_error, mean_squared_error, r2_score
+
+from air_quality import model_store
+from air_quality.brushes import BRUSH_COLORS, apply_brush
+from air_quality.train_models import FEATURES, POLLUTANTS
+
+REPORT_NAME = 'surrogate_report.json'
+
+
+def surrogate_file_name(pollutant):
+    return "surrogate_" + pollutant + ".joblib"
+
+
+def brushed_variants(grid, rng, n_pairs=1):
+    """
+    Feature rows of the grid as is, with every single brush applied and with random pairs of brushes.
+
+    :return: DataFrame of FEATURES with a "variant" column naming the applied brushes
+    """
+    variants = []
+    base = grid[FEATURES].reset_index(drop=True)
+    variants.append(base.assign(variant='none'))
+    for color in BRUSH_COLORS:
+        brushed = base.copy()
+        apply_brush(brushed, brushed.index, color)
+        variants.append(brushed.assign(variant=color))
+    for _ in range(n_pairs):
+        first, second = rng.choice(BRUSH_COLORS, size=(2, len(base)))
+        brushed = base.copy()
+        for color in BRUSH_COLORS:
+            apply_brush(brushed, first == color, color)
+        for color in BRUSH_COLORS:
+            apply_brush(brushed, second == color, color)
+        variants.append(brushed.assign(variant='pair'))
+    return pd.concat(variants, ignore_index=True)
+
+
+def fidelity(y_forest, y_surrogate):
+    """Agreement of the surrogate with the forest predictions."""
+    spread = np.std(y_forest)
+    rmse = float(np.sqrt(mean_squared_error(y_forest, y_surrogate)))
+    return {
+        'rmse': rmse,
+        'relative_rmse': rmse / spread if spread > 0 else 0.0,
+        'mae': float(mean_absolute_error(y_forest, y_surrogate)),
+        'max_abs_error': float(np.max(np.abs(y_forest - y_surrogate))),
+        'r2': float(r2_score(y_forest, y_surrogate)),
+    }
+
+
+def distill(dict_models, grid, holdout_fraction=0.2, max_iter=200, max_leaf_nodes=31, n_pairs=1,
+            random_state=42):
+    """
+    Distills one surrogate per pollutant from the forests.
+
+    Grid cells are split into distillation and hold-out cells before the brushed variants are
+    built, so the fidelity report only uses cells the surrogates never saw.
+
+    :param dict_models: Dict pollutant -> forest
+    :param grid: DataFrame with the FEATURES of the real grid
+    :return: (dict pollutant -> surrogate, fidelity report dict)
+    """
+    rng = np.random.default_rng(random_state)
+    grid = grid[FEATURES].drop_duplicates().reset_index(drop=True)
+    is_holdout = rng.random(len(grid)) < holdout_fraction
+    train_rows = brushed_variants(grid[~is_holdout], rng, n_pairs)
+    test_rows = brushed_variants(grid[is_holdout], rng, n_pairs)
+
+    surrogates = {}
+    report = {'holdout_cells': int(is_holdout.sum()), 'distillation_rows': int(len(train_rows)), 'pollutants': {}}
+    for pollutant, forest in dict_models.items():
+        start = time.perf_counter()
+        y_train = forest.predict(train_rows[FEATURES])
+        surrogate = HistGradientBoostingRegressor(max_iter=max_iter, max_leaf_nodes=max_leaf_nodes,
+                                                  random_state=random_state)
+        surrogate.fit(train_rows[FEATURES], y_train)
+        distill_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        y_forest = forest.predict(test_rows[FEATURES])
+        forest_ms = (time.perf_counter() - start) * 1000
+        start = time.perf_counter()
+        y_surrogate = surrogate.predict(test_rows[FEATURES])
+        surrogate_ms = (time.perf_counter() - start) * 1000
+
+        per_variant = {}
+        for variant in test_rows['variant'].unique():
+            rows = (test_rows['variant'] == variant).to_numpy()
+            per_variant[variant] = fidelity(y_forest[rows], y_surrogate[rows])
+        report['pollutants'][pollutant] = {
+            'real_grid': per_variant['none'],
+            'all_variants': fidelity(y_forest, y_surrogate),
+            'per_brush': {k: v for k, v in per_variant.items() if k != 'none'},
+            'latency': {'rows': int(len(test_rows)), 'forest_ms': forest_ms, 'surrogate_ms': surrogate_ms},
+            'distill_seconds': distill_seconds,
+        }
+        print(f"{pollutant}: real grid R2={per_variant['none']['r2']:.4f}, "
+              f"surrogate {surrogate_ms:.1f}ms vs forest {forest_ms:.1f}ms for {len(test_rows)} rows")
+        surrogates[pollutant] = surrogate
+    return surrogates, report
+
+
+def save_surrogates(model_dir, surrogates, report):
+    """Saves the surrogates and their report, with the fingerprint of the forests they were distilled from."""
+    for pollutant, surrogate in surrogates.items():
+        joblib.dump(surrogate, os.path.join(model_dir, surrogate_file_name(pollutant)))
+    report = dict(report, models=model_store.model_fingerprint(model_dir, list(surrogates)))
+    with open(os.path.join(model_dir, REPORT_NAME), 'w') as f:
+        json.dump(report, f, indent=2)
+
+
+def load_surrogates(model_dir, pollutants):
+    """
+    Loads the surrogates of a model directory; returns an empty dict if any is missing or if they were
+    distilled from other forests than the ones in the directory (retrained since).
+    """
+    paths = {p: os.path.join(model_dir, surrogate_file_name(p)) for p in pollutants}
+    if not all(os.path.exists(path) for path in paths.values()):
+        return {}
+    report_path = os.path.join(model_dir, REPORT_NAME)
+    models = None
+    if os.path.exists(report_path):
+        with open(report_path) as f:
+            models = json.load(f).get('models')
+    if models != model_store.model_fingerprint(model_dir, pollutants):
+        print(f"Ignoring the surrogates in '{model_dir}': they were distilled from other models, distill them again")
+        return {}
+    return {pollutant: joblib.load(path) for pollutant, path in paths.items()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Distill fast surrogate models from the pollutant forests.")
+    parser.add_argument("--models", default="models", help="Directory with the forests; surrogates are saved here.")
+    parser.add_argument("--data", default=os.path.join('air_quality', 'all_data.csv'), help="Grid feature table.")
+    parser.add_argument("--max-iter", type=int, default=200, help="Boosting iterations per surrogate.")
+    parser.add_argument("--max-leaf-nodes", type=int, default=31, help="Leaves per boosting tree.")
+    parser.add_argument("--pairs", type=int, default=1, help="Rounds of random brush pairs added to the data.")
+    args = parser.parse_args()
+
+    dict_models = model_store.load_models(args.models, FEATURES, POLLUTANTS)
+    grid = pd.read_csv(args.data, usecols=FEATURES, low_memory=False).dropna()
+    surrogates, report = distill(dict_models, grid, max_iter=args.max_iter, max_leaf_nodes=args.max_leaf_nodes,
+                                 n_pairs=args.pairs)
+    save_surrogates(args.models, surrogates, report)
+    print(f"Surrogates and {REPORT_NAME} saved to '{args.models}'")
@@ -0,0 +1,60 @@
+"""What-if sweeps: one brush applied to every cell of the grid or of a region, each cell evaluated on its own."""
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+
+from air_quality.brushes import apply_brush
+
+
+def _predict_chunk(models, chunk, color, features, pollutants):
+    """Current and painted predictions of one chunk, array [2, len(chunk), len(pollutants)]."""
+    painted = chunk.copy()
+    apply_brush(painted, painted.index, color)
+    batch = pd.concat([chunk[features], painted[features]], ignore_index=True)
+    out = np.empty((2, len(chunk), len(pollutants)))
+    for j, pollutant in enumerate(pollutants):
+        out[:, :, j] = models[pollutant].predict(batch).reshape(2, len(chunk))
+    return out
+
+
+def sweep_brush(models, grid, color, features, pollutants, chunk_rows=4096, n_jobs=-1):
+    """
+    Predicts every cell with and without the brush.
+
+    Both predictions come from the same models, so the difference is the effect of the
+    brush alone and not the model error against the measured values.
+
+    :param models: Dict pollutant -> model
+    :param grid: DataFrame with the feature columns of the cells to sweep
+    :param color: Brush colour
+    :param chunk_rows: Cells per batch
+    :param n_jobs: Chunks predicted in parallel (-1 = all cores)
+    :return: (current, painted) arrays [n_cells, n_pollutants]
+    """
+    grid = grid[features].reset_index(drop=True)
+    chunks = [grid.iloc[start:start + chunk_rows] for start in range(0, len(grid), chunk_rows)]
+    results = Parallel(n_jobs=n_jobs, prefer='threads')(
+        delayed(_predict_chunk)(models, chunk, color, features, pollutants) for chunk in chunks
+    )
+    if not results:
+        empty = np.empty((0, len(pollutants)))
+        return empty, empty
+    stacked = np.concatenate(results, axis=1)
+    return stacked[0], stacked[1]
+
+
+def top_k_reductions(current, painted, k):
+    """
+    Positions of the k cells with the largest reduction (current - painted), largest first.
+
+    :param current: Array [n_cells] of current values
+    :param painted: Array [n_cells] of values with the brush applied
+    :return: (positions, reductions)
+    """
+    reduction = current - painted
+    k = min(k, len(reduction))
+    if k <= 0:
+        return np.empty(0, dtype=int), np.empty(0)
+    top = np.argpartition(-reduction, k - 1)[:k]
+    top = top[np.argsort(-reduction[top])]
+    return top, reduction[top]
@@ -0,0 +1,167 @@
+"""
+Trains the pollutant RandomForest models in parallel into a versioned models/<version> directory.
+
+Usage: python -m air_quality.train_models --data air_quality/all_data.csv --cores 16
+"""
+import argparse
+import hashlib
+import os
+import platform
+import time
+from datetime import datetime, timezone
+
+import joblib
+import numpy as np
+import pandas as pd
+import sklearn
+from joblib import Parallel, delayed, parallel_config
+from sklearn.ensemble import RandomForestRegressor
+from sklearn.metrics import mean_absolute_error, mean_squared_error, r2_score
+from sklearn.model_selection import train_test_split
+
+from air_quality import grid_dataset
+from air_quality import model_store
+
+FEATURES = grid_dataset.FEATURE_COLUMNS
+POLLUTANTS = grid_dataset.POLLUTANT_COLUMNS
+
+
+def load_feature_table(data_path, years=None):
+    """
+    Loads the feature and pollutant columns from a CSV table or from the grid dataset.
+
+    :param data_path: CSV file (like all_data.csv) or grid dataset directory
+    :param years: Years to load when data_path is a dataset directory (all years if None)
+    """
+    columns = FEATURES + POLLUTANTS
+    if os.path.isdir(data_path):
+        years = years or grid_dataset.available_years(data_path)
+        return grid_dataset.load_years(years, columns=columns, dataset_dir=data_path)[columns]
+    return pd.read_csv(data_path, usecols=columns, low_memory=False)
+
+
+def data_hash(df):
+    """SHA-256 of the column names and values used for training."""
+    digest = hashlib.sha256()
+    digest.update(",".join(df.columns).encode())
+    digest.update(np.ascontiguousarray(df.to_numpy(dtype=np.float64)).tobytes())
+    return digest.hexdigest()
+
+
+def split_cores(total_cores, n_models):
+    """Splits a core budget into (parallel models, cores per model) without exceeding it."""
+    outer = max(1, min(n_models, total_cores))
+    return outer, max(1, total_cores // outer)
+
+
+def measure_latency(model, X, repeats=5):
+    """Median per-row latency of single-row predictions and of one batch prediction, in milliseconds."""
+    single = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        model.predict(X.iloc[:1])
+        single.append((time.perf_counter() - start) * 1000)
+    start = time.perf_counter()
+    model.predict(X)
+    batch_ms = (time.perf_counter() - start) * 1000
+    return {
+        'single_row_ms': float(np.median(single)),
+        'batch_rows': int(len(X)),
+        'batch_ms': batch_ms,
+        'batch_per_row_ms': batch_ms / max(1, len(X)),
+    }
+
+
+def train_pollutant(df, pollutant, out_dir, n_estimators, n_jobs, test_size, random_state):
+    """
+    Trains, evaluates and saves the model of one pollutant.
+
+    The split and forest seeds are fixed, so the same data always gives the same model.
+    """
+    X_train, X_test, y_train, y_test = train_test_split(
+        df[FEATURES], df[pollutant], test_size=test_size, random_state=random_state)
+
+    model = RandomForestRegressor(n_estimators=n_estimators, random_state=random_state, n_jobs=n_jobs)
+    start = time.perf_counter()
+    model.fit(X_train, y_train)
+    train_seconds = time.perf_counter() - start
+
+    y_pred = model.predict(X_test)
+    metrics = {
+        'r2': float(r2_score(y_test, y_pred)),
+        'mae': float(mean_absolute_error(y_test, y_pred)),
+        'rmse': float(np.sqrt(mean_squared_error(y_test, y_pred))),
+    }
+    latency = measure_latency(model, X_test)
+
+    model_path = os.path.join(out_dir, model_store.model_file_name(pollutant))
+    joblib.dump(model, model_path, compress=3)
+    print(f"{pollutant}: R2={metrics['r2']:.4f} RMSE={metrics['rmse']:.4g} trained in {train_seconds:.1f}s")
+    return pollutant, {
+        'file': os.path.basename(model_path),
+        'file_sha256': model_store.file_sha256(model_path),
+        'metrics': metrics,
+        'train_seconds': train_seconds,
+        'latency': latency,
+    }
+
+
+def train_all(df, out_dir, pollutants=POLLUTANTS, total_cores=None, n_estimators=1000, test_size=0.2,
+              random_state=42):
+    """
+    Trains all pollutants in parallel within a core budget and writes the manifest.
+
+    :return: The manifest dict
+    """
+    total_cores = total_cores or os.cpu_count()
+    outer, inner = split_cores(total_cores, len(pollutants))
+    os.makedirs(out_dir, exist_ok=True)
+    print(f"Training {len(pollutants)} models: {outer} in parallel with {inner} cores each")
+
+    start = time.perf_counter()
+    # inner_max_num_threads keeps BLAS/OpenMP pools in the workers within the per-model share
+    with parallel_config(backend='loky', inner_max_num_threads=inner):
+        results = Parallel(n_jobs=outer)(
+            delayed(train_pollutant)(df, pollutant, out_dir, n_estimators, inner, test_size, random_state)
+            for pollutant in pollutants
+        )
+    wall_seconds = time.perf_counter() - start
+
+    manifest = {
+        'version': os.path.basename(os.path.normpath(out_dir)),
+        'created': datetime.now(timezone.utc).isoformat(),
+        'features': list(FEATURES),
+        'pollutants': list(pollutants),
+        'params': {'n_estimators': n_estimators, 'test_size': test_size, 'random_state': random_state},
+        'data': {'rows': int(len(df)), 'sha256': data_hash(df[FEATURES + list(pollutants)])},
+        'sklearn_version': sklearn.__version__,
+        'python_version': platform.python_version(),
+        'cores': {'total': total_cores, 'parallel_models': outer, 'per_model': inner},
+        'wall_seconds': wall_seconds,
+        'models': dict(results),
+    }
+    model_store.write_manifest(out_dir, manifest)
+    return manifest
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train the pollutant RandomForest models in parallel.")
+    parser.add_argument("--data", default=os.path.join('air_quality', 'all_data.csv'),
+                        help="Feature table CSV or grid dataset directory.")
+    parser.add_argument("--years", type=int, nargs="*", help="Years to use when --data is a dataset directory.")
+    parser.add_argument("--out", default="models", help="Parent directory of the versioned model directories.")
+    parser.add_argument("--version", default=None, help="Version name (default: UTC timestamp).")
+    parser.add_argument("--cores", type=int, default=os.cpu_count(), help="Total number of cores to use.")
+    parser.add_argument("--n-estimators", type=int, default=1000, help="Trees per forest.")
+    parser.add_argument("--test-size", type=float, default=0.2, help="Hold-out fraction for the metrics.")
+    parser.add_argument("--random-state", type=int, default=42, help="Seed of the split and the forests.")
+    args = parser.parse_args()
+
+    version = args.version or datetime.now(timezone.utc).strftime('%Y%m%d-%H%M%S')
+    out_dir = os.path.join(args.out, version)
+    df = load_feature_table(args.data, args.years).dropna()
+
+    manifest = train_all(df, out_dir, total_cores=args.cores, n_estimators=args.n_estimators,
+                         test_size=args.test_size, random_state=args.random_state)
+    print(f"Models and manifest saved to '{out_dir}' in {manifest['wall_seconds']:.1f}s")
+    print(f"Serve them with: EKOVIZIJA_MODEL_DIR={out_dir} python backend.py")
@@ -0,0 +1,207 @@
+"""
+Per-cell polynomial pollutant trends, fitted for all cells at once, and forecasts from them.
+
+Usage: python -m air_quality.trend_forecast --year 2027
+"""
+import argparse
+import hashlib
+import os
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+from air_quality import grid_dataset
+
+DEFAULT_CACHE_PATH = os.path.join('air_quality', 'trend_coefficients.npz')
+GEOMETRY_COLUMNS = ['lon', 'lat', 'sw_lon', 'sw_lat', 'ne_lon', 'ne_lat']
+
+
+def dataset_fingerprint(dataset_dir=grid_dataset.DEFAULT_DATASET_DIR):
+    """Hash of the partition file names, sizes and modification times (changes when the data changes)."""
+    digest = hashlib.sha256()
+    for root, _, files in sorted(os.walk(dataset_dir)):
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            stat = os.stat(path)
+            digest.update(f"{os.path.relpath(path, dataset_dir)}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    return digest.hexdigest()
+
+
+def load_history(pollutants, dataset_dir=grid_dataset.DEFAULT_DATASET_DIR):
+    """
+    Loads the pollutant values of all years into a dense array.
+
+    Cells are the grid cells of the latest year; cells missing in an older year are NaN there.
+
+    :return: (years, cells DataFrame with grid id and geometry, values [n_years, n_cells, n_pollutants])
+    """
+    years = grid_dataset.available_years(dataset_dir)
+    if not years:
+        raise ValueError(f"No years found in dataset '{dataset_dir}'")
+
+    cells = grid_dataset.load_year(years[-1], columns=['grid_id_x'] + GEOMETRY_COLUMNS, dataset_dir=dataset_dir)
+    cells = cells.drop_duplicates('grid_id_x').drop(columns='year').reset_index(drop=True)
+    cell_index = pd.Index(cells['grid_id_x'])
+
+    values = np.full((len(years), len(cells), len(pollutants)), np.nan)
+    # one year at a time, so only a single year of the raw table is in memory
+    for i, year in enumerate(years):
+        df = grid_dataset.load_year(year, columns=['grid_id_x'] + pollutants, dataset_dir=dataset_dir)
+        df = df.drop_duplicates('grid_id_x')
+        positions = cell_index.get_indexer(df['grid_id_x'])
+        found = positions >= 0
+        values[i, positions[found]] = df.loc[found, pollutants].to_numpy(dtype=float)
+    return np.array(years), cells, values
+
+
+def fit_trends(years, values, degree=1, t_ref=None):
+    """
+    Fits a polynomial trend for every cell and pollutant in one batched solve.
+
+    :param years: Array of years [n_years]
+    :param values: Array [n_years, n_cells, n_pollutants], NaN where no value exists
+    :param degree: Polynomial degree of the trend (1 = linear)
+    :param t_ref: Year the time axis is centred on (mean year if None)
+    :return: Dict with coef [cells, pollutants, degree+1], cov (unscaled (X'WX)^-1),
+             sigma2 (residual variance), dof (residual degrees of freedom) and t_ref
+    """
+    years = np.asarray(years, dtype=float)
+    t_ref = years.mean() if t_ref is None else t_ref
+    X = np.vander(years - t_ref, degree + 1, increasing=True)  # [n_years, p]
+    n_params = X.shape[1]
+
+    W = ~np.isnan(values)  # [n_years, cells, pollutants]
+    Y = np.where(W, values, 0.0)
+    W = W.astype(float)
+
+    # normal equations for every (cell, pollutant): X'WX beta = X'Wy
+    XtWX = np.einsum('tp,tcn,tq->cnpq', X, W, X, optimize=True)
+    XtWy = np.einsum('tp,tcn->cnp', X, W * Y)
+    n_obs = W.sum(axis=0)
+    solvable = n_obs >= n_params
+    # unsolvable systems are replaced by the identity and masked afterwards
+    XtWX[~solvable] = np.eye(n_params)
+
+    coef = np.linalg.solve(XtWX, XtWy[..., None])[..., 0]
+    cov = np.linalg.inv(XtWX)
+
+    residuals = (Y - np.einsum('tp,cnp->tcn', X, coef)) * W
+    dof = n_obs - n_params
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sigma2 = np.where(dof > 0, (residuals ** 2).sum(axis=0) / dof, np.nan)
+
+    coef[~solvable] = np.nan
+    return {'coef': coef, 'cov': cov, 'sigma2': sigma2, 'dof': dof, 't_ref': t_ref}
+
+
+class PollutantTrends:
+    """
+    Cached per-cell trend coefficients that can be evaluated for any target year.
+    """
+
+    def __init__(self, cells, pollutants, years, coef, cov, sigma2, dof, t_ref, fingerprint=""):
+        """
+        :param cells: DataFrame with grid_id_x and the cell geometry, one row per cell
+        :param pollutants: Names of the fitted pollutants
+        :param years: Years used for the fit
+        :param coef, cov, sigma2, dof, t_ref: Output of fit_trends
+        :param fingerprint: Fingerprint of the dataset the trends were fitted on
+        """
+        self.cells = cells
+        self.pollutants = list(pollutants)
+        self.years = np.asarray(years)
+        self.coef = coef
+        self.cov = cov
+        self.sigma2 = sigma2
+        self.dof = dof
+        self.t_ref = float(t_ref)
+        self.fingerprint = fingerprint
+
+    @classmethod
+    def fit(cls, pollutants, degree=1, dataset_dir=grid_dataset.DEFAULT_DATASET_DIR):
+        years, cells, values = load_history(pollutants, dataset_dir)
+        fitted = fit_trends(years, values, degree=degree)
+        return cls(cells, pollutants, years, fingerprint=dataset_fingerprint(dataset_dir), **fitted)
+
+    @property
+    def has_bounds(self):
+        """Whether there are more years than trend parameters (with as many, the trend fits them exactly)."""
+        return len(self.years) > self.coef.shape[-1]
+
+    def save(self, path=DEFAULT_CACHE_PATH):
+        np.savez(
+            path,
+            grid_id_x=self.cells['grid_id_x'].to_numpy(dtype=str),
+            geometry=self.cells[GEOMETRY_COLUMNS].to_numpy(dtype=float),
+            pollutants=np.array(self.pollutants),
+            years=self.years,
+            coef=self.coef, cov=self.cov, sigma2=self.sigma2, dof=self.dof,
+            t_ref=self.t_ref,
+            fingerprint=self.fingerprint,
+        )
+
+    @classmethod
+    def load(cls, path=DEFAULT_CACHE_PATH):
+        with np.load(path) as cached:
+            cells = pd.DataFrame(cached['geometry'], columns=GEOMETRY_COLUMNS)
+            cells.insert(0, 'grid_id_x', cached['grid_id_x'])
+            return cls(cells, cached['pollutants'].tolist(), cached['years'], cached['coef'], cached['cov'],
+                       cached['sigma2'], cached['dof'], float(cached['t_ref']), str(cached['fingerprint']))
+
+    @classmethod
+    def load_or_fit(cls, pollutants, cache_path=DEFAULT_CACHE_PATH, dataset_dir=grid_dataset.DEFAULT_DATASET_DIR,
+                    degree=1):
+        """Loads the cached trends, refitting them when the dataset or the pollutant list changed."""
+        fingerprint = dataset_fingerprint(dataset_dir)
+        if os.path.exists(cache_path):
+            trends = cls.load(cache_path)
+            if (trends.fingerprint == fingerprint and trends.pollutants == list(pollutants)
+                    and trends.coef.shape[-1] == degree + 1):
+                return trends
+        trends = cls.fit(pollutants, degree=degree, dataset_dir=dataset_dir)
+        trends.save(cache_path)
+        return trends
+
+    def forecast(self, year, confidence=0.95):
+        """
+        Evaluates the trends at the target year.
+
+        :param year: Target year
+        :param confidence: Level of the confidence bounds of the fitted trend
+        :return: DataFrame with the cell columns, year, and for every pollutant the forecast
+                 plus <pollutant>_lower / <pollutant>_upper bounds (only if has_bounds)
+        """
+        degree = self.coef.shape[-1] - 1
+        x0 = np.vander([float(year) - self.t_ref], degree + 1, increasing=True)[0]
+        mean = self.coef @ x0  # [cells, pollutants]
+        with np.errstate(invalid='ignore'):
+            se = np.sqrt(self.sigma2 * np.einsum('p,cnpq,q->cn', x0, self.cov, x0))
+            t_crit = stats.t.ppf(0.5 + confidence / 2, np.where(self.dof > 0, self.dof, np.nan))
+        half_width = t_crit * se
+
+        result = self.cells.copy()
+        result['year'] = int(year)
+        for j, pollutant in enumerate(self.pollutants):
+            result[pollutant] = mean[:, j]
+            if not self.has_bounds:
+                continue
+            result[f"{pollutant}_lower"] = mean[:, j] - half_width[:, j]
+            result[f"{pollutant}_upper"] = mean[:, j] + half_width[:, j]
+        return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fit per-cell pollutant trends and forecast a target year.")
+    parser.add_argument("--year", type=int, required=True, help="Target year of the forecast.")
+    parser.add_argument("--degree", type=int, default=1, help="Polynomial degree of the trends (1 = linear).")
+    parser.add_argument("--dataset", default=grid_dataset.DEFAULT_DATASET_DIR, help="Grid dataset directory.")
+    parser.add_argument("--cache", default=DEFAULT_CACHE_PATH, help="Path of the cached coefficients.")
+    parser.add_argument("--out", default=None, help="CSV file for the forecast (default forecast_<year>.csv).")
+    args = parser.parse_args()
+
+    trends = PollutantTrends.load_or_fit(grid_dataset.POLLUTANT_COLUMNS, args.cache, args.dataset, args.degree)
+    forecast = trends.forecast(args.year)
+    out_path = args.out or f"forecast_{args.year}.csv"
+    forecast.to_csv(out_path, index=False)
+    print(f"Forecast for {args.year} from years {trends.years.tolist()} saved to '{out_path}'.")
@@ -1,19 +1,59 @@
 import uuid
-from flask import Flask, render_template, jsonify, request, session
-import csv
+import json
+import re
+from flask import Flask, Response, render_template, jsonify, request, session
 import os
-import time
-import joblib
-import pandas as pd
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from functools import lru_cache
+
+from air_quality import export
+from air_quality import forest_uncertainty
+from air_quality import grid_dataset
+from air_quality import grid_stats
+from air_quality.grid_store import DEFAULT_OVERLAY_DIR, DEFAULT_STORE_DIR, GridStore, Overlay
+from air_quality.scenario_log import ScenarioLog
+from air_quality import model_store
+from air_quality import regular_grid
+from air_quality import scenario_log
+from air_quality import selection
+from air_quality import surrogate
+from air_quality import sweep
+from air_quality.brush_impact import BrushImpactTable, TABLE_NAME as BRUSH_IMPACT_TABLE_NAME
+from air_quality.brushes import BRUSH_COLORS, EditPlan, apply_brush
+from air_quality import trend_forecast
+from air_quality.trend_forecast import PollutantTrends
 
 app = Flask(__name__)
-app.config["SECRET_KEY"] = os.urandom(24)
+# with several worker processes the key must be shared, otherwise a session is only known to the worker that started it
+app.config["SECRET_KEY"] = os.environ.get('EKOVIZIJA_SECRET_KEY') or os.urandom(24)
 
 # LOADING DATA ===================================
 data_file_path = os.path.join('air_quality', 'all_data.csv')
-df_data = pd.read_csv(data_file_path)
-df_data['lon'] = df_data['lon'].astype('float')
-df_data['lat'] = df_data['lat'].astype('float')
+# the baseline grid is published once as memory-mapped columns (air_quality/grid_store.py) that all worker
+# processes share; requests copy only the rows and columns they need
+grid_store = GridStore.open_or_publish(data_file_path, os.environ.get('EKOVIZIJA_GRID_STORE', DEFAULT_STORE_DIR))
+n_cells = len(grid_store)
+GEOMETRY_FIELDS = ["grid_id_x", "lon", "lat", "sw_lon", "sw_lat", "ne_lon", "ne_lat"]
+# spatial index of the cell centres, used to find the cells under the painted shapes
+cell_index = selection.CellIndex.from_grid(grid_store.frame(GEOMETRY_FIELDS[1:]))
+# col/row of every cell on the regular UTM grid (air_quality/regular_grid.py), None if the ids are not "col,row"
+grid_cells = regular_grid.RegularGrid.from_grid(grid_store.frame(["grid_id_x"]))
+
+# what a session painted is an append-only log of edits (air_quality/scenario_log.py); the result of every state
+# of a log is an overlay of the changed cells on top of the baseline grid, cached under the key of the state.
+# File locks serialize the read-modify-write of a session's log and of a cached overlay between the threads and
+# the worker processes; they are taken session first, then overlay
+SCENARIO_DIR = os.environ.get('EKOVIZIJA_SCENARIO_DIR', os.path.join('air_quality', 'scenarios'))
+OVERLAY_DIR = os.environ.get('EKOVIZIJA_OVERLAY_DIR', DEFAULT_OVERLAY_DIR)
+OVERLAY_CACHE_SIZE = int(os.environ.get('EKOVIZIJA_OVERLAY_CACHE_SIZE', 1000))
+LOCK_DIR = os.path.join(SCENARIO_DIR, 'locks')
+# sessions and overlay keys share a fixed number of lock files, so lock files never need to be deleted
+LOCK_BUCKETS = 64
+
+# Year-partitioned dataset with the history of all years (see air_quality/grid_dataset.py)
+GRID_DATASET_DIR = grid_dataset.DEFAULT_DATASET_DIR
 
 # POLLUTANTS =====================================
 air_pollutants = ['no2_ppb', 'co_ppb', 'so2_ppb', 'o3_ppb', 'ch4_ppb']
@@ -27,11 +67,26 @@ features = [
     'class_10_percent', 'class_11_percent'
 ]
 # LOADING MODELS ===================================
-dict_models = {}
-for pollutant in air_pollutants:
-    model_name = "model_" + pollutant + ".joblib"
-    model_path = os.path.join("models", model_name)
-    dict_models[pollutant] = joblib.load(model_path)
+# versioned models from air_quality/train_models.py are checked against their manifest
+MODEL_DIR = os.environ.get('EKOVIZIJA_MODEL_DIR', 'models')
+dict_models = model_store.load_models(MODEL_DIR, features, air_pollutants)
+# fast surrogates distilled from the forests (air_quality/surrogate.py), empty if not built
+dict_surrogates = surrogate.load_surrogates(MODEL_DIR, air_pollutants)
+# precomputed values of every baseline cell painted with every brush (air_quality/brush_impact.py)
+brush_impact = BrushImpactTable.load_if_valid(os.path.join(MODEL_DIR, BRUSH_IMPACT_TABLE_NAME),
+                                              grid_store.frame(features), MODEL_DIR)
+
+# UNCERTAINTY ======================================
+# spread across the trees of the forests (air_quality/forest_uncertainty.py): the standard deviation
+# and the quantiles listed in EKOVIZIJA_UNCERTAINTY_QUANTILES (e.g. "0.05,0.95")
+UNCERTAINTY_QUANTILES = sorted({float(q) for q in os.environ.get('EKOVIZIJA_UNCERTAINTY_QUANTILES', '').split(',') if q})
+stacked_forests = forest_uncertainty.stack_forests(dict_models)
+uncertainty_fields = [field for pollutant in air_pollutants if pollutant in stacked_forests
+                      for field in forest_uncertainty.uncertainty_field_names(pollutant, UNCERTAINTY_QUANTILES)]
+
+# key of the empty scenario: cached scenario states are only valid for the same grid, models and uncertainty fields
+SCENARIO_SEED = scenario_log.seed_hash(grid_store.meta['source'], model_store.model_fingerprint(MODEL_DIR, air_pollutants),
+                                       uncertainty_fields)
 
 # Function to assign an anonymous session
 @app.before_request
@@ -41,6 +96,71 @@ def assign_anonymous_session():
         session['user_id'] = str(uuid.uuid4())
 
 
+def session_log_path(user_id):
+    return os.path.join(SCENARIO_DIR, 'sessions', f"{user_id}.json")
+
+
+def shared_log_path(key):
+    return os.path.join(SCENARIO_DIR, 'shared', f"{key}.json")
+
+
+def load_session_log(user_id):
+    """Scenario log of a session (empty for a new session)."""
+    return ScenarioLog.load(session_log_path(user_id), SCENARIO_SEED)
+
+
+def overlay_path(key):
+    return os.path.join(OVERLAY_DIR, f"{key}.npz")
+
+
+def _lock(kind, name):
+    bucket = int(hashlib.sha256(name.encode('utf-8')).hexdigest(), 16) % LOCK_BUCKETS
+    return scenario_log.file_lock(os.path.join(LOCK_DIR, f"{kind}-{bucket}.lock"))
+
+
+def session_lock(user_id):
+    """Lock of a session's scenario log, across the worker processes."""
+    return _lock('session', user_id)
+
+
+def overlay_lock(key):
+    """Lock of a cached overlay, across the worker processes (take it after the session lock)."""
+    return _lock('overlay', key)
+
+
+def cached_overlay(key):
+    """Overlay of a scenario state, None if it is not in the cache (the empty scenario is the baseline)."""
+    if key == SCENARIO_SEED:
+        return Overlay()
+    path = overlay_path(key)
+    return Overlay.load(path) if os.path.exists(path) else None
+
+
+def cache_overlay(key, overlay):
+    """Caches a newly materialized state, unless another request cached it first (and maybe refined it since)."""
+    if key == SCENARIO_SEED:
+        return
+    with overlay_lock(key):
+        if not os.path.exists(overlay_path(key)):
+            store_overlay(key, overlay)
+
+
+def store_overlay(key, overlay):
+    """Writes a cached overlay; call with its overlay_lock held."""
+    overlay.save(overlay_path(key))
+    scenario_log.prune_cache(OVERLAY_DIR, OVERLAY_CACHE_SIZE)
+
+
+def scenario_frame(overlay, columns=None, rows=None):
+    """
+    Private copy of the baseline grid with the changes of a session applied.
+
+    :param columns: Columns to copy (all, plus the uncertainty fields of the overlay, if None)
+    :param rows: Positions of the rows to copy (all if None)
+    """
+    return overlay.apply(grid_store.frame(columns, rows), add_columns=columns is None)
+
+
 @app.route('/')
 def index():
     user_id = session.get('user_id', 'Unknown')
@@ -73,241 +193,827 @@ def prediction():
 
 @app.route('/grid-data', methods=['GET'])
 def get_grid_data():
-    grid_data = []
-    with open('./air_quality/all_data.csv', 'r') as csvfile:
-        reader = csv.DictReader(csvfile)
-        for row in reader:
-            grid_data.append({
-                "grid_id_x": row["grid_id_x"],
-                "lon": float(row["lon"]),
-                "lat": float(row["lat"]),
-                "sw_lon": float(row["sw_lon"]),
-                "sw_lat": float(row["sw_lat"]),
-                "ne_lon": float(row["ne_lon"]),
-                "ne_lat": float(row["ne_lat"])
-            })
-    return jsonify(grid_data)
+    if wants_compact() and grid_cells is not None:
+        return jsonify({"data": {"col": grid_cells.cols.tolist(), "row": grid_cells.rows.tolist()},
+                        "data_type": "grid_index", "grid": grid_cells.descriptor()})
+    grid_data = grid_store.frame(GEOMETRY_FIELDS)
+    grid_data["grid_id_x"] = grid_data["grid_id_x"].astype(str)
+    return jsonify(records(grid_data))
 
 
-@app.route('/prediction-data', methods=['GET'])
-def prediction_data():
+def records(df):
+    """DataFrame rows as JSON-ready dicts, with missing values as null."""
+    return df.astype(object).where(df.notna(), None).to_dict(orient="records")
+
+
+def column_values(series):
+    """Column as a JSON-ready list, with missing values as null."""
+    return series.astype(object).where(series.notna(), None).tolist()
+
+
+def build_compact_payload(df, grid, extra_fields=()):
+    """
+    Builds the payload with the grid descriptor and the col/row of every cell instead of its coordinates.
+
+    The values are sent as one list per field; the browser derives the cell geometry from the
+    descriptor (static/regular_grid.js).
+
+    :param grid: RegularGrid of the rows of df
+    """
+    data = {"col": grid.cols.tolist(), "row": grid.rows.tolist(),
+            "year": df["year"].astype(float).astype(int).tolist()}
+    for field in air_pollutants + list(extra_fields):
+        data[field] = column_values(df[field])
+    return {"data": data, "data_type": "grid_index", "grid": grid.descriptor()}
+
+
+def build_prediction_payload(df, extra_fields=(), compact=False):
+    """
+    Builds the JSON payload sent to the map from a grid DataFrame.
+
+    :param df: DataFrame with the grid geometry, year and pollutant columns
+    :param extra_fields: Additional columns copied to every record (e.g. forecast bounds)
+    :param compact: Send the grid descriptor and cell indices instead of the coordinates, when the grid allows it
+    """
+    if compact:
+        grid = regular_grid.RegularGrid.from_grid(df)
+        if grid is not None:
+            return build_compact_payload(df, grid, extra_fields)
+
     prediction_data = []
     data_type = ""
-    with open('./air_quality/all_data_changed.csv', 'r') as csvfile:
-        reader = csv.DictReader(csvfile)
-        CSVfilednames = reader.fieldnames
-        # data can have for each square in the grid the north east and south west coordinates
-        # or the central point of the grid square
-        # if it has both, we send both to the frontend and the user will switch between the two
-        missing_fields = [field for field in ["sw_lon", "sw_lat", "ne_lon", "ne_lat", "lat", "lon"] if field not in CSVfilednames]
-        if missing_fields:
-            print(f"Missing fields: {missing_fields}")
-        if("sw_lon" in CSVfilednames and "sw_lat" in CSVfilednames and "ne_lon" in CSVfilednames and "ne_lat" in CSVfilednames and "lat" in CSVfilednames and "lon" in CSVfilednames):
-
-            for row in reader:
-                prediction_data.append({
-                    "grid_id_x": row["grid_id_x"],
-                    "lon": float(row["lon"]),
-                    "lat": float(row["lat"]),
-                    "sw_lon": float(row["sw_lon"]),
-                    "sw_lat": float(row["sw_lat"]),
-                    "ne_lon": float(row["ne_lon"]),
-                    "ne_lat": float(row["ne_lat"]),
-                    "year": int(float(row["year"])),
-                    "no2_ppb": float(row["no2_ppb"]),
-                    "co_ppb": float(row["co_ppb"]),
-                    "so2_ppb": float(row["so2_ppb"]),
-                    "o3_ppb": float(row["o3_ppb"]),
-                    "ch4_ppb": float(row["ch4_ppb"])
-                })
-            data_type = "grid_and_point"
-        # if csv contains sw and ne data, create data for grid
-        elif ("sw_lon" in CSVfilednames and "sw_lat" in CSVfilednames and "ne_lon" in CSVfilednames and "ne_lat" in CSVfilednames):
-            for row in reader:
-                prediction_data.append({
-                    "grid_id_x": row["grid_id_x"],
-                    "sw_lon": float(row["sw_lon"]),
-                    "sw_lat": float(row["sw_lat"]),
-                    "ne_lon": float(row["ne_lon"]),
-                    "ne_lat": float(row["ne_lat"]),
-                    "year": int(float(row["year"])),
-                    "no2_ppb": float(row["no2_ppb"]),
-                    "co_ppb": float(row["co_ppb"]),
-                    "so2_ppb": float(row["so2_ppb"]),
-                    "o3_ppb": float(row["o3_ppb"]),
-                    "ch4_ppb": float(row["ch4_ppb"])
-                })
-            data_type = "grid"
-        # if csv has data based on lat long points
-        elif ("lat" in CSVfilednames and "lon" in CSVfilednames):
-            for row in reader:
-                prediction_data.append({
-                    "lat": float(row["lat"]),
-                    "lon": float(row["lon"]),
-                    "year": int(float(row["year"])),
-                    "no2_ppb": float(row["no2_ppb"]),
-                    "co_ppb": float(row["co_ppb"]),
-                    "so2_ppb": float(row["so2_ppb"]),
-                    "o3_ppb": float(row["o3_ppb"]),
-                    "ch4_ppb": float(row["ch4_ppb"])
-                })
-            data_type = "point"
-        return jsonify({"data": prediction_data, "data_type": data_type})
+    columns = df.columns
+    # data can have for each square in the grid the north east and south west coordinates
+    # or the central point of the grid square
+    # if it has both, we send both to the frontend and the user will switch between the two
+    missing_fields = [field for field in ["sw_lon", "sw_lat", "ne_lon", "ne_lat", "lat", "lon"] if field not in columns]
+    if missing_fields:
+        print(f"Missing fields: {missing_fields}")
+    has_grid = all(field in columns for field in ["sw_lon", "sw_lat", "ne_lon", "ne_lat"])
+    has_point = "lat" in columns and "lon" in columns
+
+    if has_grid and has_point:
+        fields = ["grid_id_x", "lon", "lat", "sw_lon", "sw_lat", "ne_lon", "ne_lat"]
+        data_type = "grid_and_point"
+    # if data contains sw and ne data, create data for grid
+    elif has_grid:
+        fields = ["grid_id_x", "sw_lon", "sw_lat", "ne_lon", "ne_lat"]
+        data_type = "grid"
+    # if data is based on lat long points
+    elif has_point:
+        fields = ["lat", "lon"]
+        data_type = "point"
+    else:
+        return {"data": prediction_data, "data_type": data_type}
+
+    out = df[fields + air_pollutants + list(extra_fields)].copy()
+    if "grid_id_x" in out.columns:
+        out["grid_id_x"] = out["grid_id_x"].astype(str)
+    out.insert(len(fields), "year", df["year"].astype(float).astype(int))
+    prediction_data = records(out)
+    return {"data": prediction_data, "data_type": data_type}
+
+
+def requested_year():
+    """Returns the ?year= query parameter as int, None if absent."""
+    year = request.args.get('year')
+    if year is None or year == "":
+        return None
+    return int(year)
+
+
+def wants_uncertainty():
+    return request.args.get('uncertainty', '').lower() in ('1', 'true', 'yes')
+
+
+def wants_compact():
+    return request.args.get('compact', '').lower() in ('1', 'true', 'yes')
+
+
+@lru_cache(maxsize=1)
+def baseline_uncertainty():
+    """Uncertainty fields of the forest predictions for every cell of the baseline grid (computed once)."""
+    _, uncertainty = forest_uncertainty.predict_with_uncertainty(
+        stacked_forests, grid_store.frame(features), list(stacked_forests), UNCERTAINTY_QUANTILES)
+    return uncertainty
+
+
+def with_uncertainty(df):
+    """
+    Adds the uncertainty fields to a grid aligned with the baseline grid.
+
+    Fields stored for painted cells are kept, the other cells get the baseline values.
+    """
+    if len(df) != n_cells or not uncertainty_fields:
+        return df, []
+    df = df.copy()
+    baseline = baseline_uncertainty()
+    for field in uncertainty_fields:
+        df[field] = df[field].fillna(baseline[field]) if field in df.columns else baseline[field].to_numpy()
+    return df, uncertainty_fields
+
+
+@lru_cache(maxsize=4)
+def load_dataset_year(year):
+    """Loads one year of the partitioned grid dataset (only the columns the map needs)."""
+    columns = ["grid_id_x", "lon", "lat", "sw_lon", "sw_lat", "ne_lon", "ne_lat"] + air_pollutants
+    return grid_dataset.load_year(year, columns=columns, dataset_dir=GRID_DATASET_DIR)
+
+
+def year_not_found(year):
+    return jsonify({'error': f'No data for year {year}',
+                    'available_years': grid_dataset.available_years(GRID_DATASET_DIR)}), 404
+
+
+@app.route('/prediction-data', methods=['GET'])
+def prediction_data():
+    try:
+        year = requested_year()
+    except ValueError:
+        return jsonify({'error': 'Parameter year must be an integer'}), 400
+
+    df = scenario_frame(session_overlay(session['user_id']))
+    # the changed data holds the user's edits for its own year, other years come unchanged from the dataset
+    if year is not None and not (df['year'].astype(float).astype(int) == year).any():
+        if year not in grid_dataset.available_years(GRID_DATASET_DIR):
+            return year_not_found(year)
+        df = load_dataset_year(year)
+    extra_fields = []
+    if wants_uncertainty():
+        df, extra_fields = with_uncertainty(df)
+    return jsonify(build_prediction_payload(df, extra_fields, compact=wants_compact()))
 
 
 @app.route('/unchanged-prediction-data', methods=['GET'])
 def unchanged_prediction_data():
-    prediction_data = []
-    data_type = ""
-    # for now read the 2020 data just to test frontend
-    # TODO: send the prediction data for if there is no change in the grid
-    with open('./air_quality/all_data.csv', 'r') as csvfile:
-        reader = csv.DictReader(csvfile)
-        CSVfilednames = reader.fieldnames
-        # data can have for each square in the grid the north east and south west coordinates
-        # or the central point of the grid square
-        # if it has both, we send both to the frontend and the user will switch between the two
-        if("sw_lon" in CSVfilednames and "sw_lat" in CSVfilednames and "ne_lon" in CSVfilednames and "ne_lat" in CSVfilednames and "lat" in CSVfilednames and "lon" in CSVfilednames):
-
-            for row in reader:
-                prediction_data.append({
-                    "grid_id_x": row["grid_id_x"],
-                    "lon": float(row["lon"]),
-                    "lat": float(row["lat"]),
-                    "sw_lon": float(row["sw_lon"]),
-                    "sw_lat": float(row["sw_lat"]),
-                    "ne_lon": float(row["ne_lon"]),
-                    "ne_lat": float(row["ne_lat"]),
-                    "year": int(float(row["year"])),
-                    "no2_ppb": float(row["no2_ppb"]),
-                    "co_ppb": float(row["co_ppb"]),
-                    "so2_ppb": float(row["so2_ppb"]),
-                    "o3_ppb": float(row["o3_ppb"]),
-                    "ch4_ppb": float(row["ch4_ppb"])
-                })
-            data_type = "grid_and_point"
-        # if csv contains sw and ne data, create data for grid
-        elif ("sw_lon" in CSVfilednames and "sw_lat" in CSVfilednames and "ne_lon" in CSVfilednames and "ne_lat" in CSVfilednames):
-            for row in reader:
-                prediction_data.append({
-                    "grid_id_x": row["grid_id_x"],
-                    "sw_lon": float(row["sw_lon"]),
-                    "sw_lat": float(row["sw_lat"]),
-                    "ne_lon": float(row["ne_lon"]),
-                    "ne_lat": float(row["ne_lat"]),
-                    "year": int(float(row["year"])),
-                    "no2_ppb": float(row["no2_ppb"]),
-                    "co_ppb": float(row["co_ppb"]),
-                    "so2_ppb": float(row["so2_ppb"]),
-                    "o3_ppb": float(row["o3_ppb"]),
-                    "ch4_ppb": float(row["ch4_ppb"])
-                })
-            data_type = "grid"
-        # if csv has data based on lat long points
-        elif ("lat" in CSVfilednames and "lon" in CSVfilednames):
-            for row in reader:
-                prediction_data.append({
-                    "lat": float(row["lat"]),
-                    "lon": float(row["lon"]),
-                    "year": int(float(row["year"])),
-                    "no2_ppb": float(row["no2_ppb"]),
-                    "co_ppb": float(row["co_ppb"]),
-                    "so2_ppb": float(row["so2_ppb"]),
-                    "o3_ppb": float(row["o3_ppb"]),
-                    "ch4_ppb": float(row["ch4_ppb"])
-                })
-            data_type = "point"
-        return jsonify({"data": prediction_data, "data_type": data_type})
-
-
-class_columns = [
-    'class_1_percent',
-    'class_2_percent',
-    'class_3_percent',
-    'class_4_percent',
-    'class_5_percent',
-    'class_6_percent',
-    'class_7_percent',
-    'class_8_percent',
-    'class_9_percent',
-    'class_10_percent',
-    'class_11_percent'
-]
+    try:
+        year = requested_year()
+    except ValueError:
+        return jsonify({'error': 'Parameter year must be an integer'}), 400
+
+    if year is None:
+        df = grid_store.frame()
+    elif year in grid_dataset.available_years(GRID_DATASET_DIR):
+        df = load_dataset_year(year)
+    else:
+        return year_not_found(year)
+    extra_fields = []
+    if wants_uncertainty():
+        df, extra_fields = with_uncertainty(df)
+    return jsonify(build_prediction_payload(df, extra_fields, compact=wants_compact()))
+
+
+@lru_cache(maxsize=1)
+def load_trends(fingerprint):
+    """Per-cell trend coefficients; refitted only when the dataset fingerprint changes."""
+    return PollutantTrends.load_or_fit(air_pollutants, dataset_dir=GRID_DATASET_DIR)
+
+
+@app.route('/forecast', methods=['GET'])
+def forecast():
+    try:
+        year = requested_year()
+        confidence = float(request.args.get('confidence', 0.95))
+    except ValueError:
+        return jsonify({'error': 'Parameters year and confidence must be numbers'}), 400
+    if year is None:
+        return jsonify({'error': 'Parameter year is required'}), 400
+    if not 0 < confidence < 1:
+        return jsonify({'error': 'Parameter confidence must be between 0 and 1'}), 400
+    if len(grid_dataset.available_years(GRID_DATASET_DIR)) < 2:
+        return jsonify({'error': 'At least two years of data are needed for a forecast'}), 404
+
+    trends = load_trends(trend_forecast.dataset_fingerprint(GRID_DATASET_DIR))
+    df = trends.forecast(year, confidence=confidence)
+    bounds = [f"{pollutant}_{bound}" for pollutant in air_pollutants for bound in ("lower", "upper")
+              if trends.has_bounds]
+    payload = build_prediction_payload(df, extra_fields=bounds, compact=wants_compact())
+    payload["fitted_years"] = trends.years.tolist()
+    return jsonify(payload)
+
+
+@app.route('/cell-at', methods=['GET'])
+def cell_at():
+    """Current values of the grid cell containing ?lat=&lon=."""
+    try:
+        lat = float(request.args['lat'])
+        lon = float(request.args['lon'])
+    except (KeyError, ValueError):
+        return jsonify({'error': 'Parameters lat and lon are required numbers'}), 400
+    if grid_cells is None:
+        return jsonify({'error': 'The grid ids are not on the regular grid'}), 404
+    position = int(grid_cells.locate([lon], [lat])[0])
+    if position < 0:
+        return jsonify({'error': 'No grid cell at this location'}), 404
+
+    cell = scenario_frame(session_overlay(session['user_id']), ["grid_id_x", "year"] + features + air_pollutants, rows=[position])
+    cell["grid_id_x"] = cell["grid_id_x"].astype(str)
+    return jsonify(records(cell)[0])
+
+
+# full-forest refinement of surrogate predictions runs in the background, one job at a time
+refinement_executor = ThreadPoolExecutor(max_workers=1)
+# the status of every job is a file, so any worker process can answer the polls; the newest
+# REFINEMENT_JOBS_KEPT are kept for clients that never poll
+REFINEMENT_DIR = os.path.join(OVERLAY_DIR, 'refinements')
+REFINEMENT_JOBS_KEPT = int(os.environ.get('EKOVIZIJA_REFINEMENT_JOBS_KEPT', 1000))
+
+
+def predict_pollutants(models, input_data):
+    """Predicts every pollutant for a batch of feature rows."""
+    return {pollutant: models[pollutant].predict(input_data) for pollutant in air_pollutants if pollutant in models}
+
+
+def predict_forests(input_data):
+    """
+    Full forest predictions with the per-tree uncertainty fields for a batch of feature rows.
+
+    :return: (dict pollutant -> predictions, DataFrame with the uncertainty fields)
+    """
+    predictions, uncertainty = forest_uncertainty.predict_with_uncertainty(
+        stacked_forests, input_data, list(stacked_forests), UNCERTAINTY_QUANTILES)
+    for pollutant in air_pollutants:
+        if pollutant not in predictions:
+            predictions[pollutant] = dict_models[pollutant].predict(input_data)
+    return predictions, uncertainty
+
+
+def refine_with_forests(user_id, key, indexes, input_data):
+    """
+    Replaces surrogate predictions of painted cells with the full forest predictions and their uncertainty.
+
+    The values go to the cached state they were predicted for and to the session's current state, if it
+    moved on in the meantime (its cells that were not painted again are the same).
+    """
+    predictions, uncertainty = predict_forests(input_data)
+    refined = 0
+    with session_lock(user_id):
+        for state in dict.fromkeys([key, load_session_log(user_id).key]):
+            if state == SCENARIO_SEED:
+                continue
+            with overlay_lock(state):
+                overlay = cached_overlay(state)
+                if overlay is None or not len(overlay):
+                    continue
+                current = scenario_frame(overlay, features, rows=indexes)
+                # cells that were painted again (or undone) in the meantime keep their newer values
+                still_same = np.isclose(current.to_numpy(dtype=float),
+                                        input_data.to_numpy(dtype=float), rtol=1e-9, atol=1e-12).all(axis=1)
+                in_overlay = np.zeros(len(indexes), dtype=bool)
+                in_overlay[overlay.lookup(indexes)[0]] = True
+                still_same &= in_overlay
+                values = {pollutant: values[still_same] for pollutant, values in predictions.items()}
+                for field in uncertainty.columns:
+                    values[field] = uncertainty[field].to_numpy()[still_same]
+                overlay.update(indexes[still_same], values)
+                store_overlay(state, overlay)
+            if state == key:
+                refined = int(still_same.sum())
+    return refined
+
+
+def refinement_status_path(job_id):
+    return os.path.join(REFINEMENT_DIR, f"{job_id}.json")
+
+
+def write_refinement_status(job_id, status):
+    os.makedirs(REFINEMENT_DIR, exist_ok=True)
+    path = refinement_status_path(job_id)
+    tmp_path = path + f'.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(status, f)
+    os.replace(tmp_path, path)
+
+
+def run_refinement(job_id, user_id, key, indexes, input_data):
+    """Refinement job: refine_with_forests, with its outcome written to the job's status file."""
+    try:
+        refined = refine_with_forests(user_id, key, indexes, input_data)
+    except Exception as e:
+        print('Error refining predictions:', str(e))
+        write_refinement_status(job_id, {'status': 'failed', 'error': str(e)})
+    else:
+        write_refinement_status(job_id, {'status': 'done', 'refined_cells': refined})
+
+
+def lookup_single_brush(df, stroke_count, last_brush):
+    """
+    Precomputed values of cells painted once, with a known brush, that were untouched before.
+
+    :param df: Painted cells after the brushes were applied, indexed by position in the grid
+    :param stroke_count: Number of strokes of every cell of df
+    :param last_brush: Index in BRUSH_COLORS of the last brush of every cell of df
+    :return: (boolean array over df, True where the values come from the impact table,
+              values of those cells [n, n_pollutants])
+    """
+    from_table = np.zeros(len(df), dtype=bool)
+    if brush_impact is None or not len(df):
+        return from_table, np.empty((0, len(air_pollutants)))
+    single = np.flatnonzero((stroke_count == 1) & (last_brush >= 0))
+    candidates = df.index.to_numpy()[single]
+    # the table holds baseline cells with one brush applied, so compare with the baseline painted the same way
+    expected = grid_store.frame(features, rows=candidates)
+    for brush, color in enumerate(BRUSH_COLORS):
+        apply_brush(expected, expected.index[last_brush[single] == brush], color)
+    matches = np.isclose(df.iloc[single][features].to_numpy(dtype=float), expected.to_numpy(dtype=float),
+                         rtol=1e-9, atol=1e-12).all(axis=1)
+    from_table[single[matches]] = True
+    return from_table, brush_impact.lookup(candidates[matches], last_brush[single][matches])
+
+
+def predict_cells(df, stroke_count, last_brush):
+    """
+    Overlay values of painted cells: the impact table where it applies, otherwise the fast surrogates when
+    they exist (refined by the forests afterwards) or the forests.
+
+    :param df: Painted cells after the brushes were applied, indexed by position in the grid
+    :return: (dict column -> values, boolean array True where the values came from the impact table)
+    """
+    values = {col: df[col].to_numpy(dtype=float, copy=True) for col in features}
+    for col in air_pollutants + uncertainty_fields:
+        # the uncertainty is filled below by the forests or later by the refinement
+        values[col] = np.full(len(df), np.nan)
+    from_table, table_values = lookup_single_brush(df, stroke_count, last_brush)
+    for j, pollutant in enumerate(air_pollutants):
+        values[pollutant][from_table] = table_values[:, j]
+
+    rest = ~from_table
+    input_data = df.loc[df.index[rest], features]
+    if rest.any() and dict_surrogates:
+        for pollutant, predictions in predict_pollutants(dict_surrogates, input_data).items():
+            values[pollutant][rest] = predictions
+    elif rest.any():
+        predictions, uncertainty = predict_forests(input_data)
+        for pollutant, prediction in predictions.items():
+            values[pollutant][rest] = prediction
+        for field in uncertainty.columns:
+            values[field][rest] = uncertainty[field].to_numpy()
+    return values, from_table
+
+
+@lru_cache(maxsize=4096)
+def _resolve_stroke(stroke_json):
+    stroke = json.loads(stroke_json)
+    # a stroke is a rectangle (southWest/northEast as [lat, lon]) or a GeoJSON geometry with an optional buffer in meters
+    if 'geometry' in stroke:
+        rows = cell_index.select_geometry(stroke['geometry'], stroke.get('buffer', 0))
+    else:
+        rows = cell_index.select_box(stroke['southWest'], stroke['northEast'])
+    rows.flags.writeable = False
+    return rows
+
+
+def resolve_stroke(stroke):
+    """Sorted positions of the cells painted by a stroke (cached, strokes are replayed on undo and redo)."""
+    return _resolve_stroke(scenario_log.canonical_json(stroke))
+
+
+def edit_plan(edits, rows):
+    """
+    EditPlan of all strokes of edits, restricted to some cells.
+
+    :param rows: Sorted positions of the cells; the plan is indexed by position in rows
+    """
+    plan = EditPlan(len(rows))
+    for edit in edits:
+        for stroke in edit:
+            painted = resolve_stroke(stroke)
+            painted = painted[np.isin(painted, rows)]
+            if not plan.add_stroke(np.searchsorted(rows, painted), stroke['color']):
+                print(f"Unknown color: {stroke['color']}")
+    return plan
+
+
+def materialize(log, previous=None):
+    """
+    Overlay of the current state of a scenario log, from the cache or rebuilt incrementally.
+
+    Starting from the cached state of the previous log (what the session showed before), only the cells
+    painted by the edits in which the two logs differ are recomputed. If edits were only added, their
+    strokes are applied on top of the previous state; if edits were removed (undo, another scenario), the
+    cells are replayed from the baseline through all active edits. Without a previous state the whole log
+    is replayed.
+
+    :param log: ScenarioLog to materialize
+    :param previous: ScenarioLog of the state the session had before, if any
+    :return: (overlay, positions of the cells that differ from the previous state, details) with details
+             None when the overlay came from the cache, otherwise the recomputed positions and the
+             boolean array marking the cells read from the impact table
+    """
+    base = cached_overlay(previous.key) if previous is not None else None
+    if base is None:
+        shared, removed, base = 0, [], Overlay()
+    else:
+        shared = log.common_prefix(previous)
+        removed = previous.active[shared:]
+    added = log.active[shared:]
+    affected = np.unique(np.concatenate([np.empty(0, dtype=np.int64)] +
+                                        [resolve_stroke(stroke) for edit in removed + added for stroke in edit]))
+
+    overlay = cached_overlay(log.key)
+    if overlay is not None:
+        return overlay, affected, None
+
+    if removed:
+        df = grid_store.frame(rows=affected)
+        plan = edit_plan(log.active, affected)
+    else:
+        df = scenario_frame(base, rows=affected)
+        plan = edit_plan(added, affected)
+    # strokes are compiled into one edit plan and applied to the feature matrix in a single pass
+    feature_matrix = df[features].to_numpy(dtype=float, copy=True)
+    touched = plan.apply(feature_matrix, features)
+    df[features] = feature_matrix
+
+    overlay = base.copy()
+    # cells no active edit paints any more show the baseline again
+    overlay.drop(np.delete(affected, touched))
+    values, from_table = predict_cells(df.iloc[touched], plan.stroke_count()[touched], plan.last_brush()[touched])
+    overlay.update(affected[touched], values)
+    cache_overlay(log.key, overlay)
+    return overlay, affected, {'predicted': affected[touched], 'from_table': from_table}
+
+
+def schedule_refinement(user_id, key, overlay, details):
+    """
+    Refines surrogate values and the uncertainty of table values with the forests in the background.
+
+    :param overlay: The overlay materialize returned with the details (the cached copy may be pruned already)
+    :return: Id of the refinement job, None if there is nothing to refine
+    """
+    predicted, from_table = details['predicted'], details['from_table']
+    to_refine = predicted[~from_table] if dict_surrogates else np.array([], dtype=np.int64)
+    if uncertainty_fields:
+        to_refine = np.union1d(to_refine, predicted[from_table])
+    if not len(to_refine):
+        return None
+    input_data = scenario_frame(overlay, features, rows=to_refine)
+    job_id = str(uuid.uuid4())
+    write_refinement_status(job_id, {'status': 'pending'})
+    scenario_log.prune_cache(REFINEMENT_DIR, REFINEMENT_JOBS_KEPT)
+    refinement_executor.submit(run_refinement, job_id, user_id, key, to_refine, input_data)
+    return job_id
+
+
+def session_scenario(user_id):
+    """
+    Current state of a session's scenario, replayed from its log if it left the cache.
+
+    :return: (key of the state, overlay, version of the overlay: it changes when the refinement updates it)
+    """
+    with session_lock(user_id):
+        log = load_session_log(user_id)
+        # taken before the overlay is read, so a version never stands for older values than it names
+        path = overlay_path(log.key)
+        version = os.stat(path).st_mtime_ns if os.path.exists(path) else 0
+        overlay, _, details = materialize(log)
+        if details is not None:
+            schedule_refinement(user_id, log.key, overlay, details)
+    return log.key, overlay, version
+
+
+def session_overlay(user_id):
+    """Overlay of the current state of a session's scenario."""
+    return session_scenario(user_id)[1]
+
+
+def switch_scenario(user_id, log, previous, message):
+    """
+    Moves a session to the current state of a log and builds the response with the changed cells.
+
+    Call with the session_lock of the user held.
+    """
+    overlay, affected, details = materialize(log, previous)
+    log.save(session_log_path(user_id))
+    response = {'message': message, 'scenario': log.key, 'can_undo': log.can_undo(), 'can_redo': log.can_redo(),
+                'changed_cells': len(affected)}
+    if details is None:
+        response.update({'table_cells': 0, 'tier': 'cached'})
+    else:
+        response.update({'table_cells': int(details['from_table'].sum()),
+                         'tier': 'surrogate' if dict_surrogates else 'forest'})
+        job_id = schedule_refinement(user_id, log.key, overlay, details)
+        if job_id is not None:
+            response['refinement_id'] = job_id
+    changed_cells = scenario_frame(overlay, rows=affected).reindex(
+        columns=["grid_id_x"] + air_pollutants + uncertainty_fields)
+    changed_cells["grid_id_x"] = changed_cells["grid_id_x"].astype(str)
+    response['cells'] = records(changed_cells)
+    return response
 
-color_to_class_column = {
-    'red': 'class_7_percent', # CITY
-    'green': 'class_2_percent', #FOREST
-    'yellow': 'class_5_percent', #CROPS
-}
 
 @app.route('/predict', methods=['POST'])
 def predict():
     try:
         data = request.get_json()
-        changed_indexes = set()
-        df = pd.read_csv('air_quality/all_data_changed.csv')
-
+        user_id = session['user_id']
+        if not isinstance(data, list):
+            return jsonify({'error': 'The body must be a list of strokes'}), 400
         for item in data:
-            
             print(item)
-            sw = item['southWest']
-            ne = item['northEast']
-            color = item['color']
-            print("color", color)
-
-            sw_lat, sw_lon = sw
-            ne_lat, ne_lon = ne
-
-            mask = (
-                (df['lat'] >= sw_lat) & (df['lat'] <= ne_lat) &
-                (df['lon'] >= sw_lon) & (df['lon'] <= ne_lon)
-            )
-            
-            print(mask)
-            matched_indexes = df[mask].index.tolist()
-            print(matched_indexes)
-            changed_indexes.update(matched_indexes)
-            
-            if color=='red':
-                df.loc[mask, 'population_sum'] += 1000
-            
-            if color in color_to_class_column.keys():
-                for col in class_columns:
-                    df.loc[mask, col] = 0
-
-                # LAND of type to 100%
-                if color in color_to_class_column:
-                    class_col = color_to_class_column[color]
-                    df.loc[mask, class_col] = 100
-            elif color == 'gray':
-                df.loc[mask, 'road_length_m'] += 1000
-            elif color == 'purple':
-                df.loc[mask, 'distance_to_factory'] = 0
-            else:
-                print(f"Unknown color: {color}")
-                
-        for idx in changed_indexes:
             try:
-                row = df.loc[idx]
-                input_data = row[features].to_frame().T 
-
-                for pollutant in air_pollutants:
-                    model = dict_models.get(pollutant)
-                    if model:
-                        prediction = model.predict(input_data)[0]
-                        df.at[idx, pollutant] = float(prediction)
-
-            except Exception as e:
-                print(f"Failed to predict for index {idx}: {e}")
+                item['color']
+                resolve_stroke(item)
+            except (ValueError, TypeError, KeyError) as e:
+                return jsonify({'error': f'Invalid stroke: {e}'}), 400
 
-
-        df.to_csv('all_data_changed.csv', index=False)
-        return jsonify({'message': 'Data for prediction updated successfully.'}), 200
+        with session_lock(user_id):
+            log = load_session_log(user_id)
+            previous = log.copy()
+            # the strokes of one request are one edit of the scenario, undone and redone together
+            log.append(data)
+            response = switch_scenario(user_id, log, previous, 'Data for prediction updated successfully.')
+        return jsonify(response), 200
     except Exception as e:
         print('Error processing prediction data:', str(e))
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/scenario', methods=['GET'])
+def get_scenario():
+    """The session's scenario: its key, the active edits and whether undo/redo are possible."""
+    log = load_session_log(session['user_id'])
+    return jsonify({'scenario': log.key, 'edits': log.active, 'head': log.head, 'length': len(log.edits),
+                    'can_undo': log.can_undo(), 'can_redo': log.can_redo()})
+
+
+@app.route('/scenario/undo', methods=['POST'])
+def undo_scenario():
+    user_id = session['user_id']
+    with session_lock(user_id):
+        log = load_session_log(user_id)
+        if not log.can_undo():
+            return jsonify({'error': 'Nothing to undo'}), 409
+        previous = log.copy()
+        log.undo()
+        return jsonify(switch_scenario(user_id, log, previous, 'Edit undone.'))
+
+
+@app.route('/scenario/redo', methods=['POST'])
+def redo_scenario():
+    user_id = session['user_id']
+    with session_lock(user_id):
+        log = load_session_log(user_id)
+        if not log.can_redo():
+            return jsonify({'error': 'Nothing to redo'}), 409
+        previous = log.copy()
+        log.redo()
+        return jsonify(switch_scenario(user_id, log, previous, 'Edit redone.'))
+
+
+@app.route('/scenario/reset', methods=['POST'])
+def reset_scenario():
+    user_id = session['user_id']
+    with session_lock(user_id):
+        previous = load_session_log(user_id)
+        return jsonify(switch_scenario(user_id, ScenarioLog(SCENARIO_SEED), previous, 'Scenario cleared.'))
+
+
+@app.route('/scenario/share', methods=['POST'])
+def share_scenario():
+    """Stores the active edits of the session under the scenario key, so others can open them."""
+    log = load_session_log(session['user_id'])
+    ScenarioLog(SCENARIO_SEED, log.active).save(shared_log_path(log.key))
+    return jsonify({'scenario': log.key, 'url': f"/prediction?scenario={log.key}"})
+
+
+@app.route('/scenario/load/<key>', methods=['POST'])
+def load_shared_scenario(key):
+    """Replaces the session's scenario with a shared one."""
+    if not re.fullmatch('[0-9a-f]{64}', key) or not os.path.exists(shared_log_path(key)):
+        return jsonify({'error': 'Unknown scenario'}), 404
+    shared = ScenarioLog.load(shared_log_path(key), SCENARIO_SEED)
+    if shared.key != key:
+        return jsonify({'error': 'The scenario was made with other data or models'}), 404
+    user_id = session['user_id']
+    with session_lock(user_id):
+        previous = load_session_log(user_id)
+        if previous.key == key:
+            previous = None
+        return jsonify(switch_scenario(user_id, shared, previous, 'Scenario loaded.'))
+
+
+@app.route('/predict-status/<job_id>', methods=['GET'])
+def predict_status(job_id):
+    path = refinement_status_path(job_id)
+    if not re.fullmatch('[0-9a-f-]{36}', job_id) or not os.path.exists(path):
+        return jsonify({'error': 'Unknown refinement job'}), 404
+    try:
+        with open(path) as f:
+            status = json.load(f)
+    except OSError:  # polled twice at the end of the job
+        return jsonify({'error': 'Unknown refinement job'}), 404
+    if status['status'] != 'pending':
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    return jsonify(status)
+
+
+def parse_corner(data, name):
+    """[lat, lon] corner of a request body as two floats."""
+    corner = data[name]
+    if (not isinstance(corner, (list, tuple)) or len(corner) != 2
+            or not all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in corner)):
+        raise ValueError(f'Parameter {name} must be [lat, lon]')
+    return float(corner[0]), float(corner[1])
+
+
+@app.route('/sweep', methods=['POST'])
+def sweep_interventions():
+    """
+    Ranks the cells by how much one brush would reduce a pollutant if only that cell were painted.
+
+    Body: {"color": "green", "pollutant": "no2_ppb", "k": 50,
+           "southWest": [lat, lon], "northEast": [lat, lon]}  (region optional)
+    """
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return jsonify({'error': 'The body must be a JSON object'}), 400
+    color = data.get('color')
+    pollutant = data.get('pollutant', 'no2_ppb')
+    if color not in BRUSH_COLORS:
+        return jsonify({'error': f'Parameter color must be one of {BRUSH_COLORS}'}), 400
+    if pollutant not in air_pollutants:
+        return jsonify({'error': f'Parameter pollutant must be one of {air_pollutants}'}), 400
+    try:
+        k = int(data.get('k', 50))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Parameter k must be an integer'}), 400
+    if k <= 0:
+        return jsonify({'error': 'Parameter k must be positive'}), 400
+    region = 'southWest' in data and 'northEast' in data
+    if region:
+        try:
+            sw_lat, sw_lon = parse_corner(data, 'southWest')
+            ne_lat, ne_lon = parse_corner(data, 'northEast')
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+    df = scenario_frame(session_overlay(session['user_id'])).drop_duplicates('grid_id_x').reset_index(drop=True)
+    if region:
+        df = df[(df['lat'] >= sw_lat) & (df['lat'] <= ne_lat) &
+                (df['lon'] >= sw_lon) & (df['lon'] <= ne_lon)].reset_index(drop=True)
+
+    current, painted = sweep.sweep_brush(dict_models, df, color, features, [pollutant])
+    top, reductions = sweep.top_k_reductions(current[:, 0], painted[:, 0], k)
+
+    cells = df.loc[top, ["grid_id_x", "lon", "lat", "sw_lon", "sw_lat", "ne_lon", "ne_lat"]].copy()
+    cells["grid_id_x"] = cells["grid_id_x"].astype(str)
+    cells["current"] = current[top, 0]
+    cells["painted"] = painted[top, 0]
+    cells["reduction"] = reductions
+    cells["reduction_percent"] = np.where(current[top, 0] != 0, reductions / current[top, 0] * 100, 0.0)
+    return jsonify({'color': color, 'pollutant': pollutant, 'k': len(top), 'evaluated_cells': len(df),
+                    'cells': records(cells)})
+
+
+# STATISTICS =====================================
+# aggregates of the analytics and reports pages (air_quality/grid_stats.py): the baseline sums are computed
+# once, the sums of a scenario are derived from them and the cells it changed
+@lru_cache(maxsize=1)
+def grid_statistics():
+    return grid_stats.GridStatistics(grid_store, air_pollutants, grid_cells)
+
+
+def statistics_request():
+    """Statistics, the baseline and scenario sums of the session and the scenario key for a stats endpoint."""
+    stats = grid_statistics()
+    key, overlay, version = session_scenario(session['user_id'])
+    return stats, stats.baseline, stats.scenario_sums(overlay, (key, version)), key, overlay
+
+
+def pollutant_arg():
+    pollutant = request.args.get('pollutant', 'no2_ppb')
+    if pollutant not in air_pollutants:
+        raise ValueError(f'Parameter pollutant must be one of {air_pollutants}')
+    return pollutant
+
+
+@app.route('/stats/summary', methods=['GET'])
+def stats_summary():
+    """Number of cells, mean and population-weighted exposure of every pollutant."""
+    stats, baseline, scenario, key, _ = statistics_request()
+    return jsonify({'scenario': key, 'baseline': stats.summary(baseline), 'current': stats.summary(scenario)})
+
+
+@app.route('/stats/histogram', methods=['GET'])
+def stats_histogram():
+    """Histogram of a pollutant (?pollutant=no2_ppb) over fixed bins."""
+    try:
+        pollutant = pollutant_arg()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    stats, baseline, scenario, key, _ = statistics_request()
+    return jsonify({'scenario': key, 'pollutant': pollutant, 'baseline': stats.histogram(baseline, pollutant),
+                    'current': stats.histogram(scenario, pollutant)})
+
+
+@app.route('/stats/regions', methods=['GET'])
+def stats_regions():
+    """Mean of every pollutant per region (10 km tiles of the grid)."""
+    stats, baseline, scenario, key, _ = statistics_request()
+    return jsonify({'scenario': key, 'baseline': stats.by_region(baseline), 'current': stats.by_region(scenario)})
+
+
+@app.route('/stats/land-classes', methods=['GET'])
+def stats_land_classes():
+    """Mean of every pollutant per dominant land class of the cells."""
+    stats, baseline, scenario, key, _ = statistics_request()
+    return jsonify({'scenario': key, 'baseline': stats.by_land_class(baseline),
+                    'current': stats.by_land_class(scenario)})
+
+
+@app.route('/stats/top', methods=['GET'])
+def stats_top():
+    """The n cells with the highest values of a pollutant (?pollutant=no2_ppb&n=10) in the session's scenario."""
+    try:
+        pollutant = pollutant_arg()
+        n = int(request.args.get('n', 10))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    stats, _, _, key, overlay = statistics_request()
+    positions, values = stats.top_cells(overlay, pollutant, max(n, 0))
+    cells = grid_store.frame(["grid_id_x", "lon", "lat"], rows=positions)
+    cells["grid_id_x"] = cells["grid_id_x"].astype(str)
+    cells[pollutant] = values
+    cells["changed"] = np.isin(positions, overlay.positions)
+    return jsonify({'scenario': key, 'pollutant': pollutant, 'cells': records(cells)})
+
+
+@app.route('/export', methods=['GET'])
+def export_scenario():
+    """
+    Streams the session's scenario with the cell polygons, features and pollutant values.
+
+    Query parameters: format (geojson, geoparquet or csv), bbox=min_lon,min_lat,max_lon,max_lat to export only
+    the cells intersecting it, changed=1 to export only the cells the scenario changed.
+    """
+    fmt = request.args.get('format', 'geojson')
+    if fmt not in export.FORMATS:
+        return jsonify({'error': f"Parameter format must be one of {', '.join(export.FORMATS)}"}), 400
+    try:
+        bbox = export.parse_bbox(request.args['bbox']) if request.args.get('bbox') else None
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    changed_only = request.args.get('changed', '0').lower() in ('1', 'true', 'yes')
+
+    # the overlay is read once, so the export stays consistent if the session paints while it downloads
+    key, overlay, _ = session_scenario(session['user_id'])
+    columns = ["grid_id_x", "lon", "lat", "year"] + features + air_pollutants
+    mimetype, extension = export.FORMATS[fmt]
+    chunks = export.stream(fmt, grid_store, overlay, columns, grid_cells, bbox, changed_only)
+    return Response(chunks, mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename="ekovizija-{key[:12]}.{extension}"'})
+
+
+# SATELLITE PREDICTION ===========================
+# predicted satellite image of the next year from the model exported by models/export_model.py (float32 or
+# int8 TorchScript), loaded once on the first request; predictions run in a worker pool and the PNGs are
+# cached per input years and region (air_quality/satellite_prediction.py)
+SATELLITE_MODEL = os.environ.get('EKOVIZIJA_SATELLITE_MODEL', os.path.join('models', 'satellite', 'predictor.pt'))
+SATELLITE_IMAGE_DIR = os.environ.get('EKOVIZIJA_SATELLITE_IMAGE_DIR', 'satellite_images')
+SATELLITE_CACHE_DIR = os.environ.get('EKOVIZIJA_SATELLITE_CACHE_DIR', os.path.join('air_quality', 'satellite_predictions'))
+SATELLITE_WORKERS = int(os.environ.get('EKOVIZIJA_SATELLITE_WORKERS', 2))
+
+
+@lru_cache(maxsize=1)
+def satellite_predictor():
+    # imported on the first request: torch and the image libraries would add hundreds of MB to every worker
+    from air_quality import satellite_prediction
+    return satellite_prediction.ImagePredictor(SATELLITE_MODEL, SATELLITE_IMAGE_DIR, SATELLITE_CACHE_DIR,
+                                               workers=SATELLITE_WORKERS)
+
+
+def parse_years(text):
+    """Years of a comma-separated query parameter, e.g. "2023,2024"."""
+    try:
+        return [int(year) for year in text.split(',')]
+    except ValueError:
+        raise ValueError(f"years must be comma-separated years, got {text!r}")
+
+
+@app.route('/satellite/predict', methods=['GET'])
+def predict_satellite_image():
+    """
+    PNG of the predicted satellite image of the year after the input years.
+
+    Query parameters: years (consecutive, e.g. "2023,2024"; the last available ones if missing) and
+    bbox ("min_lon,min_lat,max_lon,max_lat"; the whole images if missing).
+    """
+    if not os.path.exists(SATELLITE_MODEL):
+        return jsonify({'error': 'No exported satellite model, see models/export_model.py'}), 503
+    try:
+        years = parse_years(request.args['years']) if request.args.get('years') else None
+        bbox = export.parse_bbox(request.args['bbox']) if request.args.get('bbox') else None
+        png, year, cached = satellite_predictor().predict(years, bbox)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return Response(png, mimetype='image/png',
+                    headers={'X-Predicted-Year': str(year), 'X-Cache': 'hit' if cached else 'miss'})
+
+
 """@app.route('/predict', methods=['POST'])
 def predict():
     # COORDS FROM REQUEST (each grid square has unique coords) - lat and lon gotta be inputs 
@@ -0,0 +1,82 @@
+"""
+Converts saved JPEG/PNG satellite images to GeoTIFFs (this does not recover what JPEG compression lost).
+
+Usage: python images/convert_images.py --dir satellite_images [--benchmark]
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+import tifffile
+from skimage import io
+
+import mosaic
+from image_fetcher import DEFAULT_BBOX
+
+SOURCE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+
+def convert(path, bbox=DEFAULT_BBOX, remove=False):
+    """
+    Writes an image as an uncompressed GeoTIFF next to it.
+
+    :param path: JPEG or PNG image
+    :param bbox: [min_lon, min_lat, max_lon, max_lat] of the image
+    :param remove: Delete the original afterwards
+    :return: Path of the GeoTIFF
+    """
+    image = io.imread(path)
+    if image.ndim == 2:
+        image = np.repeat(image[:, :, None], 3, axis=2)
+    tif_path = os.path.splitext(path)[0] + '.tif'
+    mosaic.save_geotiff(tif_path, np.ascontiguousarray(image[:, :, :3]), bbox)
+    if remove:
+        os.remove(path)
+    return tif_path
+
+
+def _time_reads(paths, read, repeat):
+    """Mean time in milliseconds to read an image and sum its pixels (so memory maps are read too)."""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for path in paths:
+            int(np.asarray(read(path)).sum(dtype=np.uint64))
+    return (time.perf_counter() - start) * 1000 / (repeat * len(paths))
+
+
+def benchmark(image_dir, repeat=5):
+    """Prints the time per image of every way to read the images of a directory."""
+    sources = sorted(f for f in os.listdir(image_dir) if f.lower().endswith(SOURCE_EXTENSIONS))
+    pairs = [(os.path.join(image_dir, f), os.path.join(image_dir, os.path.splitext(f)[0] + '.tif')) for f in sources]
+    pairs = [(source, tif) for source, tif in pairs if os.path.exists(tif)]
+    if not pairs:
+        print(f"No images with both a JPEG/PNG and a TIFF in {image_dir}")
+        return
+    source_paths, tif_paths = zip(*pairs)
+    for name, paths, read in [("JPEG/PNG decode (skimage)", source_paths, io.imread),
+                              ("TIFF read (tifffile.imread)", tif_paths, tifffile.imread),
+                              ("TIFF memory map (tifffile.memmap)", tif_paths,
+                               lambda p: tifffile.memmap(p, mode='r'))]:
+        print(f"{name:36s} {_time_reads(paths, read, repeat):8.2f} ms/image")
+    source_mb = sum(os.path.getsize(p) for p in source_paths) / 1e6
+    tif_mb = sum(os.path.getsize(p) for p in tif_paths) / 1e6
+    print(f"{len(pairs)} images: {source_mb:.1f} MB JPEG/PNG, {tif_mb:.1f} MB TIFF")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert saved JPEG/PNG satellite images to GeoTIFF.")
+    parser.add_argument("--dir", default="../satellite_images", help="Directory of the images.")
+    parser.add_argument("--bbox", type=float, nargs=4, metavar=("MIN_LON", "MIN_LAT", "MAX_LON", "MAX_LAT"),
+                        default=DEFAULT_BBOX, help="Area of the images.")
+    parser.add_argument("--remove", action="store_true", help="Delete the JPEG/PNG files after converting them.")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="Only compare the read times of the JPEG/PNG files and their TIFFs.")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(args.dir)
+    else:
+        for image_file in sorted(os.listdir(args.dir)):
+            if image_file.lower().endswith(SOURCE_EXTENSIONS):
+                print(f"{image_file} -> {convert(os.path.join(args.dir, image_file), args.bbox, args.remove)}")
@@ -2,28 +2,98 @@ from oauthlib.oauth2 import BackendApplicationClient
 from requests_oauthlib import OAuth2Session
 from PIL import Image
 from io import BytesIO
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import argparse
+import hashlib
+import json
 import os
+import random
+import threading
+import time
+import numpy as np
+import requests
+import tifffile
 from dotenv import load_dotenv
 
+import mosaic
+
+TOKEN_URL = "https://identity.dataspace.copernicus.eu/auth/realms/CDSE/protocol/openid-connect/token"
+API_URL = "https://sh.dataspace.copernicus.eu/api/v1/process"
+
+# area of the original images (CRS84 lon/lat)
+DEFAULT_BBOX = [13.822174072265625, 45.85080395917834, 14.55963134765625, 46.29191774991382]
+
+# responses worth another try: rate limiting and temporary server errors
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class FetchError(Exception):
+    """A request that failed for good (after the retries, or with a status that is not retried)."""
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def request_key(payload):
+    """Cache key of a request: hash of its payload, which includes the evalscript."""
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+
+def decode_image(content):
+    """RGB pixels [height, width, 3] of an API response (TIFF, or PNG/JPEG from older cached requests)."""
+    if content[:4] in (b'II*\x00', b'MM\x00*'):
+        image = tifffile.imread(BytesIO(content))
+    else:
+        image = np.asarray(Image.open(BytesIO(content)).convert('RGB'))
+    if image.ndim not in (2, 3):
+        raise ValueError(f"Not an image: pixels of shape {image.shape}")
+    if image.ndim == 2:
+        image = np.repeat(image[:, :, None], 3, axis=2)
+    return image[:, :, :3]
+
 
 class SentinelImageFetcher:
     """
     A class to authenticate with the Sentinel Hub API and fetch satellite images
     for a given range of years.
+
+    Requests run concurrently on a bounded thread pool. Each one is retried with
+    exponential backoff on connection errors and temporary server errors, the access token
+    is refreshed before it expires (or when the API rejects it), and responses are kept in
+    an on-disk cache keyed by the request, so a year or area is only downloaded once.
     """
 
-    def __init__(self, client_id, client_secret):
+    def __init__(self, client_id, client_secret, token_url=TOKEN_URL, api_url=API_URL,
+                 output_dir="../satellite_images", cache_dir=None, workers=4, max_retries=5,
+                 backoff=1.0, timeout=120):
         """
         Initializes the SentinelImageFetcher with authentication details.
 
         :param client_id: The client ID for authentication
         :param client_secret: The client secret for authentication
+        :param token_url: OAuth2 token endpoint
+        :param api_url: Process API endpoint
+        :param output_dir: Folder of the saved images
+        :param cache_dir: Folder of the response cache (output_dir/cache if None)
+        :param workers: Number of requests running at the same time
+        :param max_retries: Retries of a failed request before giving up
+        :param backoff: Delay before the first retry in seconds, doubled on every retry
+        :param timeout: Timeout of one HTTP request in seconds
         """
         self.client_id = client_id
         self.client_secret = client_secret
-        self.token_url = "https://identity.dataspace.copernicus.eu/auth/realms/CDSE/protocol/openid-connect/token"
-        self.api_url = "https://sh.dataspace.copernicus.eu/api/v1/process"
+        self.token_url = token_url
+        self.api_url = api_url
+        self.output_dir = output_dir
+        self.cache_dir = cache_dir if cache_dir is not None else os.path.join(output_dir, "cache")
+        self.workers = workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
         self.evalscript = self._get_evalscript()
+        self._token_lock = threading.Lock()
+        self._local = threading.local()
         self.oauth = self._authenticate()
 
     def _authenticate(self):
@@ -41,6 +111,183 @@ class SentinelImageFetcher:
         )
         return oauth
 
+    def _access_token(self, rejected=None):
+        """
+        Current access token, fetched again when it is about to expire or was rejected.
+
+        :param rejected: Token the API answered 401 to; only the first thread that reports it
+                         fetches a new one, the others pick that up
+        """
+        with self._token_lock:
+            token = self.oauth.token
+            expires_at = token.get('expires_at')
+            # a margin for the request still to be sent, at most 30 s or a tenth of the token's lifetime
+            margin = min(30.0, float(token.get('expires_in', 300)) / 10)
+            if token.get('access_token') == rejected or (expires_at is not None and expires_at - margin < time.time()):
+                self.oauth = self._authenticate()
+            return self.oauth.token['access_token']
+
+    def _session(self):
+        """HTTP session of the calling thread (sessions are not shared between threads)."""
+        if not hasattr(self._local, 'session'):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def _retry_delay(self, attempt, response=None):
+        """Exponential backoff with jitter, or the Retry-After of the response if it has one."""
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after is not None:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        return self.backoff * 2 ** attempt * (0.5 + random.random() / 2)
+
+    def _post(self, payload):
+        """
+        Posts a request, with retries and token refresh.
+
+        :return: Response content
+        :raises FetchError: If the request fails for good
+        """
+        error = None
+        refreshed = False
+        attempt = 0
+        while True:
+            token = self._access_token()
+            response = None
+            try:
+                response = self._session().post(self.api_url, json=payload, timeout=self.timeout,
+                                                headers={'Authorization': f"Bearer {token}"})
+            except requests.RequestException as e:
+                error = FetchError(f"Request failed: {e}")
+            else:
+                if response.status_code == 200:
+                    return response.content
+                error = FetchError(f"Status code {response.status_code}: {response.text[:200]}", response.status_code)
+                if response.status_code == 401:
+                    # token expired or revoked early: fetch a new one, the first time without waiting
+                    self._access_token(rejected=token)
+                    if not refreshed:
+                        refreshed = True
+                        continue
+                elif response.status_code not in RETRY_STATUS:
+                    raise error
+            if attempt == self.max_retries:
+                raise error
+            time.sleep(self._retry_delay(attempt, response))
+            attempt += 1
+
+    def _cache_path(self, payload):
+        return os.path.join(self.cache_dir, request_key(payload) + ".bin")
+
+    def fetch(self, payload):
+        """
+        Response to a request, from the cache or from the API.
+
+        :param payload: Request payload (see _create_request)
+        :return: Response content
+        """
+        path = self._cache_path(payload)
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                return f.read()
+        content = self._post(payload)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # written under a temporary name, so an interrupted run never leaves a truncated entry
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+        return content
+
+    def fetch_many(self, payloads):
+        """
+        Fetches requests concurrently on the thread pool.
+
+        :param payloads: List of request payloads
+        :return: List with the content of every request, or the FetchError it failed with
+        """
+        def fetch_or_error(payload):
+            try:
+                return self.fetch(payload)
+            except FetchError as e:
+                return e
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return list(executor.map(fetch_or_error, payloads))
+
+    def fetch_mosaic(self, year, bbox, resolution_m=10, path=None, tile_px=2048):
+        """
+        Fetches a large area at a target resolution as tiles and stitches them into a GeoTIFF.
+
+        Tiles are requested concurrently, at most two per worker ahead of the writer, and each
+        one is written into the file as soon as it arrives, so memory stays at a few tiles.
+        Tiles are cached like all requests: running again after a failure only fetches the
+        missing ones.
+
+        :param year: The year for which to fetch the satellite image
+        :param bbox: Area as [min_lon, min_lat, max_lon, max_lat]
+        :param resolution_m: Pixel size in meters
+        :param path: Output GeoTIFF (output_dir/mosaics/mosaic_{year}.tif if None)
+        :param tile_px: Tile size in pixels, at most mosaic.MAX_TILE_PX
+        :return: (path, list of the windows (row, col, height, width) that failed)
+        """
+        grid = mosaic.PixelGrid(bbox, resolution_m)
+        # in a subfolder, so the training datasets do not take mosaics for yearly images
+        path = path or os.path.join(self.output_dir, "mosaics", f"mosaic_{year}.tif")
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        windows = grid.tiles(min(tile_px, mosaic.MAX_TILE_PX))
+        failed = []
+        print(f"Mosaic of {grid.width}x{grid.height} pixels for year {year} in {len(windows)} tiles")
+
+        def fetch_tile(window):
+            row, col, height, width = window
+            payload = self._create_request(year, grid.window_bbox(*window), width=width, height=height,
+                                           output_format="image/tiff")
+            try:
+                return decode_image(self.fetch(payload))
+            except (OSError, ValueError):
+                # a corrupt or truncated cached tile is fetched again by the next run
+                try:
+                    os.remove(self._cache_path(payload))
+                except OSError:
+                    pass
+                raise
+
+        with mosaic.MosaicWriter(path, grid) as writer, ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = {}
+            for window in windows:
+                pending[executor.submit(fetch_tile, window)] = window
+                if len(pending) < 2 * self.workers:
+                    continue
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    self._write_tile(writer, pending.pop(future), future, failed)
+            for future in list(pending):
+                self._write_tile(writer, pending.pop(future), future, failed)
+        print(f"Mosaic for year {year} saved at {path}" + (f", {len(failed)} tiles failed" if failed else ""))
+        return path, failed
+
+    @staticmethod
+    def _write_tile(writer, window, future, failed):
+        row, col, height, width = window
+        try:
+            tile = future.result()
+        except FetchError as e:
+            print(f"Failed to retrieve tile {window}. {e}")
+            failed.append(window)
+            return
+        except (OSError, ValueError) as e:  # undecodable response, unreadable cache entry
+            print(f"Failed to read tile {window}. {e}")
+            failed.append(window)
+            return
+        if tile.shape[:2] != (height, width):
+            print(f"Tile {window} has size {tile.shape[:2]}, expected {(height, width)}")
+            failed.append(window)
+            return
+        writer.write(row, col, tile)
+
     def _get_evalscript(self):
         """
         Defines the Evalscript used for Sentinel Hub image processing.
@@ -65,39 +312,43 @@ class SentinelImageFetcher:
         }
         """
 
-    def generate_images_for_years(self, start_year, end_year):
+    def generate_images_for_years(self, start_year, end_year, bbox=None):
         """
         Fetches and saves images for each year within the specified range.
 
         :param start_year: The starting year of the range
         :param end_year: The ending year of the range
+        :param bbox: Area as [min_lon, min_lat, max_lon, max_lat] (DEFAULT_BBOX if None)
         """
-        for year in range(start_year, end_year + 1):
-            request = self._create_request(year)
-            response = self.oauth.post(self.api_url, json=request)
-
-            if response.status_code == 200:
-                self._save_image(response.content, year)
+        years = list(range(start_year, end_year + 1))
+        bbox = list(bbox if bbox is not None else DEFAULT_BBOX)
+        # TIFF is the lossless output of the API, as delivered (no JPEG or PNG encoding)
+        results = self.fetch_many([self._create_request(year, bbox, output_format="image/tiff") for year in years])
+        for year, result in zip(years, results):
+            if isinstance(result, FetchError):
+                print(f"Failed to retrieve image for year {year}. {result}")
             else:
-                print(f"Failed to retrieve image for year {year}. Status code: {response.status_code}")
+                self._save_image(result, year, bbox)
 
-    def _create_request(self, year):
+    def _create_request(self, year, bbox=None, width=512, height=512, output_format=None):
         """
         Creates the request payload for the Sentinel Hub API.
 
         :param year: The year for which to fetch the satellite image
+        :param bbox: Area as [min_lon, min_lat, max_lon, max_lat] (DEFAULT_BBOX if None)
+        :param width: Width of the image in pixels
+        :param height: Height of the image in pixels
+        :param output_format: Media type of the response (API default if None)
         :return: JSON request payload
         """
+        output = {"width": width, "height": height}
+        if output_format is not None:
+            output["responses"] = [{"identifier": "default", "format": {"type": output_format}}]
         return {
             "input": {
                 "bounds": {
                     "properties": {"crs": "http://www.opengis.net/def/crs/OGC/1.3/CRS84"},
-                    "bbox": [
-                        13.822174072265625,
-                        45.85080395917834,
-                        14.55963134765625,
-                        46.29191774991382,
-                    ],
+                    "bbox": list(bbox if bbox is not None else DEFAULT_BBOX),
                 },
                 "data": [
                     {
@@ -112,27 +363,27 @@ class SentinelImageFetcher:
                     }
                 ],
             },
-            "output": {
-                "width": 512,
-                "height": 512,
-            },
+            "output": output,
             "evalscript": self.evalscript,
         }
 
-    def _save_image(self, image_content, year):
+    def _save_image(self, image_content, year, bbox=None):
         """
         Saves the fetched satellite image to a local file.
 
+        The image is stored as delivered, in an uncompressed GeoTIFF with the bounds of the
+        request: nothing is lost, and training can memory-map it instead of decoding it.
+
         :param image_content: The binary content of the image
         :param year: The year corresponding to the image
+        :param bbox: Area of the image as [min_lon, min_lat, max_lon, max_lat] (DEFAULT_BBOX if None)
         """
 
-        folder_path = "../satellite_images"
-        file_path = f"output_image_{year}.jpg"
+        folder_path = self.output_dir
+        file_path = f"output_image_{year}.tif"
         file_path = folder_path + "/" + file_path
-        image_data = BytesIO(image_content)
-        image = Image.open(image_data)
-        image.save(file_path)
+        image = decode_image(image_content)
+        mosaic.save_geotiff(file_path, image, bbox if bbox is not None else DEFAULT_BBOX)
         print(f"Image for year {year} saved successfully at {file_path}")
 
 # Load environment variables from .env file
@@ -140,8 +391,26 @@ load_dotenv()
 
 # Example usage
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fetch yearly Sentinel-2 images.")
+    parser.add_argument("--start-year", type=int, default=2015)
+    parser.add_argument("--end-year", type=int, default=2025)
+    parser.add_argument("--workers", type=int, default=4, help="Requests running at the same time.")
+    parser.add_argument("--retries", type=int, default=5, help="Retries of a failed request.")
+    parser.add_argument("--token-url", default=TOKEN_URL)
+    parser.add_argument("--api-url", default=API_URL, help="Process API (e.g. a local stand-in server for testing).")
+    parser.add_argument("--mosaic-bbox", type=float, nargs=4, metavar=("MIN_LON", "MIN_LAT", "MAX_LON", "MAX_LAT"),
+                        help="Fetch this area as a tiled mosaic (GeoTIFF) instead of one 512x512 image per year.")
+    parser.add_argument("--resolution", type=float, default=10, help="Pixel size of the mosaic in meters.")
+    parser.add_argument("--tile-px", type=int, default=2048, help="Tile size of the mosaic requests in pixels.")
+    args = parser.parse_args()
+
     CLIENT_ID = os.getenv("CLIENT_ID")
     CLIENT_SECRET = os.getenv("CLIENT_SECRET")
 
-    fetcher = SentinelImageFetcher(CLIENT_ID, CLIENT_SECRET)
-    fetcher.generate_images_for_years(2015, 2025)
+    fetcher = SentinelImageFetcher(CLIENT_ID, CLIENT_SECRET, token_url=args.token_url, api_url=args.api_url,
+                                   workers=args.workers, max_retries=args.retries)
+    if args.mosaic_bbox:
+        for mosaic_year in range(args.start_year, args.end_year + 1):
+            fetcher.fetch_mosaic(mosaic_year, args.mosaic_bbox, args.resolution, tile_px=args.tile_px)
+    else:
+        fetcher.generate_images_for_years(args.start_year, args.end_year)
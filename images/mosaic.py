@@ -0,0 +1,156 @@
+"""Tiling of large areas for the Sentinel Hub Process API and writing of uncompressed GeoTIFFs tile by tile."""
+import math
+import os
+
+import numpy as np
+import tifffile
+
+# largest output of one Process API request
+MAX_TILE_PX = 2500
+METERS_PER_DEGREE = 111_320.0
+
+
+class PixelGrid:
+    """
+    Pixel grid of a bounding box in lon/lat at a target resolution.
+    """
+
+    def __init__(self, bbox, resolution_m):
+        """
+        :param bbox: [min_lon, min_lat, max_lon, max_lat]
+        :param resolution_m: Pixel size in meters (at the centre of the box)
+        """
+        min_lon, min_lat, max_lon, max_lat = bbox
+        centre_lat = math.radians((min_lat + max_lat) / 2)
+        self.width = max(1, math.ceil((max_lon - min_lon) * METERS_PER_DEGREE * math.cos(centre_lat) / resolution_m))
+        self.height = max(1, math.ceil((max_lat - min_lat) * METERS_PER_DEGREE / resolution_m))
+        self.min_lon = min_lon
+        self.max_lat = max_lat
+        # pixel size in degrees, so that the pixels cover the box exactly
+        self.dx = (max_lon - min_lon) / self.width
+        self.dy = (max_lat - min_lat) / self.height
+
+    @classmethod
+    def from_size(cls, bbox, width, height):
+        """Pixel grid of a bounding box covered by an image of a given size."""
+        grid = cls.__new__(cls)
+        grid.width, grid.height = width, height
+        grid.min_lon, grid.max_lat = bbox[0], bbox[3]
+        grid.dx = (bbox[2] - bbox[0]) / width
+        grid.dy = (bbox[3] - bbox[1]) / height
+        return grid
+
+    def window_bbox(self, row, col, height, width):
+        """Bounds [min_lon, min_lat, max_lon, max_lat] of a window of pixels (rows go from north to south)."""
+        return [self.min_lon + col * self.dx, self.max_lat - (row + height) * self.dy,
+                self.min_lon + (col + width) * self.dx, self.max_lat - row * self.dy]
+
+    def tiles(self, tile_px=MAX_TILE_PX):
+        """
+        Windows of the tiles covering the grid, row by row.
+
+        :return: List of (row, col, height, width)
+        """
+        return [(row, col, min(tile_px, self.height - row), min(tile_px, self.width - col))
+                for row in range(0, self.height, tile_px) for col in range(0, self.width, tile_px)]
+
+    def geotiff_tags(self):
+        """GeoTIFF tags placing the grid in EPSG:4326 (pixel scale, tie point and geo keys)."""
+        geo_keys = [1, 1, 0, 4,
+                    1024, 0, 1, 2,      # GTModelType: geographic
+                    1025, 0, 1, 1,      # GTRasterType: pixel is area
+                    2048, 0, 1, 4326,   # GeographicType: WGS 84
+                    2054, 0, 1, 9102]   # GeogAngularUnits: degree
+        return [(33550, 12, 3, (self.dx, self.dy, 0.0), True),
+                (33922, 12, 6, (0.0, 0.0, 0.0, self.min_lon, self.max_lat, 0.0), True),
+                (34735, 3, len(geo_keys), tuple(geo_keys), True)]
+
+
+class GeoTiffWriter:
+    """
+    Uncompressed GeoTIFF filled window by window.
+
+    The file is created with contiguous, uncompressed pixels, so a tile is written with one
+    seek and write per pixel row at its place in the file (one for full rows); nothing but the
+    tile is held in memory.
+    """
+
+    def __init__(self, path, height, width, bands=3, dtype=np.uint8, extratags=()):
+        """
+        :param path: Output file
+        :param bands: Number of bands of the tiles
+        :param extratags: GeoTIFF tags (tifffile extratags) with the georeferencing
+        """
+        self.width = width
+        self.bands = bands
+        self.dtype = np.dtype(dtype)
+        # creates the file with zeroed pixels without holding them in memory
+        image = tifffile.memmap(path, shape=(height, width, bands), dtype=self.dtype,
+                                photometric='rgb' if bands == 3 else 'minisblack', extratags=list(extratags))
+        self.offset = image.offset
+        del image
+        self._file = open(path, 'r+b')
+
+    def write(self, row, col, tile):
+        """Writes a tile [height, width, bands] at a pixel position."""
+        tile = np.ascontiguousarray(tile, dtype=self.dtype)
+        pixel_bytes = self.bands * self.dtype.itemsize
+        row_bytes = self.width * pixel_bytes
+        if col == 0 and tile.shape[1] == self.width:
+            self._file.seek(self.offset + row * row_bytes)
+            self._file.write(tile.tobytes())
+            return
+        for i in range(tile.shape[0]):
+            self._file.seek(self.offset + (row + i) * row_bytes + col * pixel_bytes)
+            self._file.write(tile[i].tobytes())
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class MosaicWriter(GeoTiffWriter):
+    """
+    GeoTIFF of a pixel grid, filled tile by tile.
+    """
+
+    def __init__(self, path, grid, bands=3, dtype=np.uint8):
+        """
+        :param path: Output file
+        :param grid: PixelGrid of the mosaic
+        :param bands: Number of bands of the tiles
+        """
+        super(MosaicWriter, self).__init__(path, grid.height, grid.width, bands, dtype, grid.geotiff_tags())
+        self.grid = grid
+
+
+def save_geotiff(path, image, bbox):
+    """
+    Writes an image covering a bounding box as an uncompressed GeoTIFF.
+
+    :param image: Array [height, width, bands]
+    :param bbox: [min_lon, min_lat, max_lon, max_lat] of the image
+    """
+    grid = PixelGrid.from_size(bbox, image.shape[1], image.shape[0])
+    tmp_path = path + '.tmp'
+    with MosaicWriter(tmp_path, grid, bands=image.shape[2], dtype=image.dtype) as writer:
+        writer.write(0, 0, image)
+    os.replace(tmp_path, path)
+
+
+def read_geotiff_grid(path):
+    """
+    Pixel grid origin and size of a GeoTIFF written by MosaicWriter.
+
+    :return: (min_lon, max_lat, dx, dy)
+    """
+    with tifffile.TiffFile(path) as tif:
+        tags = tif.pages[0].tags
+        dx, dy, _ = tags[33550].value
+        min_lon, max_lat = tags[33922].value[3:5]
+    return min_lon, max_lat, dx, dy
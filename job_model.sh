@@ -1,14 +1,19 @@
 #!/bin/bash
 #SBATCH --job-name=DigiVizijaUcenjeTest
 #SBATCH --output=DigiVizijaUcenjeTest.out
-#SBATCH --partition=gpu
-#SBATCH --ntasks=1
-#SBATCH --nodes=1
+#SBATCH --partition=all
+#SBATCH --nodes=2
+#SBATCH --ntasks-per-node=4
+#SBATCH --cpus-per-task=8
 #SBATCH --time=4-00:00:00
-#SBATCH --gpus=1
+#SBATCH --requeue
 #SBATCH --export=ALL
 
 module load Python
 source /d/hpc/home/hackathon17/DigiVizija_env/bin/activate
 cd models
-srun python3 model2.py
+# one data-parallel training process per task, talking over gloo; the first node hosts the rendezvous
+export MASTER_ADDR=$(scontrol show hostnames "$SLURM_JOB_NODELIST" | head -n 1)
+export MASTER_PORT=29500
+# two CPUs of every task load data, the others train; a requeued job continues from the last checkpoint
+srun python3 model2.py --workers 2 --resume
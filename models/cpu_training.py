@@ -0,0 +1,59 @@
+"""Training settings for CPU nodes: bfloat16 autocast, channels_last, optional torch.compile and thread count."""
+import copy
+import time
+
+import torch
+
+from data_loading import available_cpus
+
+
+def configure_threads(threads=None, num_workers=0):
+    """
+    Sets the intra-op threads of this process.
+
+    :param threads: Number of threads (the available CPUs minus the loading workers if None)
+    :return: Number of threads set
+    """
+    threads = threads or max(1, available_cpus() - num_workers)
+    torch.set_num_threads(threads)
+    return threads
+
+
+def precision(device, enabled=True):
+    """
+    Autocast dtype and GradScaler of mixed precision training on a device.
+
+    :return: (dtype, scaler); dtype is None without mixed precision, the scaler is disabled on CPU
+    """
+    if not enabled:
+        return None, torch.amp.GradScaler(device.type, enabled=False)
+    if device.type == 'cuda':
+        return torch.float16, torch.amp.GradScaler('cuda')
+    return torch.bfloat16, torch.amp.GradScaler('cpu', enabled=False)
+
+
+def compile_model(model, inputs, targets, criterion, dtype=None):
+    """
+    torch.compile'd model, or the model itself if compiling does not work here.
+
+    The model is compiled with one forward and backward pass on an example batch, so that a missing
+    compiler shows up now and not in the middle of training. Parameters, buffers (BatchNorm
+    statistics) and gradients are left as they were.
+    """
+    if not hasattr(torch, 'compile'):
+        return model
+    state = copy.deepcopy(model.state_dict())
+    try:
+        compiled = torch.compile(model)
+        start = time.perf_counter()
+        with torch.autocast(inputs.device.type, dtype=dtype, enabled=dtype is not None):
+            loss = criterion(compiled(inputs).float(), targets)
+        loss.backward()
+        print(f"Compiled the model in {time.perf_counter() - start:.1f} s")
+        return compiled
+    except Exception as e:
+        print(f"Training without torch.compile ({type(e).__name__}: {e})")
+        return model
+    finally:
+        model.load_state_dict(state)
+        model.zero_grad(set_to_none=True)
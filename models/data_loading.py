@@ -0,0 +1,74 @@
+"""Data loaders with persistent, prefetching workers and a timer of the time training waits for data."""
+import os
+import time
+
+import torch
+from torch.utils.data import DataLoader
+
+
+def available_cpus():
+    """
+    CPUs this process may run on (the Slurm allocation on the cluster), divided among the training
+    processes started on the same CPUs by torchrun (LOCAL_WORLD_SIZE, see distributed_training.py).
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    return max(1, cpus // int(os.environ.get('LOCAL_WORLD_SIZE', 1)))
+
+
+def default_workers():
+    """One loading worker per available CPU but the one running the training loop, at most 8."""
+    return max(0, min(8, available_cpus() - 1))
+
+
+def make_loader(dataset, batch_size, shuffle=True, num_workers=None, prefetch_factor=2, device=None, **kwargs):
+    """
+    DataLoader with persistent, prefetching workers.
+
+    :param num_workers: Loading processes (default_workers() if None, 0 to load in the training process)
+    :param prefetch_factor: Batches every worker keeps ready
+    :param device: Training device; memory is pinned only for CUDA
+    """
+    if num_workers is None:
+        num_workers = default_workers()
+    device = torch.device(device) if device is not None else torch.device('cpu')
+    options = dict(batch_size=batch_size, shuffle=shuffle, num_workers=num_workers,
+                   pin_memory=device.type == 'cuda', **kwargs)
+    if num_workers > 0:
+        options.update(persistent_workers=True, prefetch_factor=prefetch_factor)
+    return DataLoader(dataset, **options)
+
+
+class DataWaitTimer:
+    """
+    Time a training loop spends waiting for batches, out of the time of the loop.
+    """
+
+    def __init__(self):
+        self.wait = 0.0
+        self.total = 0.0
+        self.batches = 0
+
+    def iterate(self, loader):
+        """Batches of the loader, timing how long every one was waited for."""
+        start = time.perf_counter()
+        requested = start
+        try:
+            for batch in loader:
+                self.wait += time.perf_counter() - requested
+                self.batches += 1
+                yield batch
+                requested = time.perf_counter()
+        finally:
+            self.total += time.perf_counter() - start
+
+    @property
+    def fraction(self):
+        """Share of the loop time spent waiting for data."""
+        return self.wait / self.total if self.total else 0.0
+
+    def summary(self):
+        return (f"data wait {100 * self.fraction:.1f}% of step time "
+                f"({1000 * self.wait / max(self.batches, 1):.1f} ms per batch)")
@@ -0,0 +1,183 @@
+"""Data-parallel training over torchrun or srun processes (gloo on CPU) and resumable sharded checkpoints."""
+import os
+import shutil
+import socket
+from contextlib import contextmanager, nullcontext
+
+import torch
+import torch.distributed as dist
+import torch.distributed.checkpoint as dcp
+import torch.multiprocessing as mp
+from torch.distributed.checkpoint.state_dict import get_state_dict, set_state_dict
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data.distributed import DistributedSampler
+
+LATEST_FILE = 'latest'
+
+
+def process_info():
+    """(rank, world size, local rank) of this process; (0, 1, 0) when it was not started by a launcher."""
+    if 'RANK' in os.environ and 'WORLD_SIZE' in os.environ:
+        return int(os.environ['RANK']), int(os.environ['WORLD_SIZE']), int(os.environ.get('LOCAL_RANK', 0))
+    # set by srun for every task of a job step (SLURM_NTASKS is also set in the batch script itself)
+    if 'SLURM_STEP_NUM_TASKS' in os.environ:
+        return (int(os.environ['SLURM_PROCID']), int(os.environ['SLURM_STEP_NUM_TASKS']),
+                int(os.environ.get('SLURM_LOCALID', 0)))
+    return 0, 1, 0
+
+
+def init_distributed():
+    """
+    Joins the process group of a multi-process run.
+
+    :return: (rank, world size, local rank); nothing is initialized for a single process
+    """
+    rank, world_size, local_rank = process_info()
+    if world_size > 1 and not dist.is_initialized():
+        os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+        os.environ.setdefault('MASTER_PORT', '29500')
+        if torch.cuda.is_available():
+            torch.cuda.set_device(local_rank)
+            backend = 'cpu:gloo,cuda:nccl'
+        else:
+            backend = 'gloo'
+        dist.init_process_group(backend, rank=rank, world_size=world_size)
+    return rank, world_size, local_rank
+
+
+def cleanup_distributed():
+    if dist.is_initialized():
+        dist.destroy_process_group()
+
+
+def is_main_process():
+    return not dist.is_initialized() or dist.get_rank() == 0
+
+
+def barrier():
+    if dist.is_initialized():
+        dist.barrier()
+
+
+@contextmanager
+def main_process_first():
+    """Context the first process runs through before the others enter it (to write files they then read)."""
+    if not is_main_process():
+        barrier()
+    yield
+    if is_main_process():
+        barrier()
+
+
+def sum_across_processes(values):
+    """Sums of numbers over all processes (the numbers themselves in a single process)."""
+    if not dist.is_initialized():
+        return list(values)
+    totals = torch.tensor(values, dtype=torch.float64)
+    dist.all_reduce(totals)
+    return totals.tolist()
+
+
+def make_sampler(dataset, shuffle=True, seed=42):
+    """DistributedSampler giving every process its share of the dataset, None in a single process."""
+    if not dist.is_initialized():
+        return None
+    return DistributedSampler(dataset, shuffle=shuffle, seed=seed)
+
+
+def wrap_model(model, device):
+    """DistributedDataParallel replica of the model, the model itself in a single process."""
+    if not dist.is_initialized():
+        return model
+    return DistributedDataParallel(model, device_ids=[device.index] if device.type == 'cuda' else None)
+
+
+def skip_gradient_sync(model, skip):
+    """
+    Context leaving the gradients of the next backward pass local when skip is True (gradient
+    accumulation only needs them averaged before the optimizer step).
+    """
+    if skip and isinstance(model, DistributedDataParallel):
+        return model.no_sync()
+    return nullcontext()
+
+
+def broadcast_buffers(model):
+    """
+    Copies the buffers (BatchNorm statistics) of the first process to the others. DistributedDataParallel
+    does it before every forward pass, so after the last batch of an epoch every process has its own.
+    """
+    if dist.is_initialized():
+        for buffer in model.buffers():
+            dist.broadcast(buffer, src=0)
+
+
+def _training_state(model, optimizer, scheduler, scaler, epoch=0, best_loss=float('inf')):
+    model_state, optimizer_state = get_state_dict(model, optimizer)
+    return {'model': model_state, 'optimizer': optimizer_state, 'scheduler': scheduler.state_dict(),
+            'scaler': scaler.state_dict(), 'epoch': epoch, 'best_loss': best_loss}
+
+
+def save_checkpoint(checkpoint_dir, epoch, model, optimizer, scheduler, scaler, best_loss, keep=2):
+    """
+    Saves the training state after an epoch into checkpoint_dir/epoch_{epoch}; called by every process.
+
+    :param model: The model without its DistributedDataParallel wrapper
+    :param epoch: Epochs done
+    :param keep: Checkpoints kept, the older ones are removed
+    """
+    path = os.path.join(checkpoint_dir, f'epoch_{epoch}')
+    # the shards of replicated tensors are written by different processes
+    broadcast_buffers(model)
+    dcp.save(_training_state(model, optimizer, scheduler, scaler, epoch, best_loss), checkpoint_id=path)
+    barrier()
+    if is_main_process():
+        tmp_path = os.path.join(checkpoint_dir, LATEST_FILE + '.tmp')
+        with open(tmp_path, 'w') as f:
+            f.write(os.path.basename(path))
+        os.replace(tmp_path, os.path.join(checkpoint_dir, LATEST_FILE))
+        epochs = sorted(int(name.split('_')[1]) for name in os.listdir(checkpoint_dir)
+                        if name.startswith('epoch_') and name.split('_')[1].isdigit())
+        for old in epochs[:-keep]:
+            shutil.rmtree(os.path.join(checkpoint_dir, f'epoch_{old}'), ignore_errors=True)
+    barrier()
+
+
+def load_checkpoint(checkpoint_dir, model, optimizer, scheduler, scaler):
+    """
+    Restores the latest checkpoint of a directory into the model, optimizer, scheduler and scaler;
+    called by every process.
+
+    :return: (epochs done, best loss), or None if there is no checkpoint
+    """
+    latest = os.path.join(checkpoint_dir, LATEST_FILE)
+    if not os.path.exists(latest):
+        return None
+    with open(latest) as f:
+        path = os.path.join(checkpoint_dir, f.read().strip())
+    state = _training_state(model, optimizer, scheduler, scaler)
+    dcp.load(state, checkpoint_id=path)
+    set_state_dict(model, optimizer, model_state_dict=state['model'], optim_state_dict=state['optimizer'])
+    scheduler.load_state_dict(state['scheduler'])
+    scaler.load_state_dict(state['scaler'])
+    return state['epoch'], state['best_loss']
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _local_process(local_rank, processes, port, fn, args):
+    os.environ.update(RANK=str(local_rank), WORLD_SIZE=str(processes), LOCAL_RANK=str(local_rank),
+                      LOCAL_WORLD_SIZE=str(processes), MASTER_ADDR='127.0.0.1', MASTER_PORT=str(port))
+    fn(*args)
+
+
+def run_local(fn, processes, *args):
+    """
+    Runs fn(*args) in a number of processes on this machine, set up like torchrun would; fn must be a
+    module-level function (it is pickled) and call init_distributed().
+    """
+    mp.spawn(_local_process, args=(processes, _free_port(), fn, args), nprocs=processes)
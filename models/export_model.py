@@ -0,0 +1,137 @@
+"""
+Exports a trained satellite predictor to TorchScript (float32 or static int8) for the backend.
+
+Usage (from the models directory): python export_model.py --weights ../best_model.pth --quantize --compare
+"""
+import argparse
+import copy
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+from predict_tiles import load_model
+
+SIZE = 256
+METADATA_FILE = 'predictor.json'
+
+
+def sequences(data_dir, input_years, model_kind='model2'):
+    """(inputs [1, years, 3, 256, 256], target [1, 3, 256, 256]) of every sequence of the training images."""
+    if model_kind == 'model1':
+        from model1 import ColorSatelliteDataset as Dataset
+    else:
+        from model2 import SatelliteDataset as Dataset
+    dataset = Dataset(data_dir, sequence_length=input_years + 1)
+    return [(inputs.unsqueeze(0), target.unsqueeze(0)) for inputs, target in (dataset[i] for i in range(len(dataset)))]
+
+
+def quantize(model, calibration):
+    """
+    int8 copy of a predictor, with the convolutions of the encoder, combiner and decoder statically quantized.
+
+    :param calibration: Input batches [batch, years, 3, 256, 256] to observe the activation ranges on
+    """
+    model = copy.deepcopy(model).to(memory_format=torch.contiguous_format).eval()
+    parts = ['encoder', 'combiner', 'decoder']
+    # example inputs of every part, for tracing it
+    examples = {}
+
+    def keep_example(part):
+        def hook(module, args, output):
+            examples.setdefault(part, args)
+        return hook
+
+    hooks = [getattr(model, part).register_forward_hook(keep_example(part)) for part in parts]
+    with torch.no_grad():
+        model(calibration[0])
+    for hook in hooks:
+        hook.remove()
+    # dynamic quantization only covers Linear/recurrent layers, hence static; the transposed convolutions stay
+    # in float32 because the int8 ConvTranspose2d gives wrong outputs when its input and output channels differ
+    qconfig_mapping = get_default_qconfig_mapping('x86').set_object_type(nn.ConvTranspose2d, None)
+    for part in parts:
+        setattr(model, part, prepare_fx(getattr(model, part), qconfig_mapping, examples[part]))
+    with torch.no_grad():
+        for x in calibration:
+            model(x)
+    for part in parts:
+        setattr(model, part, convert_fx(getattr(model, part)))
+    return model
+
+
+def trace(model, input_years):
+    """Frozen TorchScript of a predictor for batches of input_years years."""
+    example = torch.rand(1, input_years, 3, SIZE, SIZE)
+    with torch.no_grad():
+        traced = torch.jit.trace(model.eval(), example)
+    return torch.jit.freeze(traced)
+
+
+def save(scripted, path, metadata):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    torch.jit.save(scripted, path, _extra_files={METADATA_FILE: json.dumps(metadata)})
+
+
+def psnr(prediction, target):
+    mse = torch.mean((prediction.float() - target.float()) ** 2).item()
+    return float('inf') if mse == 0 else -10 * np.log10(mse)
+
+
+def compare(models, data):
+    """
+    Prints the latency and PSNR of every model on the sequences, and the PSNR of every model's output
+    against the first model's.
+
+    :param models: List of (name, model)
+    :param data: List of (inputs, target) from sequences()
+    """
+    outputs = {}
+    print(f"{'model':24s} {'ms/sequence':>12s} {'PSNR dB':>9s} {'PSNR vs ' + models[0][0]:>24s}")
+    for name, model in models:
+        with torch.inference_mode():
+            model(data[0][0])  # warm-up
+            start = time.perf_counter()
+            outputs[name] = [model(inputs) for inputs, _ in data]
+            latency = (time.perf_counter() - start) * 1000 / len(data)
+        quality = np.mean([psnr(out, target) for out, (_, target) in zip(outputs[name], data)])
+        agreement = np.mean([psnr(out, ref) for out, ref in zip(outputs[name], outputs[models[0][0]])])
+        print(f"{name:24s} {latency:12.1f} {quality:9.2f} {agreement:24.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export a trained satellite predictor to TorchScript.")
+    parser.add_argument("--weights", default="../best_model.pth")
+    parser.add_argument("--model", choices=["model1", "model2"], default="model2")
+    parser.add_argument("--input-years", type=int, default=2)
+    parser.add_argument("--data-dir", default="../satellite_images", help="Images for calibration and --compare.")
+    parser.add_argument("--output", default="satellite/predictor.pt")
+    parser.add_argument("--quantize", action="store_true", help="Export the int8 model instead of float32.")
+    parser.add_argument("--compare", action="store_true", help="Print latency and PSNR of float32 and int8.")
+    args = parser.parse_args()
+
+    model = load_model(args.model, args.weights, torch.device('cpu')).to(memory_format=torch.contiguous_format)
+    data = sequences(args.data_dir, args.input_years, args.model)
+    if not data:
+        raise ValueError(f"Need at least {args.input_years + 1} images in {args.data_dir}")
+    with open(args.weights, 'rb') as f:
+        weights_sha256 = hashlib.sha256(f.read()).hexdigest()
+
+    float_script = trace(model, args.input_years)
+    int8_script = trace(quantize(model, [inputs for inputs, _ in data]), args.input_years) \
+        if args.quantize or args.compare else None
+    exported = int8_script if args.quantize else float_script
+    save(exported, args.output, {'model': args.model, 'input_years': args.input_years, 'size': SIZE,
+                                 'precision': 'int8' if args.quantize else 'float32',
+                                 'weights_sha256': weights_sha256})
+    print(f"Exported the {'int8' if args.quantize else 'float32'} model to {args.output}")
+
+    if args.compare:
+        compare([('float32 eager', model), ('float32 TorchScript', float_script), ('int8 TorchScript', int8_script)],
+                data)
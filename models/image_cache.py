@@ -0,0 +1,125 @@
+"""Reading of the satellite images and a memory-mapped cache of them resized for training."""
+import json
+import os
+import socket
+
+import numpy as np
+import tifffile
+from skimage import io, transform
+
+# Lossless GeoTIFFs from images/image_fetcher.py come first; JPEG/PNG are read when no TIFF of the year exists
+IMAGE_EXTENSIONS = ('.tif', '.tiff', '.png', '.jpg', '.jpeg')
+CACHE_VERSION = 1
+
+
+def list_images(image_dir):
+    """Image files of a directory sorted by name, one file per name (the TIFF if there are several)."""
+    images = {}
+    for f in sorted(os.listdir(image_dir)):
+        stem, ext = os.path.splitext(f)
+        if ext.lower() in IMAGE_EXTENSIONS:
+            rank = IMAGE_EXTENSIONS.index(ext.lower())
+            if stem not in images or rank < IMAGE_EXTENSIONS.index(os.path.splitext(images[stem])[1].lower()):
+                images[stem] = f
+    return [images[stem] for stem in sorted(images)]
+
+
+def read_image(img_path):
+    """Pixels of an image; uncompressed TIFFs are memory-mapped instead of decoded."""
+    if img_path.lower().endswith(('.tif', '.tiff')):
+        try:
+            return tifffile.memmap(img_path, mode='r')
+        except ValueError:
+            # compressed or tiled TIFF
+            return tifffile.imread(img_path)
+    return io.imread(img_path)
+
+
+def load_image(img_path, size=256):
+    """RGB image resized to size x size, float32 [size, size, 3] in [0, 1]."""
+    img = read_image(img_path)
+    if len(img.shape) == 3 and img.shape[2] == 4:
+        img = img[:, :, :3]  # Drop alpha channel
+    img = transform.resize(img, (size, size))
+    return img.astype(np.float32)
+
+
+def _manifest(image_dir, files, size, dtype):
+    """Everything the cached array depends on."""
+    sources = []
+    for f in files:
+        stat = os.stat(os.path.join(image_dir, f))
+        sources.append({'file': f, 'bytes': stat.st_size, 'mtime_ns': stat.st_mtime_ns})
+    return {'version': CACHE_VERSION, 'size': size, 'dtype': np.dtype(dtype).name, 'sources': sources}
+
+
+class ImageCache:
+    """
+    Resized images of a directory in a memory-mapped array, rebuilt when the images change.
+    """
+
+    def __init__(self, image_dir, files, size=256, dtype=np.float16, cache_dir=None):
+        """
+        :param image_dir: Directory of the images
+        :param files: Image files of the directory in dataset order (list_images)
+        :param size: Side of the resized images in pixels
+        :param dtype: np.uint8 or np.float16
+        :param cache_dir: Directory of the cache (image_dir/.cache if None)
+        """
+        self.dtype = np.dtype(dtype)
+        if self.dtype not in (np.uint8, np.float16):
+            raise ValueError(f"Cache dtype must be uint8 or float16, not {self.dtype}")
+        cache_dir = cache_dir or os.path.join(image_dir, '.cache')
+        name = f"images_{size}_{self.dtype.name}"
+        self.path = os.path.join(cache_dir, name + '.npy')
+        self.manifest_path = os.path.join(cache_dir, name + '.json')
+        manifest = _manifest(image_dir, files, size, self.dtype)
+        if not self._is_current(manifest):
+            self._build(image_dir, files, size, manifest)
+        self._images = None
+
+    def _is_current(self, manifest):
+        if not (os.path.exists(self.manifest_path) and os.path.exists(self.path)):
+            return False
+        with open(self.manifest_path) as f:
+            return json.load(f) == manifest
+
+    def _build(self, image_dir, files, size, manifest):
+        """Writes the array image by image (never holding more than one in memory), then the manifest."""
+        print(f"Preprocessing {len(files)} images into {self.path}")
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + f'.{socket.gethostname()}.{os.getpid()}.tmp'
+        images = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=self.dtype, shape=(len(files), size, size, 3))
+        for i, f in enumerate(files):
+            img = load_image(os.path.join(image_dir, f), size)
+            images[i] = np.round(img * 255) if self.dtype == np.uint8 else img
+        images.flush()
+        del images
+        os.replace(tmp_path, self.path)
+        tmp_manifest = self.manifest_path + f'.{socket.gethostname()}.{os.getpid()}.tmp'
+        with open(tmp_manifest, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_manifest, self.manifest_path)
+
+    @property
+    def images(self):
+        """Memory-mapped array [n_images, size, size, 3], opened on first use (also in each loader worker)."""
+        if self._images is None:
+            self._images = np.load(self.path, mmap_mode='r')
+        return self._images
+
+    def __len__(self):
+        return len(self.images)
+
+    def image(self, index):
+        """Image as float32 [size, size, 3] in [0, 1], the same as load_image."""
+        img = self.images[index]
+        if self.dtype == np.uint8:
+            return img * np.float32(1 / 255)
+        return img.astype(np.float32)
+
+    def __getstate__(self):
+        # workers open their own memory map instead of receiving a copy of the array
+        state = self.__dict__.copy()
+        state['_images'] = None
+        return state
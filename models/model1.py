@@ -1,33 +1,40 @@
+import argparse
 import torch
 import torch.nn as nn
 import torch.optim as optim
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset
 import numpy as np
 import matplotlib.pyplot as plt
-from skimage import io, transform
 import os
 from torchvision import transforms
 from tqdm import tqdm
 
+from data_loading import DataWaitTimer, make_loader
+from image_cache import ImageCache, list_images, load_image
+from temporal import TemporalAttention, encode_frames
+
 # Set random seed for reproducibility
 torch.manual_seed(42)
 
 
 ## 1. Data Preparation for Color Images
 class ColorSatelliteDataset(Dataset):
-    def __init__(self, image_dir, sequence_length=3, transform=None):
+    def __init__(self, image_dir, sequence_length=3, transform=None, cache=True, cache_dtype=np.float16):
         """
         Args:
             image_dir: Directory with all the satellite images
-            sequence_length: Number of images in each sequence (including target)
+            sequence_length: Number of images in each sequence (input years and the target)
             transform: Optional transform to be applied
+            cache: Read the resized images from a preprocessed memory-mapped array (see image_cache.py)
+            cache_dtype: np.float16 or np.uint8 (half the size, rounded to 1/255)
         """
         self.image_dir = image_dir
         self.transform = transform
         self.sequence_length = sequence_length
 
         # Get all image files and sort them by date
-        self.image_files = sorted([f for f in os.listdir(image_dir) if f.endswith(('.png', '.jpg', '.jpeg'))])
+        self.image_files = list_images(image_dir)
+        self.cache = ImageCache(image_dir, self.image_files, dtype=cache_dtype) if cache else None
 
         # Calculate number of sequences
         self.num_sequences = len(self.image_files) - sequence_length + 1
@@ -39,16 +46,11 @@ class ColorSatelliteDataset(Dataset):
         # Load sequence of images
         images = []
         for i in range(self.sequence_length):
-            img_path = os.path.join(self.image_dir, self.image_files[idx + i])
-            img = io.imread(img_path)
-
-            # Handle 4-channel (RGBA) images by dropping alpha channel
-            if len(img.shape) == 3 and img.shape[2] == 4:
-                img = img[:, :, :3]  # Keep only RGB channels
-
-            # Resize and normalize to [0, 1]
-            img = transform.resize(img, (256, 256))
-            img = img.astype(np.float32)
+            # Resized to 256x256 and normalized to [0, 1], without alpha channel
+            if self.cache is not None:
+                img = self.cache.image(idx + i)
+            else:
+                img = load_image(os.path.join(self.image_dir, self.image_files[idx + i]))
 
             if self.transform:
                 img = self.transform(img)
@@ -57,9 +59,9 @@ class ColorSatelliteDataset(Dataset):
 
             images.append(img)
 
-        # Stack input images (first two) along batch dimension
-        input_images = torch.stack(images[:2], dim=0)  # Shape: [2, 3, 256, 256]
-        target_image = images[2]  # Shape: [3, 256, 256]
+        # Stack input images (all but the last) along a time dimension
+        input_images = torch.stack(images[:-1], dim=0)  # Shape: [sequence_length - 1, 3, 256, 256]
+        target_image = images[-1]  # Shape: [3, 256, 256]
 
         return input_images, target_image
 
@@ -69,7 +71,7 @@ class ColorSatellitePredictor(nn.Module):
     def __init__(self):
         super(ColorSatellitePredictor, self).__init__()
 
-        # Encoder for each image
+        # Encoder shared by all input years
         self.encoder = nn.Sequential(
             nn.Conv2d(3, 32, kernel_size=3, padding=1),
             nn.ReLU(),
@@ -82,6 +84,9 @@ class ColorSatellitePredictor(nn.Module):
             nn.MaxPool2d(2)  # 32x32
         )
 
+        # Fuses the features of the input years into [last year, attention-weighted mean]
+        self.temporal = TemporalAttention(128)
+
         # Combiner network
         self.combiner = nn.Sequential(
             nn.Conv2d(256, 256, kernel_size=3, padding=1),
@@ -103,19 +108,13 @@ class ColorSatellitePredictor(nn.Module):
         )
 
     def forward(self, x):
-        # x shape: [batch_size, 2, 3, 256, 256]
-        batch_size = x.shape[0]
-
-        # Process first image
-        img1 = x[:, 0]  # [batch, 3, 256, 256]
-        img1 = self.encoder(img1)  # [batch, 128, 32, 32]
+        # x shape: [batch_size, years, 3, 256, 256]
 
-        # Process second image
-        img2 = x[:, 1]  # [batch, 3, 256, 256]
-        img2 = self.encoder(img2)  # [batch, 128, 32, 32]
+        # Process all images in one batch
+        features = encode_frames(self.encoder, x)  # [batch, years, 128, 32, 32]
 
         # Combine features
-        combined = torch.cat([img1, img2], dim=1)  # [batch, 256, 32, 32]
+        combined = self.temporal(features)  # [batch, 256, 32, 32]
         combined = self.combiner(combined)
 
         # Decode to predicted image
@@ -125,16 +124,22 @@ class ColorSatellitePredictor(nn.Module):
 
 
 ## 3. Training Setup
-def train_model(data_dir, num_epochs=10, batch_size=4):
+def train_model(data_dir, num_epochs=10, batch_size=4, input_years=2, num_workers=None, prefetch_factor=2):
+    """
+    :param input_years: Years of images the prediction of the next year is made from
+    :param num_workers: Data loading processes (one per CPU but one if None, 0 to load in this process)
+    :param prefetch_factor: Batches every loading process keeps ready
+    """
     # Transform for color images
     transform = transforms.Compose([
         transforms.ToTensor(),
     ])
 
-    dataset = ColorSatelliteDataset(image_dir=data_dir, transform=transform)
-    dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=True)
-
+    dataset = ColorSatelliteDataset(image_dir=data_dir, sequence_length=input_years + 1, transform=transform)
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    dataloader = make_loader(dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers,
+                             prefetch_factor=prefetch_factor, device=device)
+    print(f"Loading data with {dataloader.num_workers} workers")
     model = ColorSatellitePredictor().to(device)
     criterion = nn.MSELoss()
     optimizer = optim.Adam(model.parameters(), lr=0.001)
@@ -143,7 +148,9 @@ def train_model(data_dir, num_epochs=10, batch_size=4):
     for epoch in range(num_epochs):
         model.train()
         running_loss = 0.0
-        progress_bar = tqdm(enumerate(dataloader), total=len(dataloader), desc=f'Epoch {epoch + 1}/{num_epochs}')
+        data_timer = DataWaitTimer()
+        progress_bar = tqdm(enumerate(data_timer.iterate(dataloader)), total=len(dataloader),
+                            desc=f'Epoch {epoch + 1}/{num_epochs}')
 
         for i, (inputs, targets) in progress_bar:
             inputs, targets = inputs.to(device), targets.to(device)
@@ -157,13 +164,15 @@ def train_model(data_dir, num_epochs=10, batch_size=4):
             running_loss += loss.item()
             progress_bar.set_postfix({'loss': f'{running_loss / (i + 1):.4f}'})
 
+        print(f"Epoch {epoch + 1}: loss {running_loss / len(dataloader):.4f}, {data_timer.summary()}")
+
     print('Training finished')
     return model
 
 
 ## 4. Color Visualization
-def visualize_color_prediction(model, data_dir, device='cpu'):
-    dataset = ColorSatelliteDataset(image_dir=data_dir)
+def visualize_color_prediction(model, data_dir, device='cpu', input_years=2):
+    dataset = ColorSatelliteDataset(image_dir=data_dir, sequence_length=input_years + 1)
     inputs, target = dataset[0]
 
     model.eval()
@@ -172,37 +181,32 @@ def visualize_color_prediction(model, data_dir, device='cpu'):
         prediction = model(inputs).squeeze().cpu().numpy()
 
     # Convert from CxHxW to HxWxC for visualization
-    input1 = inputs[0, 0].cpu().numpy().transpose(1, 2, 0)
-    input2 = inputs[0, 1].cpu().numpy().transpose(1, 2, 0)
+    input_images = [inputs[0, i].cpu().numpy().transpose(1, 2, 0) for i in range(input_years)]
     prediction = prediction.transpose(1, 2, 0)
     target = target.numpy().transpose(1, 2, 0)
 
     # Clip values to [0, 1] in case of small numerical errors
-    input1 = np.clip(input1, 0, 1)
-    input2 = np.clip(input2, 0, 1)
+    input_images = [np.clip(img, 0, 1) for img in input_images]
     prediction = np.clip(prediction, 0, 1)
     target = np.clip(target, 0, 1)
 
-    plt.figure(figsize=(15, 5))
+    n_plots = input_years + 2
+    plt.figure(figsize=(3.75 * n_plots, 5))
 
-    plt.subplot(1, 4, 1)
-    plt.imshow(input1)
-    plt.title('Year 1')
-    plt.axis('off')
-
-    plt.subplot(1, 4, 2)
-    plt.imshow(input2)
-    plt.title('Year 2')
-    plt.axis('off')
+    for i, img in enumerate(input_images):
+        plt.subplot(1, n_plots, i + 1)
+        plt.imshow(img)
+        plt.title(f'Year {i + 1}')
+        plt.axis('off')
 
-    plt.subplot(1, 4, 3)
+    plt.subplot(1, n_plots, n_plots - 1)
     plt.imshow(prediction)
-    plt.title('Predicted Year 3')
+    plt.title(f'Predicted Year {input_years + 1}')
     plt.axis('off')
 
-    plt.subplot(1, 4, 4)
+    plt.subplot(1, n_plots, n_plots)
     plt.imshow(target)
-    plt.title('Actual Year 3')
+    plt.title(f'Actual Year {input_years + 1}')
     plt.axis('off')
 
     plt.tight_layout()
@@ -211,7 +215,17 @@ def visualize_color_prediction(model, data_dir, device='cpu'):
 
 ## 5. Main Execution
 if __name__ == "__main__":
-    data_dir = '../satellite_images'
+    parser = argparse.ArgumentParser(description="Train the satellite image predictor.")
+    parser.add_argument("--data-dir", default="../satellite_images")
+    parser.add_argument("--epochs", type=int, default=5)
+    parser.add_argument("--input-years", type=int, default=2,
+                        help="Years of images every prediction is made from (10 uses 2015-2024 to predict 2025).")
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Data loading processes (default: one per available CPU but one, at most 8).")
+    parser.add_argument("--prefetch", type=int, default=2, help="Batches every loading process keeps ready.")
+    args = parser.parse_args()
+    data_dir = args.data_dir
 
     if not os.path.exists(data_dir):
         os.makedirs(data_dir)
@@ -235,16 +249,18 @@ if __name__ == "__main__":
 
             plt.imsave(f'{data_dir}/year_{year}.png', img)
 
-    image_files = [f for f in os.listdir(data_dir) if f.endswith(('.png', '.jpg', '.jpeg'))]
-    if len(image_files) < 3:
-        raise ValueError(f"Need at least 3 images in {data_dir}, found {len(image_files)}")
+    image_files = list_images(data_dir)
+    if len(image_files) < args.input_years + 1:
+        raise ValueError(f"Need at least {args.input_years + 1} images in {data_dir}, found {len(image_files)}")
 
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     print(f"Using device: {device}")
 
     try:
-        model = train_model(data_dir, num_epochs=5, batch_size=4)
-        visualize_color_prediction(model, data_dir, device)
+        model = train_model(data_dir, num_epochs=args.epochs, batch_size=args.batch_size,
+                            input_years=args.input_years,
+                            num_workers=args.workers, prefetch_factor=args.prefetch)
+        visualize_color_prediction(model, data_dir, device, args.input_years)
     except Exception as e:
         print(f"Error: {str(e)}")
         print("Please check your image files and try again.")
\ No newline at end of file
@@ -1,15 +1,23 @@
+import argparse
+import time
 import torch
 import torch.nn as nn
 import torch.optim as optim
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset
 import numpy as np
 import matplotlib.pyplot as plt
-from skimage import io, transform
 import os
 from torchvision import transforms
 from tqdm import tqdm
 from torch.optim.lr_scheduler import ReduceLROnPlateau
-from torch.cuda.amp import GradScaler, autocast
+
+from cpu_training import compile_model, configure_threads, precision
+from data_loading import DataWaitTimer, make_loader
+from distributed_training import (barrier, cleanup_distributed, init_distributed, load_checkpoint,
+                                  main_process_first, make_sampler, process_info, run_local, save_checkpoint,
+                                  skip_gradient_sync, sum_across_processes, wrap_model)
+from image_cache import ImageCache, list_images, load_image
+from temporal import TemporalAttention, encode_frames
 
 # Set random seed for reproducibility
 torch.manual_seed(42)
@@ -17,48 +25,46 @@ torch.manual_seed(42)
 
 ## 1. Data Preparation with Fixed Dimensions
 class SatelliteDataset(Dataset):
-    def __init__(self, image_dir, sequence_length=3, transform=None, augment=False):
+    def __init__(self, image_dir, sequence_length=3, transform=None, augment=False, cache=True,
+                 cache_dtype=np.float16):
         self.image_dir = image_dir
         self.transform = transform
         self.sequence_length = sequence_length
         self.augment = augment
 
-        self.image_files = sorted([f for f in os.listdir(image_dir) if f.endswith(('.png', '.jpg', '.jpeg'))])
+        self.image_files = list_images(image_dir)
+        # resized images are preprocessed once into a memory-mapped array (see image_cache.py)
+        self.cache = ImageCache(image_dir, self.image_files, dtype=cache_dtype) if cache else None
         self.num_sequences = len(self.image_files) - sequence_length + 1
 
-        # Augmentation transforms
-        self.augment_transforms = transforms.Compose([
-            transforms.RandomHorizontalFlip(p=0.5),
-            transforms.RandomVerticalFlip(p=0.5),
-        ])
-
     def __len__(self):
         return self.num_sequences
 
     def __getitem__(self, idx):
         images = []
         for i in range(self.sequence_length):
-            img_path = os.path.join(self.image_dir, self.image_files[idx + i])
-            img = io.imread(img_path)
-
-            if len(img.shape) == 3 and img.shape[2] == 4:
-                img = img[:, :, :3]  # Drop alpha channel
-
-            img = transform.resize(img, (256, 256))
-            img = img.astype(np.float32)
+            if self.cache is not None:
+                img = self.cache.image(idx + i)
+            else:
+                img = load_image(os.path.join(self.image_dir, self.image_files[idx + i]))
 
             if self.transform:
                 img = self.transform(img)
             else:
                 img = torch.from_numpy(img).permute(2, 0, 1)  # CHW format
 
-            if self.augment and i < self.sequence_length - 1:  # Don't augment target
-                img = self.augment_transforms(img)
-
             images.append(img)
 
-        input_images = torch.stack(images[:2], dim=0)  # [2, 3, 256, 256]
-        target_image = images[2]  # [3, 256, 256]
+        sequence = torch.stack(images, dim=0)  # [sequence_length, 3, 256, 256]
+        if self.augment:
+            # one random flip for the whole sequence, so the years and the target stay aligned pixel by pixel
+            if torch.rand(1).item() < 0.5:
+                sequence = sequence.flip(-1)
+            if torch.rand(1).item() < 0.5:
+                sequence = sequence.flip(-2)
+
+        input_images = sequence[:-1]  # [sequence_length - 1, 3, 256, 256]
+        target_image = sequence[-1]  # [3, 256, 256]
 
         return input_images, target_image
 
@@ -86,6 +92,9 @@ class SatellitePredictor(nn.Module):
             nn.MaxPool2d(2)  # 32x32
         )
 
+        # Fuses the features of the input years into [last year, attention-weighted mean]
+        self.temporal = TemporalAttention(256)
+
         # Feature combiner
         self.combiner = nn.Sequential(
             nn.Conv2d(512, 256, kernel_size=3, padding=1),
@@ -112,12 +121,11 @@ class SatellitePredictor(nn.Module):
         )
 
     def forward(self, x):
-        # Process both images
-        img1 = self.encoder(x[:, 0])  # [batch, 256, 32, 32]
-        img2 = self.encoder(x[:, 1])  # [batch, 256, 32, 32]
+        # Process the images of all input years in one batch
+        features = encode_frames(self.encoder, x)  # [batch, years, 256, 32, 32]
 
         # Combine features
-        combined = torch.cat([img1, img2], dim=1)  # [batch, 512, 32, 32]
+        combined = self.temporal(features)  # [batch, 512, 32, 32]
         combined = self.combiner(combined)  # [batch, 256, 32, 32]
 
         # Decode to prediction
@@ -127,79 +135,249 @@ class SatellitePredictor(nn.Module):
 
 
 ## 3. Training Setup
-def train_model(data_dir, num_epochs=15, batch_size=8):
+def prepare_model(device, mixed_precision=True, channels_last=True):
+    """
+    Model, autocast dtype and GradScaler for training on a device.
+
+    :param mixed_precision: bfloat16 autocast on CPU, float16 with loss scaling on CUDA
+    :param channels_last: Keep the weights (and so the activations) in NHWC layout
+    """
+    model = SatellitePredictor().to(device)
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last)
+    dtype, scaler = precision(device, mixed_precision)
+    return model, dtype, scaler
+
+
+def train_step(model, inputs, targets, criterion, dtype, scaler, accumulation_steps=1):
+    """
+    Forward and backward pass of a batch; the gradients are added to those of the previous batches.
+
+    :param accumulation_steps: Batches of the optimizer step this batch belongs to (the loss is averaged over them)
+    """
+    with torch.autocast(inputs.device.type, dtype=dtype, enabled=dtype is not None):
+        outputs = model(inputs)
+    loss = criterion(outputs.float(), targets)
+    scaler.scale(loss / accumulation_steps).backward()
+    return loss
+
+
+def train_model(data_dir, num_epochs=15, batch_size=8, input_years=2, num_workers=None, prefetch_factor=2,
+                accumulation_steps=1, mixed_precision=True, channels_last=True, compile=False, threads=None,
+                checkpoint_dir='../checkpoints', resume=False):
+    """
+    Trains the predictor, in one process or data-parallel in every process of a torchrun or srun launch
+    (see distributed_training.py); batch_size is per process.
+
+    :param input_years: Years of images the prediction of the next year is made from
+    :param num_workers: Data loading processes (one per CPU but one if None, 0 to load in this process)
+    :param prefetch_factor: Batches every loading process keeps ready
+    :param accumulation_steps: Batches whose gradients are added up before every optimizer step
+                               (effective batch size batch_size * accumulation_steps)
+    :param mixed_precision: bfloat16 autocast on CPU, float16 with loss scaling on CUDA
+    :param channels_last: Train in NHWC memory layout
+    :param compile: Use torch.compile when it works on this machine (measure it first with --benchmark)
+    :param threads: Intra-op threads on CPU (the CPUs not used by the loading workers if None)
+    :param checkpoint_dir: Directory of the checkpoints saved after every epoch (None to save none)
+    :param resume: Continue from the latest checkpoint in checkpoint_dir, if there is one
+    """
     transform = transforms.Compose([
         transforms.ToTensor(),
     ])
 
-    train_dataset = SatelliteDataset(
-        image_dir=data_dir,
-        transform=transform,
-        augment=True
-    )
+    rank, world_size, local_rank = init_distributed()
+    main = rank == 0
+    device = torch.device(f'cuda:{local_rank}' if torch.cuda.is_available() else 'cpu')
+
+    # the first process preprocesses the images, the others open its cache
+    with main_process_first():
+        train_dataset = SatelliteDataset(
+            image_dir=data_dir,
+            sequence_length=input_years + 1,
+            transform=transform,
+            augment=True
+        )
 
-    train_loader = DataLoader(
+    # every process loads its share of the sequences, reshuffled every epoch
+    sampler = make_sampler(train_dataset, shuffle=True)
+    # augmentation runs in the loading workers, in the dataset's __getitem__
+    train_loader = make_loader(
         train_dataset,
         batch_size=batch_size,
-        shuffle=True,
-        pin_memory=True
+        shuffle=sampler is None,
+        sampler=sampler,
+        num_workers=num_workers,
+        prefetch_factor=prefetch_factor,
+        device=device
     )
-
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    model = SatellitePredictor().to(device)
+    threads = configure_threads(threads, train_loader.num_workers) if device.type == 'cpu' else None
+    if main:
+        print(f"Training in {world_size} process(es), each loading data with {train_loader.num_workers} workers"
+              + (f" and training with {threads} threads" if threads else ""))
+    model, dtype, scaler = prepare_model(device, mixed_precision, channels_last)
 
     criterion = nn.MSELoss()
     optimizer = optim.Adam(model.parameters(), lr=0.001)
     scheduler = ReduceLROnPlateau(optimizer, 'min', patience=3, factor=0.5)
-    scaler = GradScaler()
 
-    best_loss = float('inf')
-    for epoch in range(num_epochs):
+    start_epoch, best_loss = 0, float('inf')
+    if resume and checkpoint_dir:
+        restored = load_checkpoint(checkpoint_dir, model, optimizer, scheduler, scaler)
+        if restored is not None:
+            start_epoch, best_loss = restored
+            if main:
+                print(f"Resuming after epoch {start_epoch} from {checkpoint_dir}")
+
+    # the replica and the compiled model share the parameters of the model, which is the one saved and returned
+    replica = wrap_model(model, device)
+    trained = replica
+    if compile:
+        inputs, targets = next(iter(train_loader))
+        trained = compile_model(replica, inputs.to(device), targets.to(device), criterion, dtype)
+
+    for epoch in range(start_epoch, num_epochs):
+        if sampler is not None:
+            sampler.set_epoch(epoch)
         model.train()
         epoch_loss = 0.0
-        progress_bar = tqdm(train_loader, desc=f'Epoch {epoch + 1}/{num_epochs}')
-
-        for inputs, targets in progress_bar:
-            inputs, targets = inputs.to(device), targets.to(device)
-
-            optimizer.zero_grad()
-
-            with autocast():
-                outputs = model(inputs)
-                loss = criterion(outputs, targets)
-
-            scaler.scale(loss).backward()
-            scaler.step(optimizer)
-            scaler.update()
+        n_images = 0
+        data_timer = DataWaitTimer()
+        progress_bar = tqdm(data_timer.iterate(train_loader), total=len(train_loader),
+                            desc=f'Epoch {epoch + 1}/{num_epochs}', disable=not main)
+        start = time.perf_counter()
+
+        optimizer.zero_grad(set_to_none=True)
+        for step, (inputs, targets) in enumerate(progress_bar):
+            inputs = inputs.to(device, non_blocking=True)
+            targets = targets.to(device, non_blocking=True)
+
+            # gradients are averaged over the processes only on the batch before an optimizer step
+            update = (step + 1) % accumulation_steps == 0 or step + 1 == len(train_loader)
+            # the last group of an epoch can be shorter
+            group_size = min(accumulation_steps, len(train_loader) - step // accumulation_steps * accumulation_steps)
+            with skip_gradient_sync(replica, not update):
+                loss = train_step(trained, inputs, targets, criterion, dtype, scaler, group_size)
+
+            if update:
+                scaler.step(optimizer)
+                scaler.update()
+                optimizer.zero_grad(set_to_none=True)
 
             epoch_loss += loss.item()
-            progress_bar.set_postfix({'loss': f'{epoch_loss / (progress_bar.n + 1):.4f}'})
+            n_images += len(targets)
+            progress_bar.set_postfix({'loss': f'{epoch_loss / (step + 1):.4f}'})
 
-        avg_loss = epoch_loss / len(train_loader)
+        # the loss of all processes, so that the scheduler steps the same everywhere
+        epoch_loss, n_batches, n_images = sum_across_processes([epoch_loss, len(train_loader), n_images])
+        avg_loss = epoch_loss / n_batches
         scheduler.step(avg_loss)
+        images_per_second = n_images / (time.perf_counter() - start)
+        if main:
+            print(f"Epoch {epoch + 1}: loss {avg_loss:.4f}, {images_per_second:.1f} images/s, "
+                  f"{data_timer.summary()}")
 
         if avg_loss < best_loss:
             best_loss = avg_loss
-            torch.save(model.state_dict(), '../best_model.pth')
-
-    print('Training finished')
+            if main:
+                torch.save(model.state_dict(), '../best_model.pth')
+        if checkpoint_dir:
+            save_checkpoint(checkpoint_dir, epoch + 1, model, optimizer, scheduler, scaler, best_loss)
+
+    barrier()
+    cleanup_distributed()
+    if main:
+        print('Training finished')
     return model
 
 
+def benchmark_training(batch_size=8, steps=10, threads=None):
+    """
+    Images per second of training steps on random batches: the original loop (float32, NCHW, eager;
+    its CUDA autocast does nothing on CPU) against every CPU setting added on top of it.
+    """
+    device = torch.device('cpu')
+    print(f"Benchmarking with {configure_threads(threads)} threads, batch size {batch_size}, {steps} steps")
+    inputs = torch.rand(batch_size, 2, 3, 256, 256)
+    targets = torch.rand(batch_size, 3, 256, 256)
+    criterion = nn.MSELoss()
+    settings = [("original (float32, NCHW)", False, False, False),
+                ("bfloat16 autocast", True, False, False),
+                ("bfloat16 + channels_last", True, True, False),
+                ("bfloat16 + channels_last + compile", True, True, True)]
+    for name, mixed_precision, channels_last, compile in settings:
+        torch.manual_seed(0)
+        model, dtype, scaler = prepare_model(device, mixed_precision, channels_last)
+        optimizer = optim.Adam(model.parameters(), lr=0.001)
+        trained = compile_model(model, inputs, targets, criterion, dtype) if compile else model
+        for step in range(steps + 2):
+            if step == 2:  # warm-up steps (allocations, oneDNN kernel selection)
+                start = time.perf_counter()
+            train_step(trained, inputs, targets, criterion, dtype, scaler)
+            scaler.step(optimizer)
+            scaler.update()
+            optimizer.zero_grad(set_to_none=True)
+        print(f"{name:36s} {batch_size * steps / (time.perf_counter() - start):7.1f} images/s")
+
+
+def _scaling_process(batch_size, steps, results):
+    """Data-parallel training steps on random batches in one process of run_local; rank 0 reports images/s."""
+    rank, world_size, _ = init_distributed()
+    device = torch.device('cpu')
+    configure_threads()
+    torch.manual_seed(rank)
+    inputs = torch.rand(batch_size, 2, 3, 256, 256)
+    targets = torch.rand(batch_size, 3, 256, 256)
+    criterion = nn.MSELoss()
+    model, dtype, scaler = prepare_model(device)
+    replica = wrap_model(model, device)
+    optimizer = optim.Adam(model.parameters(), lr=0.001)
+    for step in range(steps + 2):
+        if step == 2:  # warm-up steps
+            barrier()
+            start = time.perf_counter()
+        train_step(replica, inputs, targets, criterion, dtype, scaler)
+        scaler.step(optimizer)
+        scaler.update()
+        optimizer.zero_grad(set_to_none=True)
+    barrier()
+    elapsed = time.perf_counter() - start
+    images, = sum_across_processes([batch_size * steps])
+    if rank == 0:
+        results.put(images / elapsed)
+    cleanup_distributed()
+
+
+def benchmark_scaling(processes, batch_size=8, steps=10):
+    """
+    Images per second of data-parallel training on random batches with every number of processes on
+    this machine (batch_size per process), and the scaling efficiency against the first: the speedup
+    divided by the increase in processes.
+    """
+    results = torch.multiprocessing.get_context('spawn').SimpleQueue()
+    print(f"Benchmarking data-parallel training, batch size {batch_size} per process, {steps} steps")
+    print(f"{'processes':>9s} {'images/s':>9s} {'speedup':>8s} {'efficiency':>10s}")
+    baseline = None
+    for n in processes:
+        run_local(_scaling_process, n, batch_size, steps, results)
+        images_per_second = results.get()
+        baseline = baseline or (processes[0], images_per_second)
+        speedup = images_per_second / baseline[1]
+        print(f"{n:9d} {images_per_second:9.1f} {speedup:8.2f} {100 * speedup * baseline[0] / n:9.0f}%")
+
+
 ## 4. Visualization
-def visualize_prediction(model, data_dir, device='cpu'):
+def visualize_prediction(model, data_dir, device='cpu', input_years=2):
     model.load_state_dict(torch.load('../best_model.pth', map_location=device))
     model.eval()
 
-    dataset = SatelliteDataset(image_dir=data_dir)
+    dataset = SatelliteDataset(image_dir=data_dir, sequence_length=input_years + 1)
     inputs, target = dataset[0]
 
     with torch.no_grad():
         inputs = inputs.unsqueeze(0).to(device)
         prediction = model(inputs).squeeze().cpu().numpy()
 
-    input1 = inputs[0, 0].cpu().numpy().transpose(1, 2, 0)
-    input2 = inputs[0, 1].cpu().numpy().transpose(1, 2, 0)
+    input_images = [inputs[0, i].cpu().numpy().transpose(1, 2, 0) for i in range(input_years)]
     prediction = prediction.transpose(1, 2, 0)
     target = target.numpy().transpose(1, 2, 0)
 
@@ -207,24 +385,21 @@ def visualize_prediction(model, data_dir, device='cpu'):
     mse = np.mean((prediction - target) ** 2)
     psnr = -10 * np.log10(mse)
 
-    plt.figure(figsize=(15, 5))
-
-    plt.subplot(1, 4, 1)
-    plt.imshow(input1)
-    plt.title('Year 1')
-    plt.axis('off')
+    n_plots = input_years + 2
+    plt.figure(figsize=(3.75 * n_plots, 5))
 
-    plt.subplot(1, 4, 2)
-    plt.imshow(input2)
-    plt.title('Year 2')
-    plt.axis('off')
+    for i, img in enumerate(input_images):
+        plt.subplot(1, n_plots, i + 1)
+        plt.imshow(img)
+        plt.title(f'Year {i + 1}')
+        plt.axis('off')
 
-    plt.subplot(1, 4, 3)
+    plt.subplot(1, n_plots, n_plots - 1)
     plt.imshow(prediction)
     plt.title(f'Predicted\nPSNR: {psnr:.2f} dB')
     plt.axis('off')
 
-    plt.subplot(1, 4, 4)
+    plt.subplot(1, n_plots, n_plots)
     plt.imshow(target)
     plt.title('Actual')
     plt.axis('off')
@@ -235,7 +410,38 @@ def visualize_prediction(model, data_dir, device='cpu'):
 
 ## 5. Main Execution
 if __name__ == "__main__":
-    data_dir = '../satellite_images'
+    parser = argparse.ArgumentParser(description="Train the satellite image predictor.")
+    parser.add_argument("--data-dir", default="../satellite_images")
+    parser.add_argument("--epochs", type=int, default=15)
+    parser.add_argument("--input-years", type=int, default=2,
+                        help="Years of images every prediction is made from (10 uses 2015-2024 to predict 2025).")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Data loading processes (default: one per available CPU but one, at most 8).")
+    parser.add_argument("--prefetch", type=int, default=2, help="Batches every loading process keeps ready.")
+    parser.add_argument("--accumulate", type=int, default=1,
+                        help="Batches per optimizer step (effective batch size batch-size * accumulate).")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="Intra-op threads on CPU (default: the CPUs not used by the loading workers).")
+    parser.add_argument("--no-amp", action="store_true", help="Train in float32.")
+    parser.add_argument("--no-channels-last", action="store_true", help="Train in NCHW memory layout.")
+    parser.add_argument("--compile", action="store_true", help="Use torch.compile (see --benchmark).")
+    parser.add_argument("--checkpoint-dir", default="../checkpoints",
+                        help="Directory of the checkpoints saved after every epoch.")
+    parser.add_argument("--resume", action="store_true", help="Continue from the latest checkpoint.")
+    parser.add_argument("--benchmark", type=int, metavar="STEPS",
+                        help="Only compare the images/s of the CPU settings on random batches.")
+    parser.add_argument("--scaling", type=int, nargs="+", metavar="PROCESSES",
+                        help="Only measure data-parallel training with these numbers of processes, e.g. 1 2 4.")
+    parser.add_argument("--steps", type=int, default=10, help="Training steps measured by --scaling.")
+    args = parser.parse_args()
+    if args.benchmark:
+        benchmark_training(args.batch_size, args.benchmark, args.threads)
+        raise SystemExit
+    if args.scaling:
+        benchmark_scaling(args.scaling, args.batch_size, args.steps)
+        raise SystemExit
+    data_dir = args.data_dir
 
     if not os.path.exists(data_dir):
         os.makedirs(data_dir)
@@ -258,16 +464,22 @@ if __name__ == "__main__":
 
             plt.imsave(f'{data_dir}/year_{year}.png', img)
 
-    image_files = [f for f in os.listdir(data_dir) if f.endswith(('.png', '.jpg', '.jpeg'))]
-    if len(image_files) < 3:
-        raise ValueError(f"Need at least 3 images in {data_dir}, found {len(image_files)}")
+    image_files = list_images(data_dir)
+    if len(image_files) < args.input_years + 1:
+        raise ValueError(f"Need at least {args.input_years + 1} images in {data_dir}, found {len(image_files)}")
 
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     print(f"Using device: {device}")
 
     try:
-        model = train_model(data_dir)
-        visualize_prediction(model, data_dir, device)
+        model = train_model(data_dir, num_epochs=args.epochs, batch_size=args.batch_size,
+                            input_years=args.input_years,
+                            num_workers=args.workers, prefetch_factor=args.prefetch,
+                            accumulation_steps=args.accumulate, mixed_precision=not args.no_amp,
+                            channels_last=not args.no_channels_last, compile=args.compile,
+                            threads=args.threads, checkpoint_dir=args.checkpoint_dir, resume=args.resume)
+        if process_info()[0] == 0:
+            visualize_prediction(model, data_dir, device, args.input_years)
     except Exception as e:
         print(f"Error: {str(e)}")
         print("Please ensure your images are RGB and properly formatted.")
\ No newline at end of file
@@ -0,0 +1,142 @@
+"""
+Full-resolution prediction of the next year's image in blended 256 x 256 tiles, streamed into a GeoTIFF.
+
+Usage (from the models directory):
+    python predict_tiles.py ../satellite_images/output_image_2023.tif ../satellite_images/output_image_2024.tif \
+        --output ../satellite_images/predicted_2025.tif
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import tifffile
+import torch
+
+from image_cache import read_image
+
+# the GeoTIFF writer of the fetched images and mosaics, in images/mosaic.py
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'images'))
+import mosaic
+
+TILE = 256
+
+
+def tile_starts(length, tile=TILE, stride=TILE // 2):
+    """Start positions of tiles covering length pixels; the last tile ends at the edge."""
+    if length <= tile:
+        return [0]
+    starts = list(range(0, length - tile, stride))
+    return starts + [length - tile]
+
+
+def blend_window(tile=TILE, overlap=TILE // 4):
+    """Weights [tile, tile] of a tile, rising linearly over the overlap at every edge (never zero)."""
+    if overlap <= 0:
+        return np.ones((tile, tile), dtype=np.float32)
+    i = np.arange(tile) + 0.5
+    ramp = np.minimum(1.0, np.minimum(i, tile - i) / overlap).astype(np.float32)
+    return np.outer(ramp, ramp)
+
+
+def geo_tags(path):
+    """GeoTIFF tags (pixel scale, tie point, geo keys) of an input, to place the output on the same grid."""
+    if not path.lower().endswith(('.tif', '.tiff')):
+        return []
+    with tifffile.TiffFile(path) as tif:
+        tags = tif.pages[0].tags
+        return [(code, tags[code].dtype, tags[code].count, tags[code].value, True)
+                for code in (33550, 33922, 34735, 34736, 34737) if code in tags]
+
+
+def load_model(kind, weights, device):
+    """Trained predictor of model1.py (ColorSatellitePredictor) or model2.py (SatellitePredictor)."""
+    if kind == 'model1':
+        from model1 import ColorSatellitePredictor as Predictor
+    else:
+        from model2 import SatellitePredictor as Predictor
+    model = Predictor().to(device)
+    model.load_state_dict(torch.load(weights, map_location=device))
+    return model.to(memory_format=torch.channels_last).eval()
+
+
+def _read_band(images, top, height, width):
+    """Rows [top, top + height) of every input [years, height, width, 3], padded with the edge pixels to the size."""
+    band = np.stack([np.asarray(img[top:top + height, :, :3]) for img in images])
+    if band.shape[1] < height or band.shape[2] < width:
+        band = np.pad(band, ((0, 0), (0, height - band.shape[1]), (0, width - band.shape[2]), (0, 0)), mode='edge')
+    return band
+
+
+def predict_image(model, input_paths, output_path, device=None, batch_size=16, overlap=TILE // 4,
+                  mixed_precision=True):
+    """
+    Predicts the next year of a sequence of images, tile by tile, into a GeoTIFF.
+
+    :param model: Predictor in eval mode
+    :param input_paths: Images of the input years in chronological order, all of the same size
+    :param output_path: Output GeoTIFF
+    :param batch_size: Tiles per model call
+    :param overlap: Pixels shared by neighbouring tiles (blended)
+    :param mixed_precision: bfloat16 autocast on CPU, float16 on CUDA
+    """
+    device = device or next(model.parameters()).device
+    images = [read_image(path) for path in input_paths]
+    height, width = images[0].shape[:2]
+    if any(img.shape[:2] != (height, width) for img in images):
+        raise ValueError("All input images must have the same size")
+    stride = TILE - overlap
+    rows, cols = tile_starts(height, TILE, stride), tile_starts(width, TILE, stride)
+    padded_width = max(width, TILE)
+    window = blend_window(TILE, overlap)
+    dtype = (torch.float16 if device.type == 'cuda' else torch.bfloat16) if mixed_precision else None
+
+    # band of the output not written yet: rows [row, row + TILE)
+    total = np.zeros((TILE, padded_width, 3), dtype=np.float32)
+    weight = np.zeros((TILE, padded_width, 1), dtype=np.float32)
+    writer = mosaic.GeoTiffWriter(output_path, height, width, extratags=geo_tags(input_paths[-1]))
+    start = time.perf_counter()
+    try:
+        for k, row in enumerate(rows):
+            band = _read_band(images, row, TILE, padded_width)
+            for first in range(0, len(cols), batch_size):
+                batch_cols = cols[first:first + batch_size]
+                tiles = np.stack([band[:, :, col:col + TILE] for col in batch_cols])  # [batch, years, H, W, 3]
+                x = torch.from_numpy(tiles).permute(0, 1, 4, 2, 3).to(device).float() / 255
+                with torch.inference_mode(), torch.autocast(device.type, dtype=dtype, enabled=dtype is not None):
+                    predicted = model(x).float().permute(0, 2, 3, 1).cpu().numpy()  # [batch, H, W, 3]
+                for col, tile in zip(batch_cols, predicted):
+                    total[:, col:col + TILE] += tile * window[:, :, None]
+                    weight[:, col:col + TILE, 0] += window
+            # rows above the next row of tiles are final
+            done = (rows[k + 1] if k + 1 < len(rows) else height) - row
+            pixels = total[:done, :width] / weight[:done, :width]
+            writer.write(row, 0, np.clip(np.round(pixels * 255), 0, 255))
+            total = np.concatenate([total[done:], np.zeros((done, padded_width, 3), dtype=np.float32)])
+            weight = np.concatenate([weight[done:], np.zeros((done, padded_width, 1), dtype=np.float32)])
+    finally:
+        writer.close()
+    elapsed = time.perf_counter() - start
+    n_tiles = len(rows) * len(cols)
+    print(f"Predicted {width}x{height} pixels in {n_tiles} tiles in {elapsed:.1f} s "
+          f"({n_tiles / elapsed:.1f} tiles/s, {width * height / elapsed / 1e6:.2f} Mpixel/s) into {output_path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Predict the next year's image at full resolution, tile by tile.")
+    parser.add_argument("inputs", nargs="+", help="Images of the input years in chronological order.")
+    parser.add_argument("--output", required=True, help="Output GeoTIFF.")
+    parser.add_argument("--model", choices=["model1", "model2"], default="model2")
+    parser.add_argument("--weights", default="../best_model.pth")
+    parser.add_argument("--batch-size", type=int, default=16, help="Tiles per model call.")
+    parser.add_argument("--overlap", type=int, default=TILE // 4, help="Pixels shared by neighbouring tiles.")
+    parser.add_argument("--no-amp", action="store_true", help="Predict in float32.")
+    args = parser.parse_args()
+    if not 0 <= args.overlap < TILE:
+        parser.error(f"--overlap must be between 0 and {TILE - 1}")
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    predictor = load_model(args.model, args.weights, device)
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    predict_image(predictor, args.inputs, args.output, device, args.batch_size, args.overlap, not args.no_amp)
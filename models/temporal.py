@@ -0,0 +1,42 @@
+"""Building blocks of the satellite predictors for any number of input years."""
+import torch
+import torch.nn as nn
+
+# longest input sequence of the models (2015-2024 to predict 2025 is 10)
+MAX_INPUT_YEARS = 16
+
+
+def encode_frames(encoder, x):
+    """
+    Encodes all frames of a batch of sequences in one call of the encoder.
+
+    :param x: Frames [batch, years, channels, H, W]
+    :return: Feature maps [batch, years, features, h, w]
+    """
+    return encoder(x.flatten(0, 1)).unflatten(0, x.shape[:2])
+
+
+class TemporalAttention(nn.Module):
+    """
+    Fuses per-year feature maps into the features of the last year and their attention-weighted mean.
+
+    Every pixel of every year gets a score from its features and from how many years before the last
+    one it is; the mean over the years is weighted by the softmax of the scores.
+    """
+
+    def __init__(self, channels, max_years=MAX_INPUT_YEARS):
+        super(TemporalAttention, self).__init__()
+        self.score = nn.Conv2d(channels, 1, kernel_size=1)
+        # learned bias of a year by its distance to the last year (index 0 is the last year)
+        self.recency = nn.Parameter(torch.zeros(max_years))
+
+    def forward(self, features):
+        # features shape: [batch, years, channels, h, w]
+        years = features.shape[1]
+        if years > len(self.recency):
+            raise ValueError(f"At most {len(self.recency)} input years, got {years}")
+        scores = self.score(features.flatten(0, 1)).unflatten(0, features.shape[:2])  # [batch, years, 1, h, w]
+        scores = scores + self.recency[:years].flip(0).view(1, years, 1, 1, 1)
+        weights = torch.softmax(scores.float(), dim=1).to(features.dtype)
+        pooled = (weights * features).sum(dim=1)  # [batch, channels, h, w]
+        return torch.cat([features[:, -1], pooled], dim=1)  # [batch, 2 * channels, h, w]
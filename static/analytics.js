@@ -0,0 +1,46 @@
+// Fills the tables of the analytics page from the aggregate endpoints (/stats/...),
+// which the server computes from the baseline grid and the changes of the session's scenario.
+
+const formatValue = value => (value === null || value === undefined) ? '-' : Number(value).toPrecision(5);
+
+function fillTable(table, header, rows) {
+    table.innerHTML = '';
+    const head = table.insertRow();
+    header.forEach(text => {
+        const cell = document.createElement('th');
+        cell.textContent = text;
+        head.appendChild(cell);
+    });
+    rows.forEach(values => {
+        const row = table.insertRow();
+        values.forEach(value => { row.insertCell().textContent = value; });
+    });
+}
+
+function loadStatistics() {
+    fetch('/stats/summary').then(res => res.json()).then(stats => {
+        fillTable(document.getElementById('summaryTable'),
+            ['Pollutant', 'Mean (baseline)', 'Mean (scenario)', 'Exposure (baseline)', 'Exposure (scenario)'],
+            Object.keys(stats.current).map(pollutant => [
+                pollutant,
+                formatValue(stats.baseline[pollutant].mean),
+                formatValue(stats.current[pollutant].mean),
+                formatValue(stats.baseline[pollutant].population_weighted),
+                formatValue(stats.current[pollutant].population_weighted)
+            ]));
+    });
+    fetch('/stats/land-classes').then(res => res.json()).then(stats => {
+        fillTable(document.getElementById('landClassTable'),
+            ['Land class', 'Cells', 'NO2 mean'],
+            stats.current.map(entry => [entry.land_class, entry.cells, formatValue(entry.mean.no2_ppb)]));
+    });
+    fetch('/stats/top?pollutant=no2_ppb&n=10').then(res => res.json()).then(stats => {
+        fillTable(document.getElementById('topTable'),
+            ['Cell', 'Lat', 'Lon', 'NO2', 'Changed'],
+            stats.cells.map(cell => [cell.grid_id_x, formatValue(cell.lat), formatValue(cell.lon),
+                formatValue(cell.no2_ppb), cell.changed ? 'yes' : '']));
+    });
+}
+
+document.querySelector('.analytics-button').addEventListener('click', loadStatistics);
+loadStatistics();
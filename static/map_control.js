@@ -78,6 +78,7 @@ var elToColor = {
 let isDrawingMode = false; // Track whether drawing mode is enabled
 let isMouseDown = false; // Track whether the mouse is pressed
 let currentColor = elToColor["city"]; // Default color mode
+let shapeMode = "tiles"; // "tiles" paints grid squares, "line" and "area" draw freehand shapes
 
 // Reset toggle states on page load
 window.addEventListener('load', function () {
@@ -91,6 +92,8 @@ window.addEventListener('load', function () {
     document.getElementById('crops').checked = false;
     document.getElementById('factory').checked = false;
     document.getElementById('clearColor').checked = false;
+    document.getElementById('shapeTiles').checked = true;
+    shapeMode = "tiles";
 
 
     // Reset the currentColor variable to match the default
@@ -120,16 +123,67 @@ Object.keys(elToColor).forEach(colorKey => {
     }
 });
 
+// Add event listeners for shape mode toggles
+['shapeTiles', 'shapeLine', 'shapeArea'].forEach(id => {
+    document.getElementById(id).addEventListener('change', function () {
+        if (this.checked) shapeMode = this.value;
+    });
+});
+
+//////////////////////////////
+// Freehand lines and areas
+//////////////////////////////
+
+// Strokes sent to /predict as GeoJSON geometries; the backend selects the cells under them
+let freehandStrokes = [];
+let freehandLayer = L.layerGroup().addTo(map);
+let currentPath = null; // Points of the stroke being drawn
+let currentPathLayer = null;
+
+function finishFreehandStroke() {
+    const path = currentPath;
+    map.removeLayer(currentPathLayer);
+    currentPath = null;
+    currentPathLayer = null;
+    if (currentColor === elToColor["clearColor"]) return;
+
+    const coordinates = path.map(latlng => [latlng.lng, latlng.lat]); // GeoJSON uses [lon, lat]
+    let geometry;
+    if (shapeMode === "area" && path.length >= 3) {
+        geometry = { type: "Polygon", coordinates: [coordinates.concat([coordinates[0]])] };
+        L.polygon(path, { color: currentColor, fillOpacity: 0.5 }).addTo(freehandLayer);
+    } else if (path.length >= 2) {
+        geometry = { type: "LineString", coordinates: coordinates };
+        L.polyline(path, { color: currentColor, weight: 4 }).addTo(freehandLayer);
+    } else {
+        return;
+    }
+    const buffer = parseFloat(document.getElementById('strokeBuffer').value) || 0;
+    freehandStrokes.push({ geometry: geometry, buffer: buffer, color: currentColor });
+}
+
 // Add event listeners for mouse events on the map
-map.on('mousedown', function () {
+map.on('mousedown', function (event) {
     if (isDrawingMode) {
         isMouseDown = true;
+        if (shapeMode !== "tiles") {
+            currentPath = [event.latlng];
+            currentPathLayer = L.polyline(currentPath, { color: currentColor, dashArray: '4' }).addTo(map);
+        }
+    }
+});
+
+map.on('mousemove', function (event) {
+    if (currentPath) {
+        currentPath.push(event.latlng);
+        currentPathLayer.setLatLngs(currentPath);
     }
 });
 
 map.on('mouseup', function () {
     if (isDrawingMode) {
         isMouseDown = false;
+        if (currentPath) finishFreehandStroke();
     }
 });
 
@@ -148,13 +202,14 @@ async function fetchGridData() {
     try {
         // Fetch the grid data (replace with your backend API or static file URL)
         console.log("fetching grid data...")
-        const response = await fetch('/grid-data'); // Example: JSON file hosted as a static resource
+        const response = await fetch('/grid-data?compact=1'); // Example: JSON file hosted as a static resource
         if (!response.ok) {
             throw new Error('Failed to fetch grid data');
         }
         console.log("grid data fetch success");
-        const gridData = await response.json();
-        return gridData;
+        // the compact answer holds the grid descriptor and cell indices, the plain one a list of cells
+        const gridData = expandCompactPayload(await response.json());
+        return gridData.data || gridData;
     } catch (error) {
         console.error('Error fetching grid data:', error);
         return [];
@@ -180,7 +235,7 @@ async function renderPredefinedGrid() {
 
         // Add mouseover event for drawing mode
         rect.on('mouseover', function () {
-            if (isDrawingMode && isMouseDown) {
+            if (isDrawingMode && isMouseDown && shapeMode === "tiles") {
                 let tileKey = JSON.stringify({ southWest, northEast }); // Use tile bounds as the key
 
                 if (currentColor === "clear") {
@@ -195,7 +250,7 @@ async function renderPredefinedGrid() {
 
         // Add click event for drawing mode
         rect.on('click', function () {
-            if (isDrawingMode) {
+            if (isDrawingMode && shapeMode === "tiles") {
                 console.log('Clicked on tile:', southWest, northEast);
                 console.log('Current color:', currentColor);
                 let tileKey = JSON.stringify({ southWest, northEast }); // Use tile bounds as the key
@@ -249,6 +304,8 @@ document.getElementById('showHideGridToggle').addEventListener('change', functio
 document.getElementById('clearButton').addEventListener('click', function () {
     console.log('Resetting grid...');
     coloredTiles.clear(); // Clear the Map of colored tiles
+    freehandStrokes = []; // and the freehand lines and areas
+    freehandLayer.clearLayers();
     gridLayer.eachLayer(function (layer) {
         layer.setStyle({ fillColor: elToColor["clearColor"], fillOpacity: 0.2 }); // Reset all rectangles to default style
     });
@@ -273,7 +330,7 @@ document.getElementById('predictButton').addEventListener('click', function () {
             northEast: northEast,
             color: color
         };
-    });
+    }).concat(freehandStrokes);
 
     // Send the data to the backend
     fetch('/predict', {
@@ -287,6 +344,13 @@ document.getElementById('predictButton').addEventListener('click', function () {
             if (!response.ok) {
                 throw new Error('Failed to send prediction data');
             }
+            return response.json();
+        })
+        .then(result => {
+            // Values from the fast surrogate models are refined in the background, the prediction page waits for it
+            if (result.refinement_id) {
+                sessionStorage.setItem('refinementId', result.refinement_id);
+            }
             // Redirect to prediction.html after successful submission
             window.location.href = '/prediction';
         })
@@ -467,10 +467,24 @@ pollutionToggle.addEventListener('change', (e) => {
 //     data_type: "grid_and_point",
 //     data: [{"grid_id": num, "lat": num, "lon": num,"sw_lat": num, "sw_lon": num, "ne_lat": num, "ne_lon": num, "no2_ppb": num, "co_ppb": num, "so2_ppb": num, "o3_ppb": num, "ch4_ppb": num}]
 // }
-Promise.all([
-    fetch('/prediction-data').then(res => res.json()),
-    fetch('/unchanged-prediction-data').then(res => res.json())
-]).then(([changedData, unchangedData]) => {
+// or, requested with ?compact=1, the grid descriptor and cell indices (expanded by static/regular_grid.js)
+// {
+//     data_type: "grid_index",
+//     grid: {"crs": "EPSG:32633", "step": 1000, "origin": [x, y], ...},
+//     data: {"col": [...], "row": [...], "year": [...], "no2_ppb": [...], ...}
+// }
+// A shared scenario (/prediction?scenario=<key>) replaces the session's scenario before the data is loaded
+const sharedScenario = new URLSearchParams(window.location.search).get('scenario');
+const scenarioLoaded = sharedScenario
+    ? fetch(`/scenario/load/${sharedScenario}`, { method: 'POST' }).then(res => {
+        if (!res.ok) console.error('Could not load the shared scenario', sharedScenario);
+    })
+    : Promise.resolve();
+
+scenarioLoaded.then(() => Promise.all([
+    fetch('/prediction-data?compact=1').then(res => res.json()).then(expandCompactPayload),
+    fetch('/unchanged-prediction-data?compact=1').then(res => res.json()).then(expandCompactPayload)
+])).then(([changedData, unchangedData]) => {
     console.log("Changed data datatype:", changedData.data_type);
     console.log("Unchanged data datatype:", unchangedData.data_type);
     const dataType = changedData.data_type || unchangedData.data_type; // Assume both have the same data_type
@@ -491,6 +505,72 @@ Promise.all([
     console.error('Error fetching data:', error);
 });
 
+// Values predicted by the fast surrogate models are refined by the full models in the background,
+// reload the data once the refinement is finished
+const refinementId = sessionStorage.getItem('refinementId');
+if (refinementId) {
+    const pollRefinement = () => {
+        fetch(`/predict-status/${refinementId}`)
+            .then(res => res.json())
+            .then(status => {
+                if (status.status === 'pending') {
+                    setTimeout(pollRefinement, 1000);
+                    return;
+                }
+                sessionStorage.removeItem('refinementId');
+                if (status.status === 'done') {
+                    window.location.reload();
+                }
+            })
+            .catch(() => sessionStorage.removeItem('refinementId'));
+    };
+    pollRefinement();
+}
+
+// Undo/redo move the session along its scenario log; the server answers from its cache of scenario states
+const undoButton = document.getElementById('undoButton');
+const redoButton = document.getElementById('redoButton');
+const updateScenarioButtons = scenario => {
+    undoButton.disabled = !scenario.can_undo;
+    redoButton.disabled = !scenario.can_redo;
+};
+fetch('/scenario').then(res => res.json()).then(updateScenarioButtons);
+
+const moveScenario = action => {
+    fetch(`/scenario/${action}`, { method: 'POST' })
+        .then(res => res.json())
+        .then(result => {
+            if (result.error) {
+                console.error(result.error);
+                return;
+            }
+            if (result.refinement_id) {
+                sessionStorage.setItem('refinementId', result.refinement_id);
+            }
+            // without the ?scenario= of a shared link, which would load it again
+            window.location.href = window.location.pathname;
+        });
+};
+undoButton.addEventListener('click', () => moveScenario('undo'));
+redoButton.addEventListener('click', () => moveScenario('redo'));
+
+document.getElementById('shareButton').addEventListener('click', () => {
+    fetch('/scenario/share', { method: 'POST' })
+        .then(res => res.json())
+        .then(result => {
+            const url = window.location.origin + result.url;
+            if (navigator.clipboard) navigator.clipboard.writeText(url);
+            window.prompt('Link to this scenario:', url);
+        });
+});
+
+// Saves the changed scenario in the visible part of the map as GeoJSON (streamed by /export)
+document.getElementById('saveButton').addEventListener('click', () => {
+    const bounds = mapLeft.getBounds();
+    const bbox = [bounds.getWest(), bounds.getSouth(), bounds.getEast(), bounds.getNorth()].join(',');
+    window.location.href = `/export?format=geojson&bbox=${bbox}`;
+});
+
 // Synchronize the maps
 mapLeft.sync(mapRight);
 mapRight.sync(mapLeft);
\ No newline at end of file
@@ -0,0 +1,71 @@
+// Geometry of the regular UTM grid, derived in the browser from the grid descriptor.
+// Endpoints called with ?compact=1 send the descriptor (CRS, origin, step) and the col/row of
+// every cell instead of six coordinates per cell; expandCompactPayload turns such a payload back
+// into the records the maps use. The math mirrors air_quality/regular_grid.py.
+
+const WGS84_FLATTENING = 1 / 298.257223563;
+const WGS84_SEMI_MAJOR_AXIS = 6378137.0;
+
+const tmSeries = (function () {
+    const n = WGS84_FLATTENING / (2 - WGS84_FLATTENING);
+    return {
+        radius: WGS84_SEMI_MAJOR_AXIS / (1 + n) * (1 + n ** 2 / 4 + n ** 4 / 64),
+        beta: [
+            n / 2 - 2 * n ** 2 / 3 + 37 * n ** 3 / 96 - n ** 4 / 360,
+            n ** 2 / 48 + n ** 3 / 15 - 437 * n ** 4 / 1440,
+            17 * n ** 3 / 480 - 37 * n ** 4 / 840,
+            4397 * n ** 4 / 161280
+        ],
+        delta: [
+            2 * n - 2 * n ** 2 / 3 - 2 * n ** 3 + 116 * n ** 4 / 45,
+            7 * n ** 2 / 3 - 8 * n ** 3 / 5 - 227 * n ** 4 / 45,
+            56 * n ** 3 / 15 - 136 * n ** 4 / 35,
+            4279 * n ** 4 / 630
+        ]
+    };
+})();
+
+// Converts UTM easting/northing to [lat, lon] in degrees
+function utmToLatLng(easting, northing, projection) {
+    const k = projection.scale_factor * tmSeries.radius;
+    const xi = (northing - projection.false_northing) / k;
+    const eta = (easting - projection.false_easting) / k;
+    let xiP = xi;
+    let etaP = eta;
+    tmSeries.beta.forEach((beta, i) => {
+        const j = 2 * (i + 1);
+        xiP -= beta * Math.sin(j * xi) * Math.cosh(j * eta);
+        etaP -= beta * Math.cos(j * xi) * Math.sinh(j * eta);
+    });
+    const chi = Math.asin(Math.sin(xiP) / Math.cosh(etaP));
+    let phi = chi;
+    tmSeries.delta.forEach((delta, i) => {
+        phi += delta * Math.sin(2 * (i + 1) * chi);
+    });
+    const lam = Math.atan2(Math.sinh(etaP), Math.cos(xiP));
+    return [phi * 180 / Math.PI, projection.central_meridian + lam * 180 / Math.PI];
+}
+
+// Expands a compact payload ({grid, data: {col: [...], row: [...], <field>: [...]}}) to the
+// grid_and_point records of the full payload
+function expandCompactPayload(payload) {
+    if (payload.data_type !== 'grid_index') return payload;
+    const grid = payload.grid;
+    const [x0, y0] = grid.origin;
+    const step = grid.step;
+    const columns = payload.data;
+    const fields = Object.keys(columns).filter(field => field !== 'col' && field !== 'row');
+    const records = columns.col.map((col, i) => {
+        const row = columns.row[i];
+        const [swLat, swLon] = utmToLatLng(x0 + col * step, y0 + row * step, grid.projection);
+        const [neLat, neLon] = utmToLatLng(x0 + (col + 1) * step, y0 + (row + 1) * step, grid.projection);
+        const [lat, lon] = utmToLatLng(x0 + (col + 0.5) * step, y0 + (row + 0.5) * step, grid.projection);
+        const record = {
+            grid_id_x: `${x0 / step + col},${y0 / step + row}`,
+            lon: lon, lat: lat, sw_lon: swLon, sw_lat: swLat, ne_lon: neLon, ne_lat: neLat
+        };
+        fields.forEach(field => { record[field] = columns[field][i]; });
+        return record;
+    });
+    return { ...payload, data: records, data_type: 'grid_and_point' };
+}